@@ -0,0 +1,264 @@
+"""Post-brew analytics calculated from the brew history.
+
+The samples, stages, heat-ups and tasks of the selected brews are loaded into
+NumPy arrays and every metric is calculated for all brews at once, grouped by
+brew and vessel, so a season of brews is processed in one pass.
+
+Vessel metrics (per brew):
+- overshoot: the highest temperature above the target after it was reached
+- settling: seconds from reaching the target until the temperature stays within
+  the settling band, averaged over the hold periods
+- hold_std: standard deviation of the temperature from the target while holding
+- heatup_rate: average heating speed in Celsius/minute of the heat-ups
+- heater_seconds: heater time at full power equivalent, multiply by the heater
+  wattage for the energy
+Stage metrics: planned and actual durations. Pump metrics: duty cycle of the
+pumps over the brew, the distribution work/idle cycles included.
+
+    python analytics.py --last 20 --format html --out report.html
+    python analytics.py --brew 12 --brew 13
+"""
+import argparse
+import html
+import json
+import sys
+
+import numpy as np
+
+import config
+import history
+import process
+
+SETTLING_BAND = 0.5
+
+VESSELS = ('mashtun', 'boiler')
+
+# Pump commands of the brews recorded before the topology: (pump, started)
+_LEGACY_PUMPS = {
+    process.BrewTask.START_MASH_PUMP: ('mashtunpump', True), process.BrewTask.STOP_MASH_PUMP: ('mashtunpump', False),
+    process.BrewTask.START_TEMP_PUMP: ('temppump', True), process.BrewTask.STOP_TEMP_PUMP: ('temppump', False),
+    process.BrewTask.START_BOIL_PUMP: ('boilerpump', True), process.BrewTask.STOP_BOIL_PUMP: ('boilerpump', False),
+}
+
+def _columns(rows, names, dtype=float):
+    "Converts the rows of a query into one array per column, None becomes NaN."
+    if not rows:
+        return [np.empty(0, dtype=dtype) for _ in names]
+    return [np.array([np.nan if r[i] is None else r[i] for r in rows], dtype=dtype) for i in range(len(names))]
+
+def load(conn, brew_ids):
+    "Loads the tables of the brews into arrays."
+    marks = ",".join("?" * len(brew_ids))
+    data = {'brew_ids': np.array(sorted(brew_ids), dtype=np.int64)}
+    rows = conn.execute("SELECT brew_id, at, vessel, current, target, power FROM samples WHERE brew_id IN (" + marks + ")",
+                        brew_ids).fetchall()
+    brew, at, current, target, power = _columns([(r[0], r[1], r[3], r[4], r[5]) for r in rows], range(5))
+    vessel = np.array([VESSELS.index(r[2]) if r[2] in VESSELS else -1 for r in rows], dtype=np.int64)
+    data['samples'] = {'brew': brew.astype(np.int64), 'at': at, 'vessel': vessel, 'current': current, 'target': target, 'power': power}
+    rows = conn.execute("SELECT brew_id, stage, started_at, ended_at, planned_seconds FROM stages WHERE brew_id IN (" + marks + ") "
+                        "ORDER BY brew_id, started_at", brew_ids).fetchall()
+    brew, started, ended, planned = _columns([(r[0], r[2], r[3], r[4]) for r in rows], range(4))
+    data['stages'] = {'brew': brew.astype(np.int64), 'stage': [r[1] for r in rows], 'started': started, 'ended': ended, 'planned': planned}
+    rows = conn.execute("SELECT brew_id, vessel, target, start_temperature, set_at, reached_at FROM heatups WHERE brew_id IN (" + marks + ")",
+                        brew_ids).fetchall()
+    brew, target, start, set_at, reached = _columns([(r[0], r[2], r[3], r[4], r[5]) for r in rows], range(5))
+    vessel = np.array([VESSELS.index(r[1]) for r in rows], dtype=np.int64)
+    data['heatups'] = {'brew': brew.astype(np.int64), 'vessel': vessel, 'target': target, 'start': start, 'set_at': set_at, 'reached': reached}
+    rows = conn.execute("SELECT brew_id, at, event, param FROM tasks WHERE brew_id IN (" + marks + ") ORDER BY brew_id, at",
+                        brew_ids).fetchall()
+    data['tasks'] = rows
+    rows = conn.execute("SELECT id, started_at, finished_at, result, config, mash_water, sparge_water FROM brews WHERE id IN (" + marks + ")",
+                        brew_ids).fetchall()
+    data['brews'] = dict((r[0], {'started_at': r[1], 'finished_at': r[2], 'result': r[3], 'config': json.loads(r[4]),
+                                 'mash_water': r[5], 'sparge_water': r[6]}) for r in rows)
+    return data
+
+def _group_index(brew_ids, brew, vessel):
+    "Returns the index of the (brew, vessel) group of every row."
+    return np.searchsorted(brew_ids, brew) * len(VESSELS) + vessel
+
+def vessel_metrics(data):
+    "Returns a (brew, vessel) indexed dict of arrays with the vessel metrics."
+    brew_ids = data['brew_ids']
+    ngroups = len(brew_ids) * len(VESSELS)
+    s = data['samples']
+    valid = s['vessel'] >= 0
+    group = _group_index(brew_ids, s['brew'][valid], s['vessel'][valid])
+    at, current, target, power = s['at'][valid], s['current'][valid], s['target'][valid], s['power'][valid]
+    order = np.lexsort((at, group))
+    group, at, current, target, power = group[order], at[order], current[order], target[order], power[order]
+    target = np.nan_to_num(target)
+
+    # Time until the next sample of the same group, 0 at the end of the groups
+    dt = np.zeros_like(at)
+    if len(at) > 1:
+        dt[:-1] = np.where(group[1:] == group[:-1], np.diff(at), 0)
+    heater_seconds = np.bincount(group, weights=np.nan_to_num(power) / 100.0 * dt, minlength=ngroups)
+
+    # Hold segments: runs of samples with the same non-zero target
+    new_segment = np.ones(len(at), dtype=bool)
+    if len(at) > 1:
+        new_segment[1:] = (group[1:] != group[:-1]) | (target[1:] != target[:-1])
+    segment = np.cumsum(new_segment) - 1
+    nsegments = segment[-1] + 1 if len(segment) else 0
+    segment_group = group[new_segment]
+    controlled = target > 0
+    reached = controlled & (current >= target - SETTLING_BAND)
+    first_reached = np.full(nsegments, np.inf)
+    np.minimum.at(first_reached, segment[reached], at[reached])
+    holding = controlled & (at >= first_reached[segment])
+    error = current - target
+
+    overshoot = np.full(ngroups, np.nan)
+    np.fmax.at(overshoot, group[holding], np.maximum(error[holding], 0))
+
+    outside = holding & (np.abs(error) > SETTLING_BAND)
+    last_outside = np.full(nsegments, -np.inf)
+    np.maximum.at(last_outside, segment[outside], at[outside])
+    held = np.isfinite(first_reached)
+    settling = np.where(np.isfinite(last_outside), last_outside - first_reached, 0)
+    settling_sum = np.bincount(segment_group[held], weights=settling[held], minlength=ngroups)
+    settling_count = np.bincount(segment_group[held], minlength=ngroups)
+
+    hold_count = np.bincount(group[holding], minlength=ngroups)
+    hold_sum = np.bincount(group[holding], weights=error[holding], minlength=ngroups)
+    hold_sq = np.bincount(group[holding], weights=error[holding] ** 2, minlength=ngroups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        hold_mean = hold_sum / hold_count
+        hold_std = np.sqrt(np.maximum(hold_sq / hold_count - hold_mean ** 2, 0))
+        settling_avg = settling_sum / settling_count
+
+    h = data['heatups']
+    done = np.isfinite(h['reached']) & np.isfinite(h['start']) & (h['reached'] > h['set_at'])
+    hgroup = _group_index(brew_ids, h['brew'][done], h['vessel'][done])
+    rate = (h['target'][done] - h['start'][done]) / (h['reached'][done] - h['set_at'][done]) * 60
+    with np.errstate(invalid='ignore', divide='ignore'):
+        heatup_rate = np.bincount(hgroup, weights=rate, minlength=ngroups) / np.bincount(hgroup, minlength=ngroups)
+
+    shape = (len(brew_ids), len(VESSELS))
+    return {'overshoot': overshoot.reshape(shape), 'settling': settling_avg.reshape(shape), 'hold_std': hold_std.reshape(shape),
+            'heatup_rate': heatup_rate.reshape(shape), 'heater_seconds': heater_seconds.reshape(shape)}
+
+def stage_metrics(data):
+    "Returns the planned and actual duration of every recorded stage."
+    st = data['stages']
+    actual = st['ended'] - st['started']
+    return {'brew': st['brew'], 'stage': st['stage'], 'planned': st['planned'], 'actual': actual,
+            'deviation': actual - st['planned']}
+
+def _distribution_ratio(cfg, param):
+    "Fraction of the time the mash pump works when started with a distribution parameter."
+    pumps = cfg.get(config.PombruConfig.SECTION_PUMPS, {})
+    keys = {'MASH_DISTRIBUTION': ('mashcirculatedistributionwork', 'mashcirculatedistributionidle'),
+            'SPARGE_DISTRIBUTION': ('spargecirculatedistributionwork', 'spargecirculatedistributionidle')}
+    if param not in keys or keys[param][0] not in pumps:
+        return 1.0
+    work, idle = float(pumps[keys[param][0]]), float(pumps[keys[param][1]])
+    return work / (work + idle) if work + idle > 0 else 1.0
+
+def _pump_commands(tasks):
+    "Returns the (brew, at, pump, started, distribution) pump commands of the tasks."
+    for brew, at, event, param in tasks:
+        if event in _LEGACY_PUMPS:
+            pump, started = _LEGACY_PUMPS[event]
+            yield brew, at, pump, started, param if started else None
+        elif event == process.BrewTask.START_PUMP or event == process.BrewTask.STOP_PUMP:
+            pump, _, distribution = (param or "").partition(":")
+            yield brew, at, pump, event == process.BrewTask.START_PUMP, distribution or None
+
+def pump_metrics(data):
+    "Returns a brew indexed dict of pump duty cycle arrays."
+    brew_ids = data['brew_ids']
+    ret = {}
+    commands = list(_pump_commands(data['tasks']))
+    for pump in sorted(set(c[2] for c in commands)):
+        rows = [c for c in commands if c[2] == pump]
+        brew = np.array([c[0] for c in rows], dtype=np.int64)
+        at = np.array([c[1] for c in rows], dtype=float)
+        on = np.array([_distribution_ratio(data['brews'][c[0]]['config'], c[4]) if c[3] else 0.0 for c in rows])
+        # A pump state lasts until the next command of the pump or the end of the brew
+        ends = np.array([data['brews'][b]['finished_at'] or at[-1] for b in brew]) if len(rows) else np.empty(0)
+        next_at = ends.copy()
+        if len(rows) > 1:
+            same = brew[1:] == brew[:-1]
+            next_at[:-1] = np.where(same, at[1:], ends[:-1])
+        on_seconds = np.bincount(np.searchsorted(brew_ids, brew), weights=on * (next_at - at), minlength=len(brew_ids))
+        durations = np.array([(data['brews'][b]['finished_at'] or np.nan) - data['brews'][b]['started_at'] for b in brew_ids])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ret[pump] = on_seconds / durations
+    return ret
+
+def analyze(hist, brew_ids):
+    "Returns the report of the brews as a JSON serializable dict."
+    conn = history.connect(hist.filename)
+    try:
+        data = load(conn, list(brew_ids))
+    finally:
+        conn.close()
+    vessels = vessel_metrics(data)
+    stages = stage_metrics(data)
+    pumps = pump_metrics(data)
+
+    def num(value):
+        return None if not np.isfinite(value) else round(float(value), 3)
+
+    report = []
+    for i, brew_id in enumerate(data['brew_ids'].tolist()):
+        brew = data['brews'].get(brew_id)
+        if brew is None:
+            continue
+        entry = {'brew': brew_id, 'started_at': brew['started_at'], 'result': brew['result'],
+                 'mash_water': brew['mash_water'], 'sparge_water': brew['sparge_water'], 'vessels': {}, 'pumps': {}, 'stages': []}
+        for v, vessel in enumerate(VESSELS):
+            entry['vessels'][vessel] = dict((name, num(values[i, v])) for name, values in vessels.items())
+        for pump, duty in pumps.items():
+            entry['pumps'][pump] = num(duty[i])
+        for j in np.flatnonzero(stages['brew'] == brew_id):
+            entry['stages'].append({'stage': stages['stage'][j], 'planned': num(stages['planned'][j]),
+                                    'actual': num(stages['actual'][j]), 'deviation': num(stages['deviation'][j])})
+        report.append(entry)
+    return report
+
+def render_html(report):
+    "Renders the report as a standalone HTML page."
+    out = ["<!DOCTYPE html><html><head><meta charset='utf-8'><title>Pombru brew report</title>",
+           "<style>body{font-family:sans-serif} table{border-collapse:collapse;margin-bottom:1em} "
+           "td,th{border:1px solid #999;padding:2px 6px;text-align:right}</style></head><body>"]
+
+    def table(headers, rows):
+        out.append("<table><tr>" + "".join("<th>" + html.escape(str(h)) + "</th>" for h in headers) + "</tr>")
+        for row in rows:
+            out.append("<tr>" + "".join("<td>" + html.escape("-" if c is None else str(c)) + "</td>" for c in row) + "</tr>")
+        out.append("</table>")
+
+    for entry in report:
+        out.append("<h2>Brew %d (%s, mash %s L, sparge %s L)</h2>" % (
+            entry['brew'], html.escape(str(entry['result'])), entry['mash_water'], entry['sparge_water']))
+        metrics = ('overshoot', 'settling', 'hold_std', 'heatup_rate', 'heater_seconds')
+        table(('vessel',) + metrics, [[vessel] + [values[m] for m in metrics] for vessel, values in entry['vessels'].items()])
+        table(('pump', 'duty'), sorted(entry['pumps'].items()))
+        table(('stage', 'planned', 'actual', 'deviation'),
+              [[s['stage'], s['planned'], s['actual'], s['deviation']] for s in entry['stages']])
+    out.append("</body></html>")
+    return "\n".join(out)
+
+def main():
+    parser = argparse.ArgumentParser(description="Post-brew analytics report.")
+    parser.add_argument("--database", default=None, help="Database file, [history] Database by default")
+    parser.add_argument("--brew", type=int, action="append", help="Brew id, can be repeated")
+    parser.add_argument("--last", type=int, default=1, help="Report the last brews if no --brew is given")
+    parser.add_argument("--format", default="json", choices=["json", "html"])
+    parser.add_argument("--out", default=None, help="Output file, stdout by default")
+    args = parser.parse_args()
+    hist = history.BrewHistory(args.database or config.config.history_database)
+    brew_ids = args.brew or sorted(b['id'] for b in hist.brews(args.last))
+    report = analyze(hist, brew_ids)
+    text = render_html(report) if args.format == "html" else json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""Benchmarks of the control stack's hot paths.
+
+Runs with mocked GPIO (GPIOZERO_PIN_FACTORY=mock), from a directory containing
+a pombru.ini. Every benchmark reports the time of one operation; the soak test
+brews the recipe again and again for several simulated hours on a virtual clock
+(see planner.py) and reports the thread count and RSS growth.
+
+    python benchmarks.py --save      # store the results as the baseline
+    python benchmarks.py             # compare with the baseline, exit code 1 on regression
+"""
+import os
+os.environ.setdefault('GPIOZERO_PIN_FACTORY', 'mock')
+
+import argparse
+import gc
+import json
+import logging
+import threading
+import time
+
+import brewery
+import config
+import flows
+import history
+import lowlevel
+import planner
+import process
+import recipes
+import utils
+from pid.PID import PID
+
+BASELINE_FILE = "benchmark_baseline.json"
+
+class ConstantAdc(object):
+    "ADC returning a constant value, so the conversion path of Thermistor is exercised."
+    value = 0.3
+
+class TaskRecorder(object):
+    "Actor of the process which only counts the tasks."
+    def __init__(self):
+        self.count = 0
+
+    def task(self, task):
+        self.count += 1
+
+def measure(func, number=1000, repeat=5):
+    "Returns the best time of one call in seconds, out of repeat rounds of number calls."
+    best = None
+    for _ in range(repeat):
+        gc.disable()
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def rss_kb():
+    "Returns the resident set size of the process in kilobytes."
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+def bench_thermistor():
+    thermistor = lowlevel.Thermistor(0, adc=ConstantAdc())
+    return measure(thermistor.get_temp, 10000)
+
+def bench_pid_update():
+    pid = PID(1, 3, 0.2)
+    pid.SetPoint = 67
+    return measure(lambda: pid.update(65), 10000)
+
+def bench_calc_heater_power(brwry):
+    jm = brwry.mashtun
+    jm.set_temperature(67)
+    return measure(lambda: jm._calc_heater_power(65.0), 10000)
+
+def bench_enter_stage():
+    p = process.BrewProcess(recipes.from_config())
+    p.actor = TaskRecorder()
+    stages = [process.BrewStages.MASHING_1, process.BrewStages.SPARGE_CIRCULATE_IN_MASH_1, process.BrewStages.BOIL]
+    i = [0]
+    def enter():
+        p._enter_stage(stages[i[0] % len(stages)])
+        i[0] += 1
+    ret = measure(enter, 200)
+    p._reset()
+    return ret
+
+def bench_get_status():
+    p = process.BrewProcess(recipes.from_config())
+    p.actor = TaskRecorder()
+    p._enter_stage(process.BrewStages.MASHING_1)
+    ret = measure(p.get_status, 10000)
+    p._reset()
+    return ret
+
+def bench_brewery_task(brwry):
+    tasks = [process.BrewTask(process.BrewTask.SET_ROUTES, "temporary->boiler"), process.BrewTask(process.BrewTask.SET_ROUTES, ""),
+             process.BrewTask(process.BrewTask.SET_ROUTES, "mashtun->temporary"), process.BrewTask(process.BrewTask.SET_ROUTES, "mashtun->mashtun")]
+    i = [0]
+    def task():
+        brwry.task(tasks[i[0] % len(tasks)])
+        i[0] += 1
+    return measure(task, 1000)
+
+def bench_rest(brwry, prcss, path):
+    import restapi
+    client = restapi.PombruRestApi(brwry, prcss)._app.test_client()
+    url = restapi.BASE + path
+    return measure(lambda: client.get(url), 200)
+
+def soak(hours):
+    """Brews the recipe again and again for hours simulated hours, on a VirtualClock with
+    the thermistors reading the planner's PlantModel: the device loops, timers, heat-ups
+    and transfers all run, and the brewer's steps are taken like in planner.simulate().
+    Returns (thread growth, rss growth in kB, completed brews). The RSS growth is
+    measured in the second half only, after the bounded buffers have warmed up."""
+    cfg = config.config.current
+    recipe = recipes.from_config()
+    real_clock = utils.clock
+    clock = utils.VirtualClock(0.0)
+    utils.clock = clock
+    try:
+        model = planner.PlantModel(cfg)
+        brwry = brewery.Brewery(mashtun_adc=planner.ModelAdc(model.vessels['mashtun']),
+                                boiler_adc=planner.ModelAdc(model.vessels['boiler']))
+        brwry.transfers.learn = False
+        prcss = process.BrewProcess(recipe)
+        prcss.actor = brwry
+        brwry.process = prcss
+        operator = set(process.operator_stages(cfg.transfer_mode, cfg.pause, flows.get(recipe.flow) if recipe.flow is not None else None))
+        threads_start = threading.active_count()
+        end = hours * 3600
+        rss_start = None
+        brews = 0
+        while clock.time() < end:
+            for vessel in model.vessels.values():
+                vessel.liters, vessel.temperature = 0.0, cfg.planner_ambient_temperature
+            model.attach(brwry, recipe)
+            prcss.start()
+            started = clock.time()
+            stage, entered, advanced = None, None, None
+            while clock.time() < end and clock.time() - started < cfg.planner_max_hours * 3600:
+                clock.run_until(clock.time() + cfg.planner_step_secs)
+                model.step(cfg.planner_step_secs)
+                snapshot = prcss.get_status_snapshot()
+                if snapshot.status == 'stopped':
+                    brews += 1
+                    break
+                if snapshot.stage is not stage:
+                    stage, entered = snapshot.stage, clock.time()
+                key = history.stage_key(stage['name'])
+                if key in operator and advanced is not stage and clock.time() - entered >= cfg.planner_operator_secs:
+                    advanced = stage
+                    if cfg.transfer_mode == 'MANUAL':
+                        model.manual_transfers(key)
+                    prcss.next()
+            prcss.stop()
+            if rss_start is None and clock.time() > end / 2:
+                rss_start = rss_kb()
+        if rss_start is None:
+            rss_start = rss_kb()
+        return threading.active_count() - threads_start, rss_kb() - rss_start, brews
+    finally:
+        utils.clock = real_clock
+
+def run(soak_hours):
+    config.config.override(valve_settle_time_secs=0)
+    brwry = brewery.Brewery()
+    prcss = process.BrewProcess(recipes.from_config())
+    prcss.actor = brwry
+    brwry.process = prcss
+    results = {
+        'thermistor_get_temp': bench_thermistor(),
+        'pid_update': bench_pid_update(),
+        'jammaker_calc_heater_power': bench_calc_heater_power(brwry),
+        'process_enter_stage': bench_enter_stage(),
+        'process_get_status': bench_get_status(),
+        'brewery_task': bench_brewery_task(brwry),
+    }
+    try:
+        results['rest_get_process'] = bench_rest(brwry, prcss, '/process')
+        results['rest_get_status'] = bench_rest(brwry, prcss, '/status')
+    except ImportError as e:
+        logging.warning("REST benchmarks skipped: %s", e)
+    threads, rss, brews = soak(soak_hours)
+    results['soak_thread_growth'] = threads
+    results['soak_rss_growth_kb'] = rss
+    logging.info("Soak test completed %d brews in %g simulated hours", brews, soak_hours)
+    return results
+
+def compare(results, baseline, tolerance, rss_tolerance_kb):
+    "Returns the list of regressions."
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if name == 'soak_thread_growth':
+            failed = value > max(base, 0)
+        elif name == 'soak_rss_growth_kb':
+            failed = value > base + rss_tolerance_kb
+        else:
+            failed = value > base * tolerance
+        if failed:
+            regressions.append((name, base, value))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Baseline file")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Allowed slowdown factor compared to the baseline")
+    parser.add_argument("--rss-tolerance-kb", type=int, default=2048, help="Allowed extra RSS growth during the soak test")
+    parser.add_argument("--soak-hours", type=float, default=8, help="Simulated duration of the soak test")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results = run(args.soak_hours)
+    for name, value in sorted(results.items()):
+        if name.startswith('soak_'):
+            print("%-30s %10d" % (name, value))
+        else:
+            print("%-30s %10.2f us" % (name, value * 1000000))
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Baseline saved to " + args.baseline)
+        os._exit(0)
+    if not os.path.exists(args.baseline):
+        print("No baseline found, run with --save first")
+        os._exit(0)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance, args.rss_tolerance_kb)
+    for name, base, value in regressions:
+        print("REGRESSION %s: baseline %s, now %s" % (name, base, value))
+    # The device loops run on non-daemon timers, so exit hard
+    os._exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
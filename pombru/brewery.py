@@ -1,26 +1,89 @@
 "The module representing a brewery."
 import logging
 
+import brewtrace
 import config
 import devices
+import energy
 import lowlevel
+import metrics
 import process
+import telemetry
+import topology
+import transfers
 
 class Brewery(object):
-    def __init__(self):
-        self.mashtun = devices.JamMaker(6, 27, self.mash_temp_reached, name="Mashtun")
-        self.boiler = devices.JamMaker(7, 22, self.boil_temp_reached, name="Boiler")
-        self.boiler.power_cap = 70
-        self.mashtunpump = devices.Pump(2)
-        self.temppump = devices.Pump(4)
-        self.boilerpump = devices.Pump(3)
-        self.mashtunvalve = devices.TwoWayValve(17, 18, "mashtun", "temporary")
-        self.boilervalve = devices.TwoWayValve(14, 15, "mashtun", "temporary")
+    """The devices of the rig, built from the topology of the configuration (see topology):
+    * jammakers: the heated vessels by name, mashtun and boiler are required,
+    * pumps, valves: by name, driven by the router for the routes of the process,
+    * chiller: of the boiler, None if it has no ChillerPin,
+    * hop_arms: of the boiler by arm number (1, 2, ...), released by the RELEASE_ARM tasks,
+    * energy: the EnergyMeter of the heaters, its listener is added by the service."""
+
+    def __init__(self, mashtun_adc=None, boiler_adc=None):
+        self.topology = topology.from_config()
+        adcs = {'mashtun': mashtun_adc, 'boiler': boiler_adc}
+        listeners = {'mashtun': self.mash_temp_reached, 'boiler': self.boil_temp_reached}
+        self.jammakers = {}
+        for vessel in self.topology.heated():
+            jm = devices.JamMaker(vessel.sensor_channel, vessel.heater_pin, listeners.get(vessel.name),
+                                  name=vessel.name.capitalize(), adc=adcs.get(vessel.name))
+            if vessel.power_cap is not None:
+                jm.power_cap = vessel.power_cap
+            self.jammakers[vessel.name] = jm
+        for name in ('mashtun', 'boiler'):
+            if name not in self.jammakers:
+                raise ValueError("The topology has no heated vessel named " + name)
+        self.mashtun = self.jammakers['mashtun']
+        self.boiler = self.jammakers['boiler']
+        self.pumps = dict((p.name, devices.Pump(p.pin)) for p in self.topology.pumps.values())
+        self.valves = dict((v.name, devices.TwoWayValve(v.pins[0], v.pins[1], v.outlets[0], v.outlets[1], name=v.name))
+                           for v in self.topology.valves.values())
+        self.router = topology.Router(self.topology, self.pumps, self.valves,
+                                      lambda event, param: self.task(process.BrewTask(event, param)))
+        chiller_pin = self.topology.vessels['boiler'].chiller_pin
+        boiler_pumps = self.topology.pumps_from('boiler')
+        self.chiller = devices.Chiller(chiller_pin, self.boiler, self.cooling_temp_reached, self.cooling_progress,
+                                       pump=self.pumps[boiler_pumps[0]] if boiler_pumps else None, name="Chiller") if chiller_pin else None
+        self.hop_arms = dict((arm, devices.HopArm(pin, name="hop arm " + str(arm)))
+                             for arm, pin in enumerate(self.topology.vessels['boiler'].hop_arm_pins, 1))
+        cfg = config.config.current
+        flow_meter = lowlevel.FlowMeter(cfg.transfers_flow_meter_pin, cfg.transfers_pulses_per_liter) if cfg.transfers_flow_meter_pin else None
+        self.transfers = transfers.TransferMonitor(self.jammakers, flow_meter)
+        self.energy = energy.EnergyMeter(self.jammakers)
         self.process = None
+        self._faults = {}
+        # Target of the chiller stopped by a pause
+        self._paused_cooling = None
+
+    def config_changed(self, old, new, changed):
+        "Configuration subscriber, see config.PombruConfig.subscribe()."
+        for jm in self.jammakers.values():
+            jm.config_changed(old, new, changed)
+
+    ##############################
+    # Safe state
+    ##############################
+
+    _PUMP_STARTS = frozenset([process.BrewTask.START_PUMP])
+    _ROUTE_STARTS = frozenset([process.BrewTask.SET_ROUTES, process.BrewTask.START_ROUTE])
+
+    def enter_safe_state(self, vessel, reason):
+        """Switches the heater of the vessel off and stops all pumps, each of them moves
+        liquid through or between the vessels. Heating of the vessel and starting pumps
+        by the process are refused until clear_faults()."""
+        self._faults[vessel] = reason
+        self.jammakers[vessel].fail_safe(reason)
+        self.router.halt()
 
-    def reload_config(self):
-        self.mashtun.reload_config()
-        self.boiler.reload_config()
+    def get_faults(self):
+        "Returns the latched faults by vessel."
+        return dict(self._faults)
+
+    def clear_faults(self):
+        self._faults.clear()
+        for jm in self.jammakers.values():
+            jm.clear_fault()
 
     ##############################
     # Jam maker callbacks
@@ -28,31 +91,57 @@ class Brewery(object):
 
     def mash_temp_reached(self, temp):
         logging.info("mash temperature reached: %dC", temp)
+        telemetry.hub.publish(telemetry.EVENT_TARGET_REACHED, {'vessel': 'mashtun', 'target': temp})
         self.process.mash_target_reached(temp)
 
     def boil_temp_reached(self, temp):
         logging.info("boil temperature reached: %dC", temp)
+        telemetry.hub.publish(telemetry.EVENT_TARGET_REACHED, {'vessel': 'boiler', 'target': temp})
         self.process.boil_target_reached(temp)
 
+    def cooling_temp_reached(self, temp):
+        logging.info("cooling temperature reached: %sC", temp)
+        telemetry.hub.publish(telemetry.EVENT_TARGET_REACHED, {'vessel': 'boiler', 'target': temp})
+        self.process.cooling_target_reached(temp)
+
+    def cooling_progress(self, eta):
+        self.process.cooling_progress(eta)
+
     #################################
     # Process callback
     #################################
     def task(self, task):
         "This method is called by the BrewProcess object."
         logging.info("%s", task)
-        if task.event == process.BrewTask.SET_MASH_VALVE_TARGET_MASH:
-            self.mashtunvalve.mashtun()
-        elif task.event == process.BrewTask.SET_MASH_VALVE_TARGET_TEMP:
-            self.mashtunvalve.temporary()
-        elif task.event == process.BrewTask.START_MASH_PUMP:
-            if task.param == 'MASH_DISTRIBUTION':
-                self.mashtunpump.start(config.config.mash_circulate_distribution_work, config.config.mash_circulate_distribution_idle)
-            elif task.param == 'SPARGE_DISTRIBUTION':
-                self.mashtunpump.start(config.config.sparge_circulate_distribution_work, config.config.sparge_circulate_distribution_idle)
+        telemetry.hub.publish(telemetry.EVENT_TASK, {'event': task.event, 'param': task.param})
+        with metrics.ACTUATOR_COMMAND_SECONDS.labels(event=task.event).time():
+            with brewtrace.tracer.span(task.event, brewtrace.CATEGORY_TASK, param=task.param):
+                self._execute(task)
+
+    def _execute(self, task):
+        if self._faults and (task.event in Brewery._PUMP_STARTS or task.event in Brewery._ROUTE_STARTS and task.param):
+            logging.warning("Brewery is in safe state (%s), %s is refused", self._faults, task.event)
+            return
+        if task.event == process.BrewTask.SET_ROUTES:
+            self.router.set_routes([spec for spec in (task.param or "").split(",") if spec])
+        elif task.event == process.BrewTask.START_ROUTE:
+            self.router.start(task.param)
+        elif task.event == process.BrewTask.STOP_ROUTE:
+            self.router.stop(task.param)
+        elif task.event == process.BrewTask.SET_VALVE:
+            valve, _, outlet = task.param.partition(":")
+            self.valves[valve].set_direction_name(outlet)
+        elif task.event == process.BrewTask.START_PUMP:
+            pump, _, distribution = task.param.partition(":")
+            cfg = config.config.current
+            if distribution == 'MASH_DISTRIBUTION':
+                self.pumps[pump].start(cfg.mash_circulate_distribution_work, cfg.mash_circulate_distribution_idle)
+            elif distribution == 'SPARGE_DISTRIBUTION':
+                self.pumps[pump].start(cfg.sparge_circulate_distribution_work, cfg.sparge_circulate_distribution_idle)
             else:
-                self.mashtunpump.start()
-        elif task.event == process.BrewTask.STOP_MASH_PUMP:
-            self.mashtunpump.stop()
+                self.pumps[pump].start()
+        elif task.event == process.BrewTask.STOP_PUMP:
+            self.pumps[task.param].stop()
         elif task.event == process.BrewTask.MASH_TARGET_TEMP:
             self.mashtun.set_temperature(task.param)
         elif task.event == process.BrewTask.BOIL_TARGET_TEMP:
@@ -61,24 +150,40 @@ class Brewery(object):
             self.mashtun.off()
         elif task.event == process.BrewTask.STOP_BOIL_KETTLE:
             self.boiler.off()
-        elif task.event == process.BrewTask.START_TEMP_PUMP:
-            self.temppump.start()
-        elif task.event == process.BrewTask.STOP_TEMP_PUMP:
-            self.temppump.stop()
-        elif task.event == process.BrewTask.START_BOIL_PUMP:
-            self.boilerpump.start()
-        elif task.event == process.BrewTask.STOP_BOIL_PUMP:
-            self.boilerpump.stop()
-        elif task.event == process.BrewTask.SET_BOIL_VALVE_TARGET_MASH:
-            self.boilervalve.mashtun()
-        elif task.event == process.BrewTask.SET_BOIL_VALVE_TARGET_TEMP:
-            self.boilervalve.temporary()
         elif task.event == process.BrewTask.ENGAGE_COOLING_VALVE:
-            #TODO
-            pass
+            if self.chiller is None:
+                logging.warning("The boiler has no chiller in the topology, cool the wort manually and continue")
+            else:
+                self.chiller.start(task.param)
         elif task.event == process.BrewTask.STOP_COOLING_VALVE:
-            #TODO
-            pass
+            self._paused_cooling = None
+            if self.chiller is not None:
+                self.chiller.stop()
+        elif task.event == process.BrewTask.PAUSE:
+            self.router.pause()
+            if self.chiller is not None and self.chiller.is_started():
+                self._paused_cooling = self.chiller.get_target_temperature()
+                self.chiller.stop()
+            if task.param == 'IDLE':
+                for jm in self.jammakers.values():
+                    jm.pause()
+        elif task.event == process.BrewTask.RESUME:
+            for jm in self.jammakers.values():
+                jm.resume()
+            if self._paused_cooling is not None:
+                self.chiller.start(self._paused_cooling)
+                self._paused_cooling = None
+            if self._faults:
+                logging.warning("Brewery is in safe state (%s), the paused routes are not resumed", self._faults)
+                self.router.halt()
+            else:
+                self.router.resume()
         elif task.event == process.BrewTask.RELEASE_ARM:
-            # TODO
-            pass
+            if task.param in self.hop_arms:
+                self.hop_arms[task.param].release()
+            else:
+                logging.warning("The boiler has no hop arm %s in the topology, add the hops manually", task.param)
+        elif task.event == process.BrewTask.MASH_FILL_VOLUME:
+            self.mashtun.set_fill_volume(task.param)
+        elif task.event == process.BrewTask.BOIL_FILL_VOLUME:
+            self.boiler.set_fill_volume(task.param)
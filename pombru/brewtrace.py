@@ -0,0 +1,95 @@
+"""Execution trace of a brew in the Chrome trace event format.
+
+Stages, brew tasks, valve moves, timers and lock contention are recorded as
+spans into a bounded in-memory buffer. The exported JSON can be opened in
+chrome://tracing or https://ui.perfetto.dev.
+See https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU"""
+import collections
+import os
+import threading
+import time
+
+CATEGORY_STAGE = "stage"
+CATEGORY_TASK = "task"
+CATEGORY_VALVE = "valve"
+CATEGORY_TIMER = "timer"
+CATEGORY_LOCK = "lock"
+
+# Lock waits shorter than this are not traced
+LOCK_WAIT_THRESHOLD_SECS = 0.001
+
+def _now_us():
+    return int(time.time() * 1000000)
+
+class _Span(object):
+
+    __slots__ = ('_buffer', '_name', '_category', '_args', '_start')
+
+    def __init__(self, buffer, name, category, args):
+        self._buffer = buffer
+        self._name = name
+        self._category = category
+        self._args = args
+
+    def __enter__(self):
+        self._start = _now_us()
+        return self
+
+    def __exit__(self, *_):
+        self._buffer.complete(self._name, self._category, self._start, _now_us() - self._start, self._args)
+
+class TraceBuffer(object):
+    "Bounded buffer of trace events, the oldest events are dropped when it is full."
+
+    def __init__(self, size=50000):
+        self._events = collections.deque(maxlen=size)
+        self._thread_names = {}
+        self._pid = os.getpid()
+        self.brew_id = None
+
+    def resize(self, size):
+        if size != self._events.maxlen:
+            self._events = collections.deque(self._events, maxlen=size)
+
+    def clear(self, brew_id=None):
+        "Drops all events and starts the trace of a new brew."
+        self._events.clear()
+        self.brew_id = brew_id
+
+    def _record(self, event):
+        thread = threading.current_thread()
+        tid = thread.ident
+        if tid not in self._thread_names:
+            self._thread_names[tid] = thread.name
+        event["pid"] = self._pid
+        event["tid"] = tid
+        # deque.append is atomic, no lock is needed
+        self._events.append(event)
+
+    def span(self, name, category, **args):
+        "Returns a context manager which records the block as a complete event."
+        return _Span(self, name, category, args)
+
+    def complete(self, name, category, start_us, duration_us, args=None):
+        self._record({"name": name, "cat": category, "ph": "X", "ts": start_us, "dur": duration_us, "args": args or {}})
+
+    def begin(self, name, category, span_id, **args):
+        "Begins an asynchronous span, which may end on another thread."
+        self._record({"name": name, "cat": category, "ph": "b", "id": str(span_id), "ts": _now_us(), "args": args})
+
+    def end(self, name, category, span_id, **args):
+        "Ends an asynchronous span started by begin()."
+        self._record({"name": name, "cat": category, "ph": "e", "id": str(span_id), "ts": _now_us(), "args": args})
+
+    def instant(self, name, category, **args):
+        self._record({"name": name, "cat": category, "ph": "i", "s": "p", "ts": _now_us(), "args": args})
+
+    def export(self):
+        "Returns the trace as a Chrome trace JSON object."
+        events = list(self._events)
+        metadata = [{"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": name}}
+                    for tid, name in list(self._thread_names.items())]
+        metadata.append({"name": "process_name", "ph": "M", "pid": self._pid, "args": {"name": "pombru"}})
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms", "otherData": {"brew": self.brew_id}}
+
+tracer = TraceBuffer()
@@ -1,4 +1,14 @@
+"""Configuration of Pombru, read from pombru.ini.
+
+The file is parsed into an immutable ConfigSnapshot. A reload parses and
+validates a new snapshot and swaps it in with one assignment, so readers
+always see a complete configuration. Code reading several values for one
+operation should take config.config.current once. Subscribers are called
+after every swap with the names of the changed values."""
 import configparser
+import logging
+import os
+import threading
 
 class PombruConfig:
 
@@ -28,49 +38,444 @@ class PombruConfig:
     PROPERTY_PREBOIL_MASH_TO_TEMP_PERIOD = "PreBoilMashToTempPeriod"
     PROPERTY_TRANSFER_MODE = "TransferMode"
     PROPERTY_MASH_START = "MashStart"
+    PROPERTY_PAUSE_HEATERS = "PauseHeaters"
 
     SECTION_VALVES = "valves"
     PROPERTY_VALVE_SETTLE_TIME_SECS = "SettleTimeSecs"
 
+    SECTION_AUTOTUNE = "autotune"
+    PROPERTY_STEP_POWER = "StepPower"
+    PROPERTY_MAX_STEP_SECS = "MaxStepSecs"
+    PROPERTY_MAX_TEMPERATURE = "MaxTemperature"
+    PROPERTY_VALIDATE_RISE = "ValidateRise"
+    PROPERTY_VALIDATE_SECS = "ValidateSecs"
+    PROPERTY_MAX_OVERSHOOT = "MaxOvershoot"
+    PROPERTY_GAINS_FILE = "GainsFile"
+
+    SECTION_TELEMETRY = "telemetry"
+    PROPERTY_SAMPLE_SECS = "SampleSecs"
+    PROPERTY_CLIENT_QUEUE_SIZE = "ClientQueueSize"
+    PROPERTY_KEEP_ALIVE_SECS = "KeepAliveSecs"
+
+    SECTION_SERVER = "server"
+    PROPERTY_MODE = "Mode"
+    PROPERTY_HOST = "Host"
+    PROPERTY_PORT = "Port"
+    PROPERTY_THREADS = "Threads"
+    PROPERTY_STREAM_RESERVE = "StreamReserve"
+    PROPERTY_CONNECTION_LIMIT = "ConnectionLimit"
+    PROPERTY_CHANNEL_TIMEOUT_SECS = "ChannelTimeoutSecs"
+    PROPERTY_HANDLER_TIMEOUT_SECS = "HandlerTimeoutSecs"
+    PROPERTY_HARDWARE_WORKERS = "HardwareWorkers"
+
+    SECTION_TRACE = "trace"
+    PROPERTY_BUFFER_EVENTS = "BufferEvents"
+
+    SECTION_EVENTLOG = "eventlog"
+    PROPERTY_ENABLED = "Enabled"
+    PROPERTY_DIRECTORY = "Directory"
+    PROPERTY_MAX_SEGMENT_BYTES = "MaxSegmentBytes"
+    PROPERTY_MAX_SEGMENT_SECS = "MaxSegmentSecs"
+    PROPERTY_MAX_SEGMENTS = "MaxSegments"
+    PROPERTY_QUEUE_SIZE = "QueueSize"
+
+    SECTION_LOGGING = "logging"
+    PROPERTY_LEVEL = "Level"
+    PROPERTY_FILE = "File"
+    PROPERTY_MAX_BYTES = "MaxBytes"
+    PROPERTY_BACKUP_COUNT = "BackupCount"
+
+    SECTION_HISTORY = "history"
+    PROPERTY_DATABASE = "Database"
+    PROPERTY_BATCH_SECS = "BatchSecs"
+
+    SECTION_RECIPES = "recipes"
+
+    SECTION_FLOWS = "flows"
+
+    SECTION_HEATERS = "heaters"
+    PROPERTY_MASHTUN_WATTS = "MashtunWatts"
+    PROPERTY_BOILER_WATTS = "BoilerWatts"
+
+    SECTION_PLANNER = "planner"
+    PROPERTY_AMBIENT_TEMPERATURE = "AmbientTemperature"
+    PROPERTY_HEAT_LOSS_WATTS_PER_KELVIN = "HeatLossWattsPerKelvin"
+    PROPERTY_STEP_SECS = "StepSecs"
+    PROPERTY_OPERATOR_SECS = "OperatorSecs"
+    PROPERTY_CHILLER_WATTS_PER_KELVIN = "ChillerWattsPerKelvin"
+    PROPERTY_MAX_HOURS = "MaxHours"
+    PROPERTY_CACHE_SIZE = "CacheSize"
+    PROPERTY_TIMEOUT_SECS = "TimeoutSecs"
+
+    SECTION_TRANSFERS = "transfers"
+    PROPERTY_FLOW_METER_PIN = "FlowMeterPin"
+    PROPERTY_PULSES_PER_LITER = "PulsesPerLiter"
+    PROPERTY_FLOW_STOP_SECS = "FlowStopSecs"
+    PROPERTY_UNCOVERED_CELSIUS = "UncoveredCelsius"
+    PROPERTY_UNCOVERED_SECS = "UncoveredSecs"
+    PROPERTY_RECEIVE_CELSIUS = "ReceiveCelsius"
+    PROPERTY_STABLE_CELSIUS = "StableCelsius"
+    PROPERTY_STABLE_SECS = "StableSecs"
+    PROPERTY_MIN_FRACTION = "MinFraction"
+    PROPERTY_TAIL_SECS = "TailSecs"
+    PROPERTY_MODEL_FILE = "ModelFile"
+    PROPERTY_MODEL_WEIGHT = "ModelWeight"
+
+    SECTION_COOLING = "cooling"
+    PROPERTY_RECIRCULATE = "Recirculate"
+    PROPERTY_PROPORTIONAL_BAND = "ProportionalBand"
+    PROPERTY_MIN_FLOW = "MinFlow"
+    PROPERTY_COOLANT_TEMPERATURE = "CoolantTemperature"
+    PROPERTY_CELSIUS_PER_MINUTE = "CelsiusPerMinute"
+
+    SECTION_BOIL = "boil"
+    PROPERTY_DETECT_CELSIUS = "DetectCelsius"
+    PROPERTY_PLATEAU_SECS = "PlateauSecs"
+    PROPERTY_PLATEAU_CELSIUS = "PlateauCelsius"
+    PROPERTY_HOLD_POWER = "HoldPower"
+    PROPERTY_BOIL_OVER_RATE = "BoilOverRate"
+    PROPERTY_BOIL_OVER_SECS = "BoilOverSecs"
+    PROPERTY_BOIL_OVER_CUT_SECS = "BoilOverCutSecs"
+
+    SECTION_WATCHDOG = "watchdog"
+    PROPERTY_CHECK_SECS = "CheckSecs"
+    PROPERTY_LATE_SECS = "LateSecs"
+    PROPERTY_STALE_SECS = "StaleSecs"
+    PROPERTY_MIN_TEMPERATURE = "MinTemperature"
+    PROPERTY_MAX_RATE = "MaxRate"
+    PROPERTY_NO_RISE_SECS = "NoRiseSecs"
+    PROPERTY_NO_RISE_POWER = "NoRisePower"
+    PROPERTY_NO_RISE_CELSIUS = "NoRiseCelsius"
+    PROPERTY_NO_RISE_BELOW = "NoRiseBelow"
+
+    SECTION_IDLE = "idle"
+    PROPERTY_AWAKE_SECS = "AwakeSecs"
+
+    SECTION_FERMENTATION = "fermentation"
+    PROPERTY_SENSOR_CHANNEL = "SensorChannel"
+    PROPERTY_HEATER_PIN = "HeaterPin"
+    PROPERTY_COOLER_PIN = "CoolerPin"
+    PROPERTY_BAND = "Band"
+    PROPERTY_COOLER_MIN_OFF_SECS = "CoolerMinOffSecs"
+    PROPERTY_RAW_HOURS = "RawHours"
+    PROPERTY_MINUTE_DAYS = "MinuteDays"
+    PROPERTY_TEN_MINUTE_DAYS = "TenMinuteDays"
+
+    SECTION_CONFIG = "config"
+    PROPERTY_WATCH_SECS = "WatchSecs"
+
     def __init__(self):
+        self._snapshot = None
+        self._subscribers = ()
+        self._lock = threading.Lock()
         self.reload()
 
+    @property
+    def current(self):
+        "The current ConfigSnapshot."
+        return self._snapshot
+
+    def __getattr__(self, name):
+        # Values are read from the current snapshot, e.g. config.config.pid_integral
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._snapshot, name)
+
+    def as_dict(self):
+        "Returns the raw configuration as a dictionary of sections."
+        return self._snapshot.as_dict()
+
     def reload(self):
-        self.cp = configparser.ConfigParser()
-        self.cp.read(PombruConfig.CONFIG_FILE)
-
-        # Section "pumps"
-        self.pump_seconds_per_liter_mash_to_temp = float(self.cp[PombruConfig.SECTION_PUMPS][PombruConfig.PROPERTY_SECONDS_PER_LITER_MASH_TO_TEMP])
-        self.pump_seconds_per_liter_temp_to_boil = float(self.cp[PombruConfig.SECTION_PUMPS][PombruConfig.PROPERTY_SECONDS_PER_LITER_TEMP_TO_BOIL])
-        self.pump_seconds_per_liter_boil_to_temp = float(self.cp[PombruConfig.SECTION_PUMPS][PombruConfig.PROPERTY_SECONDS_PER_LITER_BOIL_TO_TEMP])
-        self.pump_seconds_per_liter_boil_to_mash = float(self.cp[PombruConfig.SECTION_PUMPS][PombruConfig.PROPERTY_SECONDS_PER_LITER_BOIL_TO_MASH])
-        self.mash_circulate_distribution_work = int(self.cp[PombruConfig.SECTION_PUMPS][PombruConfig.PROPERTY_MASH_CIRCULATE_DISTRIBUTION_WORK])
-        self.mash_circulate_distribution_idle = int(self.cp[PombruConfig.SECTION_PUMPS][PombruConfig.PROPERTY_MASH_CIRCULATE_DISTRIBUTION_IDLE])
-        self.sparge_circulate_distribution_work = int(self.cp[PombruConfig.SECTION_PUMPS][PombruConfig.PROPERTY_SPARGE_CIRCULATE_DISTRIBUTION_WORK])
-        self.sparge_circulate_distribution_idle = int(self.cp[PombruConfig.SECTION_PUMPS][PombruConfig.PROPERTY_SPARGE_CIRCULATE_DISTRIBUTION_IDLE])
-
-        # Section "process"
-        self.sparging_temperature = int(self.cp[PombruConfig.SECTION_PROCESS][PombruConfig.PROPERTY_SPARGING_TEMPERATURE])
-        self.sparging_circulate_secs = int(self.cp[PombruConfig.SECTION_PROCESS][PombruConfig.PROPERTY_SPARGING_CIRCULATE_SECS])
-        self.sparging_delay_between_mash_to_temp_stages = int(self.cp[PombruConfig.SECTION_PROCESS][PombruConfig.PROPERTY_SPARGING_DELAY_BETWEEN_MASH_TO_TEMP_STAGES])
-        self.pause = bool(self.cp[PombruConfig.SECTION_PROCESS][PombruConfig.PROPERTY_PAUSE].lower() == 'true')
-        self.preboil_mash_to_temp_cycle = int(self.cp[PombruConfig.SECTION_PROCESS][PombruConfig.PROPERTY_PREBOIL_MASH_TO_TEMP_CYCLE])
-        self.preboil_mash_to_temp_period = int(self.cp[PombruConfig.SECTION_PROCESS][PombruConfig.PROPERTY_PREBOIL_MASH_TO_TEMP_PERIOD])
-        self.transfer_mode = self.cp[PombruConfig.SECTION_PROCESS][PombruConfig.PROPERTY_TRANSFER_MODE]
-        if self.transfer_mode not in ['AUTOMATIC', 'MANUAL']:
-            raise ValueError('process.transferMode invalid value: ' + self.transfer_mode)
-        self.mash_start = self.cp[PombruConfig.SECTION_PROCESS][PombruConfig.PROPERTY_MASH_START]
-        if self.mash_start not in ['MASHTUN', 'BOILER']:
-            raise ValueError("process.mashStart invalid value: " + self.mash_start)
-        if self.mash_start == 'MASHTUN' and self.transfer_mode == 'AUTOMATIC':
-            self.mash_start = 'BOILER'
-
-        # Section "pid"
-        self.pid_proportional = float(self.cp[PombruConfig.SECTION_PID][PombruConfig.PROPERTY_PROPORTIONAL])
-        self.pid_integral = float(self.cp[PombruConfig.SECTION_PID][PombruConfig.PROPERTY_INTEGRAL])
-        self.pid_derivative = float(self.cp[PombruConfig.SECTION_PID][PombruConfig.PROPERTY_DERIVATIVE])
-
-        # Section "valves"
-        self.valve_settle_time_secs = int(self.cp[PombruConfig.SECTION_VALVES][PombruConfig.PROPERTY_VALVE_SETTLE_TIME_SECS])
+        """Reads and validates the configuration file, then swaps it in. Raises
+        ValueError and keeps the current configuration if the file is invalid."""
+        cp = configparser.ConfigParser()
+        cp.read(PombruConfig.CONFIG_FILE)
+        self._swap(ConfigSnapshot.parse(cp))
+
+    def load_dict(self, sections):
+        "Replaces the configuration with a dictionary of sections, e.g. one returned by as_dict()."
+        self._swap(ConfigSnapshot.from_dict(sections))
+
+    def override(self, **values):
+        "Replaces some parsed values, e.g. override(valve_settle_time_secs=0)."
+        self._swap(self._snapshot.replace(**values))
+
+    def restore(self, snapshot):
+        "Swaps a snapshot read from current back in, e.g. after load_dict() for a replay."
+        self._swap(snapshot)
+
+    def subscribe(self, callback):
+        """Adds a function which is called with (old snapshot, new snapshot, set of
+        changed value names) after every change of the configuration."""
+        with self._lock:
+            self._subscribers = self._subscribers + (callback,)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not callback)
+
+    def _swap(self, snapshot):
+        with self._lock:
+            old = self._snapshot
+            self._snapshot = snapshot
+            subscribers = self._subscribers
+        if old is None:
+            return
+        changed = snapshot.changed(old)
+        if changed:
+            logging.info("Configuration changed: %s", ", ".join(sorted(changed)))
+        for callback in subscribers:
+            try:
+                callback(old, snapshot, changed)
+            except Exception:
+                logging.exception("Configuration subscriber failed")
+
+def _bool(value):
+    return value.lower() == 'true'
+
+def _choice(*choices):
+    def parse(value):
+        if value not in choices:
+            raise ValueError(value)
+        return value
+    return parse
+
+def _upper_choice(*choices):
+    def parse(value):
+        return _choice(*choices)(value.upper())
+    return parse
+
+P = PombruConfig
+# (name, section, property, type)
+_FIELDS = (
+    ('pump_seconds_per_liter_mash_to_temp', P.SECTION_PUMPS, P.PROPERTY_SECONDS_PER_LITER_MASH_TO_TEMP, float),
+    ('pump_seconds_per_liter_temp_to_boil', P.SECTION_PUMPS, P.PROPERTY_SECONDS_PER_LITER_TEMP_TO_BOIL, float),
+    ('pump_seconds_per_liter_boil_to_temp', P.SECTION_PUMPS, P.PROPERTY_SECONDS_PER_LITER_BOIL_TO_TEMP, float),
+    ('pump_seconds_per_liter_boil_to_mash', P.SECTION_PUMPS, P.PROPERTY_SECONDS_PER_LITER_BOIL_TO_MASH, float),
+    ('mash_circulate_distribution_work', P.SECTION_PUMPS, P.PROPERTY_MASH_CIRCULATE_DISTRIBUTION_WORK, int),
+    ('mash_circulate_distribution_idle', P.SECTION_PUMPS, P.PROPERTY_MASH_CIRCULATE_DISTRIBUTION_IDLE, int),
+    ('sparge_circulate_distribution_work', P.SECTION_PUMPS, P.PROPERTY_SPARGE_CIRCULATE_DISTRIBUTION_WORK, int),
+    ('sparge_circulate_distribution_idle', P.SECTION_PUMPS, P.PROPERTY_SPARGE_CIRCULATE_DISTRIBUTION_IDLE, int),
+
+    ('sparging_temperature', P.SECTION_PROCESS, P.PROPERTY_SPARGING_TEMPERATURE, int),
+    ('sparging_circulate_secs', P.SECTION_PROCESS, P.PROPERTY_SPARGING_CIRCULATE_SECS, int),
+    ('sparging_delay_between_mash_to_temp_stages', P.SECTION_PROCESS, P.PROPERTY_SPARGING_DELAY_BETWEEN_MASH_TO_TEMP_STAGES, int),
+    ('pause', P.SECTION_PROCESS, P.PROPERTY_PAUSE, _bool),
+    ('preboil_mash_to_temp_cycle', P.SECTION_PROCESS, P.PROPERTY_PREBOIL_MASH_TO_TEMP_CYCLE, int),
+    ('preboil_mash_to_temp_period', P.SECTION_PROCESS, P.PROPERTY_PREBOIL_MASH_TO_TEMP_PERIOD, int),
+    ('transfer_mode', P.SECTION_PROCESS, P.PROPERTY_TRANSFER_MODE, _choice('AUTOMATIC', 'MANUAL')),
+    ('mash_start', P.SECTION_PROCESS, P.PROPERTY_MASH_START, _choice('MASHTUN', 'BOILER')),
+    ('pause_heaters', P.SECTION_PROCESS, P.PROPERTY_PAUSE_HEATERS, _choice('HOLD', 'IDLE')),
+
+    ('pid_proportional', P.SECTION_PID, P.PROPERTY_PROPORTIONAL, float),
+    ('pid_integral', P.SECTION_PID, P.PROPERTY_INTEGRAL, float),
+    ('pid_derivative', P.SECTION_PID, P.PROPERTY_DERIVATIVE, float),
+
+    ('valve_settle_time_secs', P.SECTION_VALVES, P.PROPERTY_VALVE_SETTLE_TIME_SECS, int),
+
+    ('autotune_step_power', P.SECTION_AUTOTUNE, P.PROPERTY_STEP_POWER, int),
+    ('autotune_max_step_secs', P.SECTION_AUTOTUNE, P.PROPERTY_MAX_STEP_SECS, int),
+    ('autotune_max_temperature', P.SECTION_AUTOTUNE, P.PROPERTY_MAX_TEMPERATURE, float),
+    ('autotune_validate_rise', P.SECTION_AUTOTUNE, P.PROPERTY_VALIDATE_RISE, float),
+    ('autotune_validate_secs', P.SECTION_AUTOTUNE, P.PROPERTY_VALIDATE_SECS, int),
+    ('autotune_max_overshoot', P.SECTION_AUTOTUNE, P.PROPERTY_MAX_OVERSHOOT, float),
+    ('autotune_gains_file', P.SECTION_AUTOTUNE, P.PROPERTY_GAINS_FILE, str),
+
+    ('telemetry_sample_secs', P.SECTION_TELEMETRY, P.PROPERTY_SAMPLE_SECS, float),
+    ('telemetry_client_queue_size', P.SECTION_TELEMETRY, P.PROPERTY_CLIENT_QUEUE_SIZE, int),
+    ('telemetry_keep_alive_secs', P.SECTION_TELEMETRY, P.PROPERTY_KEEP_ALIVE_SECS, float),
+
+    ('server_mode', P.SECTION_SERVER, P.PROPERTY_MODE, _choice('development', 'waitress')),
+    ('server_host', P.SECTION_SERVER, P.PROPERTY_HOST, str),
+    ('server_port', P.SECTION_SERVER, P.PROPERTY_PORT, int),
+    ('server_threads', P.SECTION_SERVER, P.PROPERTY_THREADS, int),
+    ('server_stream_reserve', P.SECTION_SERVER, P.PROPERTY_STREAM_RESERVE, int),
+    ('server_connection_limit', P.SECTION_SERVER, P.PROPERTY_CONNECTION_LIMIT, int),
+    ('server_channel_timeout_secs', P.SECTION_SERVER, P.PROPERTY_CHANNEL_TIMEOUT_SECS, int),
+    ('server_handler_timeout_secs', P.SECTION_SERVER, P.PROPERTY_HANDLER_TIMEOUT_SECS, float),
+    ('server_hardware_workers', P.SECTION_SERVER, P.PROPERTY_HARDWARE_WORKERS, int),
+
+    ('trace_buffer_events', P.SECTION_TRACE, P.PROPERTY_BUFFER_EVENTS, int),
+
+    ('eventlog_enabled', P.SECTION_EVENTLOG, P.PROPERTY_ENABLED, _bool),
+    ('eventlog_directory', P.SECTION_EVENTLOG, P.PROPERTY_DIRECTORY, str),
+    ('eventlog_max_segment_bytes', P.SECTION_EVENTLOG, P.PROPERTY_MAX_SEGMENT_BYTES, int),
+    ('eventlog_max_segment_secs', P.SECTION_EVENTLOG, P.PROPERTY_MAX_SEGMENT_SECS, int),
+    ('eventlog_max_segments', P.SECTION_EVENTLOG, P.PROPERTY_MAX_SEGMENTS, int),
+    ('eventlog_queue_size', P.SECTION_EVENTLOG, P.PROPERTY_QUEUE_SIZE, int),
+
+    ('logging_level', P.SECTION_LOGGING, P.PROPERTY_LEVEL, _upper_choice('DEBUG', 'INFO', 'WARNING', 'ERROR')),
+    ('logging_file', P.SECTION_LOGGING, P.PROPERTY_FILE, str),
+    ('logging_max_bytes', P.SECTION_LOGGING, P.PROPERTY_MAX_BYTES, int),
+    ('logging_backup_count', P.SECTION_LOGGING, P.PROPERTY_BACKUP_COUNT, int),
+
+    ('history_enabled', P.SECTION_HISTORY, P.PROPERTY_ENABLED, _bool),
+    ('history_database', P.SECTION_HISTORY, P.PROPERTY_DATABASE, str),
+    ('history_batch_secs', P.SECTION_HISTORY, P.PROPERTY_BATCH_SECS, float),
+    ('history_sample_secs', P.SECTION_HISTORY, P.PROPERTY_SAMPLE_SECS, float),
+    ('history_queue_size', P.SECTION_HISTORY, P.PROPERTY_QUEUE_SIZE, int),
+
+    ('recipes_directory', P.SECTION_RECIPES, P.PROPERTY_DIRECTORY, str),
+
+    ('flows_directory', P.SECTION_FLOWS, P.PROPERTY_DIRECTORY, str),
+
+    ('heater_mashtun_watts', P.SECTION_HEATERS, P.PROPERTY_MASHTUN_WATTS, float),
+    ('heater_boiler_watts', P.SECTION_HEATERS, P.PROPERTY_BOILER_WATTS, float),
+
+    ('planner_ambient_temperature', P.SECTION_PLANNER, P.PROPERTY_AMBIENT_TEMPERATURE, float),
+    ('planner_heat_loss_watts_per_kelvin', P.SECTION_PLANNER, P.PROPERTY_HEAT_LOSS_WATTS_PER_KELVIN, float),
+    ('planner_step_secs', P.SECTION_PLANNER, P.PROPERTY_STEP_SECS, float),
+    ('planner_operator_secs', P.SECTION_PLANNER, P.PROPERTY_OPERATOR_SECS, float),
+    ('planner_chiller_watts_per_kelvin', P.SECTION_PLANNER, P.PROPERTY_CHILLER_WATTS_PER_KELVIN, float),
+    ('planner_max_hours', P.SECTION_PLANNER, P.PROPERTY_MAX_HOURS, float),
+    ('planner_cache_size', P.SECTION_PLANNER, P.PROPERTY_CACHE_SIZE, int),
+    ('planner_timeout_secs', P.SECTION_PLANNER, P.PROPERTY_TIMEOUT_SECS, float),
+
+    ('transfers_flow_meter_pin', P.SECTION_TRANSFERS, P.PROPERTY_FLOW_METER_PIN, int),
+    ('transfers_pulses_per_liter', P.SECTION_TRANSFERS, P.PROPERTY_PULSES_PER_LITER, float),
+    ('transfers_flow_stop_secs', P.SECTION_TRANSFERS, P.PROPERTY_FLOW_STOP_SECS, float),
+    ('transfers_uncovered_celsius', P.SECTION_TRANSFERS, P.PROPERTY_UNCOVERED_CELSIUS, float),
+    ('transfers_uncovered_secs', P.SECTION_TRANSFERS, P.PROPERTY_UNCOVERED_SECS, float),
+    ('transfers_receive_celsius', P.SECTION_TRANSFERS, P.PROPERTY_RECEIVE_CELSIUS, float),
+    ('transfers_stable_celsius', P.SECTION_TRANSFERS, P.PROPERTY_STABLE_CELSIUS, float),
+    ('transfers_stable_secs', P.SECTION_TRANSFERS, P.PROPERTY_STABLE_SECS, float),
+    ('transfers_min_fraction', P.SECTION_TRANSFERS, P.PROPERTY_MIN_FRACTION, float),
+    ('transfers_tail_secs', P.SECTION_TRANSFERS, P.PROPERTY_TAIL_SECS, float),
+    ('transfers_model_file', P.SECTION_TRANSFERS, P.PROPERTY_MODEL_FILE, str),
+    ('transfers_model_weight', P.SECTION_TRANSFERS, P.PROPERTY_MODEL_WEIGHT, float),
+
+    ('cooling_enabled', P.SECTION_COOLING, P.PROPERTY_ENABLED, _bool),
+    ('cooling_recirculate', P.SECTION_COOLING, P.PROPERTY_RECIRCULATE, _bool),
+    ('cooling_proportional_band', P.SECTION_COOLING, P.PROPERTY_PROPORTIONAL_BAND, float),
+    ('cooling_min_flow', P.SECTION_COOLING, P.PROPERTY_MIN_FLOW, float),
+    ('cooling_coolant_temperature', P.SECTION_COOLING, P.PROPERTY_COOLANT_TEMPERATURE, float),
+    ('cooling_celsius_per_minute', P.SECTION_COOLING, P.PROPERTY_CELSIUS_PER_MINUTE, float),
+
+    ('boil_detect_celsius', P.SECTION_BOIL, P.PROPERTY_DETECT_CELSIUS, float),
+    ('boil_plateau_secs', P.SECTION_BOIL, P.PROPERTY_PLATEAU_SECS, float),
+    ('boil_plateau_celsius', P.SECTION_BOIL, P.PROPERTY_PLATEAU_CELSIUS, float),
+    ('boil_hold_power', P.SECTION_BOIL, P.PROPERTY_HOLD_POWER, float),
+    ('boil_over_rate', P.SECTION_BOIL, P.PROPERTY_BOIL_OVER_RATE, float),
+    ('boil_over_secs', P.SECTION_BOIL, P.PROPERTY_BOIL_OVER_SECS, float),
+    ('boil_over_cut_secs', P.SECTION_BOIL, P.PROPERTY_BOIL_OVER_CUT_SECS, float),
+
+    ('watchdog_enabled', P.SECTION_WATCHDOG, P.PROPERTY_ENABLED, _bool),
+    ('watchdog_check_secs', P.SECTION_WATCHDOG, P.PROPERTY_CHECK_SECS, float),
+    ('watchdog_late_secs', P.SECTION_WATCHDOG, P.PROPERTY_LATE_SECS, float),
+    ('watchdog_stale_secs', P.SECTION_WATCHDOG, P.PROPERTY_STALE_SECS, float),
+    ('watchdog_min_temperature', P.SECTION_WATCHDOG, P.PROPERTY_MIN_TEMPERATURE, float),
+    ('watchdog_max_temperature', P.SECTION_WATCHDOG, P.PROPERTY_MAX_TEMPERATURE, float),
+    ('watchdog_max_rate', P.SECTION_WATCHDOG, P.PROPERTY_MAX_RATE, float),
+    ('watchdog_no_rise_secs', P.SECTION_WATCHDOG, P.PROPERTY_NO_RISE_SECS, float),
+    ('watchdog_no_rise_power', P.SECTION_WATCHDOG, P.PROPERTY_NO_RISE_POWER, float),
+    ('watchdog_no_rise_celsius', P.SECTION_WATCHDOG, P.PROPERTY_NO_RISE_CELSIUS, float),
+    ('watchdog_no_rise_below', P.SECTION_WATCHDOG, P.PROPERTY_NO_RISE_BELOW, float),
+
+    ('idle_sample_secs', P.SECTION_IDLE, P.PROPERTY_SAMPLE_SECS, float),
+    ('idle_awake_secs', P.SECTION_IDLE, P.PROPERTY_AWAKE_SECS, float),
+
+    ('fermentation_sensor_channel', P.SECTION_FERMENTATION, P.PROPERTY_SENSOR_CHANNEL, int),
+    ('fermentation_heater_pin', P.SECTION_FERMENTATION, P.PROPERTY_HEATER_PIN, int),
+    ('fermentation_cooler_pin', P.SECTION_FERMENTATION, P.PROPERTY_COOLER_PIN, int),
+    ('fermentation_sample_secs', P.SECTION_FERMENTATION, P.PROPERTY_SAMPLE_SECS, float),
+    ('fermentation_band', P.SECTION_FERMENTATION, P.PROPERTY_BAND, float),
+    ('fermentation_cooler_min_off_secs', P.SECTION_FERMENTATION, P.PROPERTY_COOLER_MIN_OFF_SECS, float),
+    ('fermentation_directory', P.SECTION_FERMENTATION, P.PROPERTY_DIRECTORY, str),
+    ('fermentation_raw_hours', P.SECTION_FERMENTATION, P.PROPERTY_RAW_HOURS, float),
+    ('fermentation_minute_days', P.SECTION_FERMENTATION, P.PROPERTY_MINUTE_DAYS, float),
+    ('fermentation_ten_minute_days', P.SECTION_FERMENTATION, P.PROPERTY_TEN_MINUTE_DAYS, float),
+
+    ('config_watch_secs', P.SECTION_CONFIG, P.PROPERTY_WATCH_SECS, float),
+)
+del P
+
+class ConfigSnapshot(object):
+    """Immutable, validated configuration. The values are the attributes named in _FIELDS,
+    cp is the parser the snapshot was made of (must not be modified)."""
+
+    __slots__ = ('cp',) + tuple(f[0] for f in _FIELDS)
+
+    def __init__(self, cp, values):
+        object.__setattr__(self, 'cp', cp)
+        for name, _, _, _ in _FIELDS:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ConfigSnapshot is immutable")
+
+    @staticmethod
+    def parse(cp):
+        "Parses and validates the configuration. Raises ValueError for missing or invalid values."
+        values = {}
+        for name, section, prop, parse in _FIELDS:
+            try:
+                raw = cp[section][prop]
+            except KeyError:
+                raise ValueError("Missing configuration value: " + section + "." + prop)
+            try:
+                values[name] = parse(raw)
+            except ValueError:
+                raise ValueError(section + "." + prop + " invalid value: " + raw)
+        if values['mash_start'] == 'MASHTUN' and values['transfer_mode'] == 'AUTOMATIC':
+            values['mash_start'] = 'BOILER'
+        return ConfigSnapshot(cp, values)
+
+    @staticmethod
+    def from_dict(sections):
+        "Parses a dictionary of sections, e.g. one returned by as_dict()."
+        cp = configparser.ConfigParser()
+        cp.read_dict(sections)
+        return ConfigSnapshot.parse(cp)
+
+    def replace(self, **values):
+        "Returns a copy of the snapshot with some values replaced."
+        current = dict((name, getattr(self, name)) for name, _, _, _ in _FIELDS)
+        for name in values:
+            if name not in current:
+                raise AttributeError("Unknown configuration value: " + name)
+        current.update(values)
+        return ConfigSnapshot(self.cp, current)
+
+    def changed(self, other):
+        "Returns the set of value names which differ from the other snapshot."
+        return set(name for name, _, _, _ in _FIELDS if getattr(self, name) != getattr(other, name))
+
+    def as_dict(self):
+        return dict((sec, dict(self.cp.items(sec))) for sec in self.cp.sections())
+
+class ConfigWatcher(object):
+    "Reloads the configuration whenever the modification time of the file changes."
+
+    def __init__(self, cfg, interval):
+        self._config = cfg
+        self._interval = interval
+        self._mtime = self._get_mtime()
+        self._stopped = threading.Event()
+
+    def _get_mtime(self):
+        try:
+            return os.stat(PombruConfig.CONFIG_FILE).st_mtime
+        except OSError:
+            return None
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="config watcher")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            mtime = self._get_mtime()
+            if mtime is None or mtime == self._mtime:
+                continue
+            self._mtime = mtime
+            try:
+                self._config.reload()
+                logging.info("Configuration reloaded from %s", PombruConfig.CONFIG_FILE)
+            except ValueError as e:
+                logging.error("Invalid configuration, keeping the previous one: %s", e)
 
 config = PombruConfig()
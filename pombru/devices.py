@@ -1,11 +1,16 @@
 "Represents Pombru devices: Pumps, Valves and JamMakers."
 
+import collections
 import logging
+import math
 import threading
-import time
+import brewtrace
 import config
+import metrics
+import utils
 from lowlevel import Relay, Thermistor
 from pid.PID import PID
+from pid.autotune import Autotuner, get_gain_store
 
 class TwoWayValve(object):
     """Class represents a valve which can flow liquid in two directions.
@@ -18,12 +23,14 @@ class TwoWayValve(object):
 
     _DEFAULT_SETTLE_TIME = 2
 
-    def __init__(self, direction_1_pin, direction_2_pin, direction_1_name=None, direction_2_name=None):
+    def __init__(self, direction_1_pin, direction_2_pin, direction_1_name=None, direction_2_name=None, name=None):
         self._relay_1 = Relay(direction_1_pin)
         self._relay_2 = Relay(direction_2_pin)
         self._direction_1_name = direction_1_name
         self._direction_2_name = direction_2_name
         self._direction = None
+        self._name = name
+        self._settle_seconds = metrics.VALVE_SETTLE_SECONDS.labels(valve=name)
 
     def get_direction_name(self):
         return self._direction
@@ -38,16 +45,18 @@ class TwoWayValve(object):
 
     def direction_1(self):
         "Moves the valve to direction 1. This method blocks while waiting for the valve to settle."
-        self._relay_1.off()
-        self._relay_2.off()
-        time.sleep(config.config.valve_settle_time_secs)
+        with self._settle_seconds.time(), brewtrace.tracer.span(str(self._name) + " -> " + str(self._direction_1_name), brewtrace.CATEGORY_VALVE):
+            self._relay_1.off()
+            self._relay_2.off()
+            utils.clock.sleep(config.config.current.valve_settle_time_secs)
         self._direction = self._direction_1_name
 
     def direction_2(self):
         "Moves the valve to direction 2. This method blocks while waiting for the valve to settle."
-        self._relay_1.on()
-        self._relay_2.on()
-        time.sleep(config.config.valve_settle_time_secs)
+        with self._settle_seconds.time(), brewtrace.tracer.span(str(self._name) + " -> " + str(self._direction_2_name), brewtrace.CATEGORY_VALVE):
+            self._relay_1.on()
+            self._relay_2.on()
+            utils.clock.sleep(config.config.current.valve_settle_time_secs)
         self._direction = self._direction_2_name
 
     def __getattr__(self, attr):
@@ -65,6 +74,8 @@ class Heater(object):
 
     This heater is backed by a Relay. The heater can be set a power in 10 percentages.
     E.g. when the heater is told to work 30% then it is on for 3 seconds every 10 seconds.
+    At 0% the cycle stops once the relay is off, setting a power starts it again.
+    The time the relay was on is summed up for the energy accounting, see energy.
     """
 
     def __init__(self, pin, initial_power=0, name=None):
@@ -76,20 +87,27 @@ class Heater(object):
         self.__timer = None
         self.__lock = threading.RLock()
         self.__name = name
+        self.__due = None
+        self.__on_seconds = 0.0
+        self.__integrated_at = utils.clock.time()
+        self.__lateness = metrics.TICK_LATENESS_SECONDS.labels(loop=str(name) + " heater")
 
     def start(self):
         "Starts the heater."
         with self.__lock:
             if self.__timer is not None:
                 return
-            self.__timer = threading.Timer(1, self.__timeout)
+            self.__due = utils.clock.time() + 1
+            self.__timer = utils.clock.timer(1, self.__timeout)
             self.__timer.start()
 
     def stop(self):
         "Stops the heater."
         with self.__lock:
             self.__power = 0
-            self.__timer.cancel()
+            if self.__timer is not None:
+                self.__timer.cancel()
+            self.__integrate()
             self.__relay.off()
             self.__timer = None
 
@@ -99,6 +117,8 @@ class Heater(object):
         Argument must be between 0 and 100 (inclusive)."""
         with self.__lock:
             self.__power = round(power / 10.0)
+            if self.__power > 0:
+                self.start()
 
     def get_power(self):
         return self.__power * 10
@@ -108,40 +128,141 @@ class Heater(object):
         with self.__lock:
             return self.__relay.get_value()
 
+    def force_off(self):
+        "Switches the relay off at once, without waiting for the cycle, and sets the power to 0."
+        with self.__lock:
+            self.__power = 0
+            self.__integrate()
+            self.__relay.off()
+
+    def get_on_seconds(self):
+        "Returns how many seconds the relay has been on since the heater was created."
+        with self.__lock:
+            self.__integrate()
+            return self.__on_seconds
+
+    def __integrate(self):
+        "Adds the time since the last call to the on time if the relay is on. The lock must be held."
+        now = utils.clock.time()
+        if self.__relay.get_value():
+            self.__on_seconds += now - self.__integrated_at
+        self.__integrated_at = now
+
+    def get_due(self):
+        "Returns when the next cycle of the heater is due, None if the heater is stopped."
+        return self.__due if self.__timer is not None else None
+
     def __timeout(self):
         #logging.debug("heater timeout. cycle: " + str(self.__cycle) + ", power: " + str(self.__power))
+        self.__lateness.observe(utils.clock.time() - self.__due)
         self.__cycle += 1
         if self.__cycle == 11:
             self.__cycle = 1
         with self.__lock:
             if self.__timer is None:
                 return
-            if self.__cycle <= self.__power:
-                if not self.is_panel_on():
-                    logging.debug("Heater '" + str(self.__name) + "' relay ON")
-                self.__relay.on()
-            else:
-                if self.is_panel_on():
-                    logging.debug("Heater '" + str(self.__name) + "' relay OFF")
-                self.__relay.off()
-            self.__timer = threading.Timer(1, self.__timeout)
-            self.__timer.start()
+            idle = False
+            try:
+                self.__integrate()
+                if self.__cycle <= self.__power:
+                    if not self.is_panel_on():
+                        logging.debug("Heater '%s' relay ON", self.__name)
+                    self.__relay.on()
+                else:
+                    if self.is_panel_on():
+                        logging.debug("Heater '%s' relay OFF", self.__name)
+                    self.__relay.off()
+                    idle = self.__power == 0
+            except Exception:
+                logging.exception("Heater '%s' cycle failed", self.__name)
+            finally:
+                # The cycle must go on while the relay may be on, otherwise it stays where it is
+                if idle:
+                    self.__timer = None
+                else:
+                    self.__due = utils.clock.time() + 1
+                    self.__timer = utils.clock.timer(1, self.__timeout)
+                    self.__timer.start()
+
+class BoilDetector(object):
+    """Heater power for a boil target, see [boil]: full power until the boil is detected by
+    the temperature plateau, then HoldPower. Above DetectCelsius a steep rise (foam on
+    the probe) switches the heater off for BoilOverCutSecs."""
+
+    def __init__(self):
+        self._samples = collections.deque()
+        self._boiling_since = None
+        self._cut_until = None
+        self._boil_overs = 0
+
+    def tick(self, now, temp, cfg):
+        """Takes a temperature sample. Returns the heater power and True at the sample
+        the boil is detected."""
+        samples = self._samples
+        samples.append((now, temp))
+        while now - samples[0][0] > max(cfg.boil_plateau_secs, cfg.boil_over_secs):
+            samples.popleft()
+        near = temp >= cfg.boil_detect_celsius
+        reached = False
+        if self._boiling_since is None:
+            slope = self._slope(now, cfg.boil_plateau_secs)
+            if temp >= 100 or near and slope is not None and slope * cfg.boil_plateau_secs < cfg.boil_plateau_celsius:
+                logging.info("Boil detected at %.1fC", temp)
+                self._boiling_since = now
+                reached = True
+        if self._cut_until is not None and now < self._cut_until:
+            return 0, reached
+        self._cut_until = None
+        if near and cfg.boil_over_rate > 0:
+            slope = self._slope(now, cfg.boil_over_secs)
+            if slope is not None and slope * 60 > cfg.boil_over_rate:
+                logging.warning("Boil-over: the wort heats at %.1fC/min at %.1fC, heater off for %s s",
+                                slope * 60, temp, cfg.boil_over_cut_secs)
+                self._boil_overs += 1
+                self._cut_until = now + cfg.boil_over_cut_secs
+                # The rise before the cut must not trip it again
+                samples.clear()
+                return 0, reached
+        if self._boiling_since is not None and near:
+            return cfg.boil_hold_power, reached
+        return 100, reached
+
+    def _slope(self, now, secs):
+        "Least squares slope of the samples of the last secs seconds in Celsius per second, None if they span less."
+        window = [(t, temp) for t, temp in self._samples if now - t <= secs]
+        if len(window) < 2 or window[-1][0] - window[0][0] < secs - JamMaker.TICK_SECS:
+            return None
+        mean_t = sum(t for t, _ in window) / len(window)
+        mean_temp = sum(temp for _, temp in window) / len(window)
+        var = sum((t - mean_t) ** 2 for t, _ in window)
+        return sum((t - mean_t) * (temp - mean_temp) for t, temp in window) / var
+
+    def get_status(self):
+        return {'boiling_since': self._boiling_since, 'boil_overs': self._boil_overs,
+                'cut': self._cut_until is not None}
 
 class JamMaker(object):
     """Represents a controller jam maker.
     * thermistor_channel: The channel number on the MCP3208 A/D converter which reads the temperature
     * heater_panel_gpio_pin: The RPi GPIO PIN number to which the heater panel's relay is wired
     * listener: a function to call when the preset temperature is reached it is passed the set temperature
-    * thermistor_spi_args: SPI GPIO PIN settings for the MCP3208"""
+    * adc: optional replacement of the MCP3208 channel, see Thermistor
+    * thermistor_spi_args: SPI GPIO PIN settings for the MCP3208
+    The control loop ticks every second. While the heater is off and no one reads the
+    temperature (see wake()), it only samples every [idle] SampleSecs seconds."""
     MODE_MANUAL_ON = 'on'
     MODE_MANUAL_OFF = 'off'
     MODE_CONTROLLED = 'controlled'
+    MODE_AUTOTUNE = 'autotune'
+    MODE_PAUSED = 'paused'
 
     _STATUS_HEATING = 1
     _STATUS_HOLDING = 2
 
-    def __init__(self, thermistor_channel, heater_panel_gpio_pin, listener=None, lock=None, name=None, **thermistor_spi_args):
-        self._thermistor = Thermistor(thermistor_channel, sample_count=5, sample_delay=0.1, spi_args=thermistor_spi_args)
+    TICK_SECS = 1
+
+    def __init__(self, thermistor_channel, heater_panel_gpio_pin, listener=None, lock=None, name=None, adc=None, **thermistor_spi_args):
+        self._thermistor = Thermistor(thermistor_channel, sample_count=5, sample_delay=0.1, spi_args=thermistor_spi_args, adc=adc)
         self._heater = Heater(heater_panel_gpio_pin, name=name)
         self._mode = JamMaker.MODE_MANUAL_OFF
         self._listener = listener
@@ -150,17 +271,92 @@ class JamMaker(object):
         self._heater.start()
         self._timer = None
         self._lock = lock
+        self._name = name
+        self._fill_volume = None
+        self._autotuner = None
+        self._boil = None
+        self._last_sample = None
+        self._due = None
+        self._busy_since = None
+        self._fault = None
+        self._loop_lock = threading.RLock()
+        self._awake_until = 0
+        self._sample_secs = JamMaker.TICK_SECS
+        self._interval = None
+        self._wake_listeners = []
+        self._lateness = metrics.TICK_LATENESS_SECONDS.labels(loop=str(name))
+        self._pid = None
         self.reload_config()
         self._set_timer()
         self.power_cap = 100
 
+    _PID_CONFIG = frozenset(['pid_proportional', 'pid_integral', 'pid_derivative', 'autotune_gains_file'])
+
     def reload_config(self):
-        self._pid = PID(config.config.pid_proportional, config.config.pid_integral, config.config.pid_derivative)
+        """Sets up the PID controller. Gains measured by autotune for this vessel
+        and the nearest fill volume are preferred over the [pid] section.
+        An existing controller keeps its state, only the gains are changed."""
+        cfg = config.config.current
+        gains = get_gain_store(cfg.autotune_gains_file).get(self._name, self._fill_volume)
+        if gains is None:
+            gains = (cfg.pid_proportional, cfg.pid_integral, cfg.pid_derivative)
+        logging.debug("PID gains of '%s' at %s liters: %s", self._name, self._fill_volume, gains)
+        if self._pid is None:
+            self._pid = PID(*gains, time_func=utils.now)
+            self._pid.SetPoint = self._target_temperature
+        else:
+            self._pid.setKp(gains[0])
+            self._pid.setKi(gains[1])
+            self._pid.setKd(gains[2])
+
+    def config_changed(self, old, new, changed):
+        "Configuration subscriber: the gains are reapplied only if the PID settings changed."
+        if changed & JamMaker._PID_CONFIG:
+            self.reload_config()
+
+    def set_fill_volume(self, liters):
+        "Sets the amount of liquid in the vessel, and selects the PID gains for it."
+        if liters == self._fill_volume:
+            return
+        self._fill_volume = liters
+        self.reload_config()
+
+    def autotune(self, liters=None):
+        """Starts an autotune run: a step-response experiment and a closed-loop validation.
+
+        When finished, the gains are stored for this vessel and fill volume and the
+        heater is switched off."""
+        if self._refused("autotune"):
+            return
+        if liters is not None:
+            self._fill_volume = liters
+        self._autotuner = Autotuner(config.config.autotune_step_power, config.config.autotune_max_step_secs,
+                config.config.autotune_max_temperature, config.config.autotune_validate_rise,
+                config.config.autotune_validate_secs, config.config.autotune_max_overshoot)
+        self._mode = JamMaker.MODE_AUTOTUNE
+        self._heater.set_power(self._autotuner.step_power)
+        self._wake_loop()
+
+    def get_autotune_status(self):
+        "Returns the status of the last autotune run or None."
+        if self._autotuner is None:
+            return None
+        return self._autotuner.get_status()
+
+    def get_boil_status(self):
+        "Returns the status of the boil detection while the target is a boil, otherwise None."
+        boil = self._boil
+        if boil is None:
+            return None
+        return boil.get_status()
 
     def on(self):
         "Switch on the heater."
+        if self._refused("manual heating"):
+            return
         self._mode = JamMaker.MODE_MANUAL_ON
         self._heater.set_power(100)
+        self._wake_loop()
 
     def off(self):
         "Switch off the heater."
@@ -174,8 +370,72 @@ class JamMaker(object):
         """
         self._target_temperature = target_temp
         self._status = JamMaker._STATUS_HEATING
-        self._mode = JamMaker.MODE_CONTROLLED
+        self._boil = BoilDetector() if target_temp >= 100 else None
         self._pid.SetPoint = target_temp
+        if self._refused("heating to " + str(target_temp)):
+            return
+        self._mode = JamMaker.MODE_CONTROLLED
+        self._wake_loop()
+
+    def pause(self):
+        """Switches the heater off while the brewing is paused. The target temperature
+        and whether it has been reached are kept for resume()."""
+        if self._mode != JamMaker.MODE_CONTROLLED:
+            return
+        self._mode = JamMaker.MODE_PAUSED
+        self._heater.set_power(0)
+
+    def resume(self):
+        "Controls to the target temperature again after pause(). A reached target is not reported again."
+        if self._mode != JamMaker.MODE_PAUSED or self._refused("resuming"):
+            return
+        self._mode = JamMaker.MODE_CONTROLLED
+        self._wake_loop()
+
+    def wake(self):
+        """Tells that someone reads the temperature: the control loop samples every second
+        for [idle] AwakeSecs. An idle loop ticks at once."""
+        self._awake_until = utils.clock.time() + config.config.current.idle_awake_secs
+        self._wake_loop()
+
+    def add_wake_listener(self, listener):
+        "Adds a function called when the control loop leaves the idle sampling rate."
+        self._wake_listeners.append(listener)
+
+    def is_idle(self):
+        "True if the control loop samples at the idle rate."
+        return self._tick_secs() > JamMaker.TICK_SECS
+
+    def get_sample_secs(self):
+        "Returns in how many seconds the sample after the last one is due."
+        return self._sample_secs
+
+    def fail_safe(self, reason):
+        """Switches the heater off at once and latches a fault: heating is refused
+        until clear_fault() is called."""
+        self._fault = reason
+        self._mode = JamMaker.MODE_MANUAL_OFF
+        self._heater.force_off()
+
+    def get_fault(self):
+        "Returns the reason of the latched fault, or None."
+        return self._fault
+
+    def clear_fault(self):
+        "Clears the latched fault. The heater stays off until it is switched on again."
+        self._fault = None
+
+    def _refused(self, what):
+        if self._fault is None:
+            return False
+        logging.warning("Jam maker '%s' is in fail safe state (%s), %s is refused", self._name, self._fault, what)
+        return True
+
+    def get_deadlines(self):
+        """Returns when the control loop and the heater loop must tick at the latest,
+        None for a stopped loop. A control tick in progress is due since it started."""
+        busy = self._busy_since
+        return (busy if busy is not None else self._due), self._heater.get_due()
 
     def get_mode(self):
         "Return the current mode operation of the jam maker."
@@ -185,35 +445,90 @@ class JamMaker(object):
         "Returns the jam maker's inside temperature in Celsius."
         if self._lock:
             with self._lock:
-                return self._thermistor.get_temp()
+                temp = self._thermistor.get_temp()
         else:
-            return self._thermistor.get_temp()
+            temp = self._thermistor.get_temp()
+        self._last_sample = (temp, utils.clock.time())
+        return temp
+
+    def get_last_sample(self, read=True):
+        """Returns the last temperature read by the control loop as a (temperature, timestamp) tuple
+        without touching the sensor. The sensor is read only if there is no sample yet,
+        with read=False None is returned then."""
+        sample = self._last_sample
+        if sample is None and read:
+            self.get_temperature()
+            sample = self._last_sample
+        return sample
+
+    def get_power(self):
+        "Returns the current heater power in percent."
+        return self._heater.get_power()
+
+    def get_heating_seconds(self):
+        "Returns how many seconds the heating panel has been on, see Heater.get_on_seconds()."
+        return self._heater.get_on_seconds()
 
     def get_target_temperature(self):
         return self._target_temperature
 
     def _timeout(self):
         #logging.debug("heater::timetout mode: " + str(self._mode))
-        self._set_timer()
-        if self._mode != JamMaker.MODE_CONTROLLED:
-            return
-        self._calc_heater_power()
+        self._lateness.observe(utils.clock.time() - self._due)
+        self._busy_since = utils.clock.time()
+        secs = self._set_timer()
+        try:
+            curr_temp = self.get_temperature()
+            self._sample_secs = secs
+            if curr_temp != curr_temp:
+                # Open or shorted probe: there is nothing to control by
+                if self._mode != JamMaker.MODE_MANUAL_OFF:
+                    self._heater.set_power(0)
+                return
+            if self._mode == JamMaker.MODE_AUTOTUNE:
+                self._autotune_tick(curr_temp)
+                return
+            if self._mode != JamMaker.MODE_CONTROLLED:
+                return
+            self._calc_heater_power(curr_temp)
+        except Exception:
+            logging.exception("Control tick of '%s' failed, heater power set to 0", self._name)
+            self._heater.set_power(0)
+        finally:
+            self._busy_since = None
+            # The heater may have been switched on during the tick
+            self._wake_loop()
+
+    def _autotune_tick(self, curr_temp):
+        tuner = self._autotuner
+        power = tuner.update(utils.clock.time(), curr_temp)
+        if tuner.state == Autotuner.STATE_DONE:
+            if self._fill_volume is not None:
+                get_gain_store(config.config.autotune_gains_file).put(self._name, self._fill_volume, tuner.gains)
+            else:
+                logging.warning("Autotune of '%s' finished without fill volume, gains are not stored", self._name)
+            self.reload_config()
+            self.off()
+        elif tuner.state == Autotuner.STATE_FAILED:
+            self.off()
+        else:
+            self._heater.set_power(power)
 
-    def _calc_heater_power(self):
-        curr_temp = self.get_temperature()
+    def _calc_heater_power(self, curr_temp):
         #logging.debug("heater::calc_heater_power curr_temp: " + str(curr_temp) + ", status: " + str(self._status) + ", target: " + str(self._target_temperature))
         if self._target_temperature >= 100:
-            # Boiling
-            self._heater.set_power(100)
-            if self._status == JamMaker._STATUS_HEATING and curr_temp >= 100:
+            # Boiling, see BoilDetector
+            power, reached = self._boil.tick(utils.clock.time(), curr_temp, config.config.current)
+            self._heater.set_power(power)
+            if self._status == JamMaker._STATUS_HEATING and reached:
                 self._status = JamMaker._STATUS_HOLDING
-                self._listener(self._target_temperature)
+                self._target_reached()
             return
         else:
             temp_reached = (curr_temp >= self._target_temperature + 0.5) or (self._target_temperature == 100 and curr_temp >= 97)
             if self._status == JamMaker._STATUS_HEATING and temp_reached:
                 self._status = JamMaker._STATUS_HOLDING
-                self._listener(self._target_temperature)
+                self._target_reached()
 
             self._pid.update(round(curr_temp))
             power = self._pid.output
@@ -222,10 +537,201 @@ class JamMaker(object):
             if (self._target_temperature < 100): power = min(power, self.power_cap)
             self._heater.set_power(power)
 
+    def _target_reached(self):
+        """Calls the listener on a timer of its own: it may move valves for seconds,
+        the control tick must not wait for it or the watchdog finds the loop stalled."""
+        if self._listener is None:
+            return
+        timer = utils.clock.timer(0, self._notify_listener, (self._target_temperature,))
+        timer.daemon = True
+        timer.start()
+
+    def _notify_listener(self, target):
+        # A failing listener must not stop the temperature control
+        try:
+            self._listener(target)
+        except Exception:
+            logging.exception("Target temperature listener of '%s' failed", self._name)
+
+    def _tick_secs(self):
+        if self._mode != JamMaker.MODE_MANUAL_OFF or utils.clock.time() < self._awake_until:
+            return JamMaker.TICK_SECS
+        return config.config.current.idle_sample_secs
+
+    def _set_timer(self, secs=None):
+        "Schedules the next tick, by default in _tick_secs(). Returns the seconds."
+        with self._loop_lock:
+            if secs is None:
+                secs = self._tick_secs()
+            self._interval = secs
+            self._due = utils.clock.time() + secs
+            self._timer = utils.clock.timer(secs, self._timeout)
+            self._timer.start()
+            return secs
+
+    def _wake_loop(self):
+        "Lets an idle control loop tick at once if it must not be idle any more."
+        with self._loop_lock:
+            if self._busy_since is not None or self._interval <= self._tick_secs():
+                return
+            self._timer.cancel()
+            self._set_timer(0)
+        for listener in self._wake_listeners:
+            listener()
+
+class Chiller(object):
+    """Cools the wort in the vessel of a jam maker to a target temperature.
+
+    The coolant flows through the chiller while the valve relay is on. The flow is
+    modulated like the power of a heater, in 10 second cycles: full flow down to
+    [cooling] ProportionalBand above the target, then proportionally less, at least
+    MinFlow percent. Near the target the coolant leaves the chiller cold, so less of it
+    carries off the same heat and the target is not undershot.
+    * valve_pin: the RPi GPIO PIN number of the coolant valve's relay
+    * jammaker: the jam maker of the vessel, its control loop samples the temperature
+    * listener: called with the target temperature when it is reached
+    * progress: called with the estimated seconds to the target every cycle
+    * pump: recirculates the wort while cooling if [cooling] Recirculate is set"""
+
+    _ETA_WINDOW_SECS = 60
+
+    def __init__(self, valve_pin, jammaker, listener=None, progress=None, pump=None, name=None):
+        self._valve = Relay(valve_pin)
+        self._valve.off()
+        self._jammaker = jammaker
+        self._listener = listener
+        self._progress = progress
+        self._pump = pump
+        self._name = name
+        self._lock = threading.RLock()
+        self._timer = None
+        self._due = None
+        self._target = None
+        self._flow = 0
+        self._cycle = 0
+        self._eta = None
+        self._samples = collections.deque()
+        self._lateness = metrics.TICK_LATENESS_SECONDS.labels(loop=str(name))
+
+    def start(self, target):
+        "Starts cooling to the target temperature."
+        with self._lock:
+            self._target = target
+            self._eta = None
+            self._samples.clear()
+            if self._pump is not None and config.config.current.cooling_recirculate:
+                self._pump.start()
+            if self._timer is None:
+                self._cycle = 0
+                self._set_timer()
+
+    def stop(self):
+        "Closes the valve and stops the recirculation."
+        with self._lock:
+            self._target = None
+            self._flow = 0
+            self._eta = None
+            self._valve.off()
+            if self._pump is not None:
+                self._pump.stop()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def is_started(self):
+        return self._target is not None
+
+    def is_valve_open(self):
+        return self._valve.get_value()
+
+    def get_target_temperature(self):
+        return self._target
+
+    def get_flow(self):
+        "Returns the coolant flow of the current cycle in percent."
+        return self._flow
+
+    def get_eta(self):
+        "Returns the estimated seconds to the target, None while unknown."
+        return self._eta
+
     def _set_timer(self):
-        self._timer = threading.Timer(1, self._timeout)
+        self._due = utils.clock.time() + 1
+        self._timer = utils.clock.timer(1, self._timeout)
         self._timer.start()
 
+    def _timeout(self):
+        with self._lock:
+            if self._timer is None:
+                return
+            self._lateness.observe(utils.clock.time() - self._due)
+            self._set_timer()
+            try:
+                reached = self._tick()
+            except Exception:
+                logging.exception("Cooling tick of '%s' failed", self._name)
+                return
+        try:
+            if reached is not None and self._listener is not None:
+                self._listener(reached)
+            elif self._cycle == 1 and self._progress is not None and self._eta is not None:
+                self._progress(self._eta)
+        except Exception:
+            logging.exception("Cooling listener of '%s' failed", self._name)
+
+    def _tick(self):
+        "Switches the valve for this second. Returns the target if it is reached."
+        self._jammaker.wake()
+        sample = self._jammaker.get_last_sample(read=False)
+        if sample is None or sample[0] != sample[0]:
+            # No valid reading: the valve is left as it is
+            return None
+        temp, at = sample
+        target = self._target
+        if temp <= target:
+            logging.info("Cooling of '%s' reached %.1fC", self._name, temp)
+            self.stop()
+            return target
+        cfg = config.config.current
+        if not self._samples or at > self._samples[-1][0]:
+            self._samples.append((at, temp, self._flow))
+            while at - self._samples[0][0] > Chiller._ETA_WINDOW_SECS:
+                self._samples.popleft()
+        self._cycle = self._cycle % 10 + 1
+        if self._cycle == 1:
+            self._flow = Chiller._flow_for(temp, target, cfg)
+            self._eta = self._estimate(temp, target, cfg)
+        if self._cycle * 10 <= self._flow:
+            self._valve.on()
+        else:
+            self._valve.off()
+        return None
+
+    @staticmethod
+    def _flow_for(temp, target, cfg):
+        flow = 100.0 * (temp - target) / cfg.cooling_proportional_band
+        return int(round(min(100, max(cfg.cooling_min_flow, flow)) / 10.0)) * 10
+
+    def _estimate(self, temp, target, cfg):
+        """Estimates the seconds to the target. The cooling constant at full flow is fitted
+        to the samples of the last minute by Newton's law of cooling toward the coolant,
+        then the cool-down is integrated with the flow the chiller is going to use.
+        If the target is not above the coolant, the last minute is extrapolated."""
+        first_at, first_temp, _ = self._samples[0]
+        elapsed = self._samples[-1][0] - first_at
+        flow = sum(s[2] for s in self._samples) / (100.0 * len(self._samples))
+        if elapsed < 10 or first_temp <= temp or flow <= 0:
+            return None
+        coolant = cfg.cooling_coolant_temperature
+        if target <= coolant + 0.5:
+            return (temp - target) * elapsed / (first_temp - temp)
+        constant = math.log((first_temp - coolant) / (temp - coolant)) / elapsed / flow
+        secs = 0
+        while temp > target and secs < 86400:
+            temp -= constant * Chiller._flow_for(temp, target, cfg) / 100.0 * (temp - coolant) * 10
+            secs += 10
+        return secs
+
 class Pump(object):
     """
     Class represents a pump.
@@ -262,7 +768,7 @@ class Pump(object):
                 raise ValueError('work_sec must be positive!')
             self._relay.on()
             if idle_sec > 0:
-                self._timer = threading.Timer(work_sec, self._idle)
+                self._timer = utils.clock.timer(work_sec, self._idle)
                 self._timer.start()
             else:
                 self._timer = None
@@ -284,7 +790,7 @@ class Pump(object):
             self._relay.off()
             if self._state == Pump.STOPPED:
                 return
-            self._timer = threading.Timer(self._idle_sec, self._work)
+            self._timer = utils.clock.timer(self._idle_sec, self._work)
             self._timer.start()
             
     def _work(self):
@@ -292,5 +798,24 @@ class Pump(object):
             if self._state == Pump.STOPPED:
                 return
             self._relay.on()
-            self._timer = threading.Timer(self._work_sec, self._idle)
-            self._timer.start()
\ No newline at end of file
+            self._timer = utils.clock.timer(self._work_sec, self._idle)
+            self._timer.start()
+
+class HopArm(object):
+    """
+    Class represents the arm holding a hop addition over the boiler.
+
+    The arm is released by a pulse of its relay.
+    """
+
+    def __init__(self, pin, pulse_sec=1, name=None):
+        self.pulse_sec = pulse_sec
+        self.name = name
+        self._relay = Relay(pin)
+        self._relay.off()
+
+    def release(self):
+        "Pulses the relay, the hops fall into the boiler."
+        logging.info("Releasing %s", self.name)
+        self._relay.on()
+        utils.clock.timer(self.pulse_sec, self._relay.off).start()
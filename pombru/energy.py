@@ -0,0 +1,119 @@
+"""Energy accounting of the heating panels.
+
+The heaters sum up the time their relay is on (devices.Heater.get_on_seconds()),
+with the panel power of [heaters] this is the energy used by the vessel. The
+EnergyMeter attributes it to the stages of the running brew, listener() is meant
+to be added to the telemetry hub. Only the vessels with a configured panel power
+(mashtun and boiler) are metered.
+
+The totals by vessel are exported as the pombru_heater_energy_kwh_total metric,
+the temperature events carry them, so the brew history records the energy of the
+stages and heat-ups (see history.BrewHistory.stage_stats()).
+"""
+import threading
+
+import config
+import metrics
+import telemetry
+
+# Energy to heat a liter of water by a Kelvin in kWh (4186 J)
+WATER_KWH_PER_LITER_KELVIN = 4186.0 / 3.6e6
+
+def panel_watts(cfg, vessel):
+    "Returns the configured power of the heating panel of a vessel in watts, None if it is not known."
+    return {'mashtun': cfg.heater_mashtun_watts, 'boiler': cfg.heater_boiler_watts}.get(vessel)
+
+def _subtract(a, b):
+    return dict((vessel, kwh - b.get(vessel, 0.0)) for vessel, kwh in a.items())
+
+def _add(a, b):
+    return dict((vessel, a.get(vessel, 0.0) + kwh) for vessel, kwh in b.items())
+
+class EnergyMeter(object):
+    """Energy used by the heaters of the jam makers in kWh, in total and by the stages
+    of the current (or last) brew. Stages run more than once (continue_with) are summed up."""
+
+    def __init__(self, jammakers):
+        self._jammakers = jammakers
+        self._lock = threading.Lock()
+        self._brew_start = None
+        self._brew_end = None
+        self._stage = None
+        self._stage_start = None
+        self._stages = []
+
+    def kwh(self):
+        """Returns the energy used by each metered vessel since the start of the service,
+        with the current panel power of the configuration."""
+        cfg = config.config.current
+        ret = {}
+        for name, jm in self._jammakers.items():
+            watts = panel_watts(cfg, name)
+            if watts is not None:
+                ret[name] = jm.get_heating_seconds() * watts / 3.6e6
+        return ret
+
+    def listener(self, event):
+        "Telemetry listener following the brew and its stages."
+        if event.kind == telemetry.EVENT_BREW:
+            with self._lock:
+                if event.data['action'] == 'start':
+                    self._brew_start = self.kwh()
+                    self._brew_end = None
+                    self._stage = None
+                    self._stages = []
+                elif self._brew_start is not None:
+                    self._close(self.kwh())
+        elif event.kind == telemetry.EVENT_STATUS and self._brew_start is not None and self._brew_end is None:
+            status = event.data['status']
+            with self._lock:
+                if status == 'stopped':
+                    self._close(self.kwh())
+                elif event.data['current_stage'] != self._stage:
+                    now = self.kwh()
+                    self._close_stage(now)
+                    self._stage = event.data['current_stage']
+                    self._stage_start = now
+
+    def _close_stage(self, now):
+        if self._stage is None:
+            return
+        used = _subtract(now, self._stage_start)
+        for entry in self._stages:
+            if entry[0] == self._stage:
+                entry[1] = _add(entry[1], used)
+                break
+        else:
+            self._stages.append([self._stage, used])
+        self._stage = None
+
+    def _close(self, now):
+        self._close_stage(now)
+        self._brew_end = now
+
+    def get_status(self):
+        """Returns the totals by vessel, and the energy of the current or last brew by vessel
+        and by stage, the running stage included."""
+        now = self.kwh()
+        ret = {'kwh': now, 'brew': None}
+        with self._lock:
+            if self._brew_start is None:
+                return ret
+            stages = [(name, dict(used)) for name, used in self._stages]
+            if self._stage is not None:
+                used = _subtract(now, self._stage_start)
+                for entry in stages:
+                    if entry[0] == self._stage:
+                        entry[1].update(_add(entry[1], used))
+                        break
+                else:
+                    stages.append((self._stage, used))
+            end = self._brew_end if self._brew_end is not None else now
+            ret['brew'] = {'running': self._brew_end is None, 'kwh': _subtract(end, self._brew_start),
+                           'stages': [dict(used, stage=name) for name, used in stages]}
+        return ret
+
+    def register_metrics(self):
+        "Exports the totals by vessel."
+        metrics.register(metrics.Counter("pombru_heater_energy_kwh_total", "Energy used by the heating panels.",
+                                         self.kwh, label='vessel'))
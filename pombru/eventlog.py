@@ -0,0 +1,287 @@
+"""Compact binary log of the telemetry events.
+
+The events of the telemetry hub are queued and written by a background thread
+as struct-packed records into segment files. Segments are rotated by size and
+age, closed segments are gzip compressed and the oldest ones are deleted.
+
+Segment layout: the MAGIC header, then records. Every record starts with a
+type byte and a timestamp (double), followed by the fixed fields of the type.
+Strings which repeat (vessel, stage and task names) are written once per
+segment as a STRING record and referenced by id, so every segment can be
+decoded on its own.
+
+Decoding:
+    python eventlog.py pombru-20240101-120000.evl.gz [--kind temperature]
+"""
+import argparse
+import glob
+import gzip
+import json
+import logging
+import math
+import os
+import queue
+import shutil
+import struct
+import sys
+import threading
+import time
+
+import telemetry
+
+MAGIC = b"PEVL\x01"
+
+TYPE_STRING = 0
+TYPE_TEMPERATURE = 1
+TYPE_STATUS = 2
+TYPE_TASK = 3
+TYPE_NOTIFICATION = 4
+TYPE_GENERIC = 5
+
+_HEADER = struct.Struct("<Bd")
+_STRING = struct.Struct("<HH")
+_TEMPERATURE = struct.Struct("<Hfff")
+_STATUS = struct.Struct("<IHHii")
+_TASK = struct.Struct("<HHd")
+_LENGTH = struct.Struct("<H")
+_GENERIC = struct.Struct("<HH")
+
+_KIND_NAMES = {TYPE_TEMPERATURE: telemetry.EVENT_TEMPERATURE, TYPE_STATUS: telemetry.EVENT_STATUS,
+               TYPE_TASK: telemetry.EVENT_TASK, TYPE_NOTIFICATION: telemetry.EVENT_NOTIFICATION}
+
+def _float(value):
+    return float('nan') if value is None else float(value)
+
+def _text(value, limit=65535):
+    # Cut on a character boundary, the reader decodes the text
+    return value.encode('utf-8')[:limit].decode('utf-8', 'ignore').encode('utf-8')
+
+class Encoder(object):
+    "Encodes telemetry events into records. Keeps the string table of a segment."
+
+    # The ids are 16 bit, an event adds a few strings at most
+    MAX_STRINGS = 65535 - 256
+
+    def __init__(self):
+        self._strings = {}
+
+    def is_full(self):
+        "True if the segment should be closed before the string ids run out."
+        return len(self._strings) >= Encoder.MAX_STRINGS
+
+    def _string_id(self, value, out):
+        value = str(value)
+        sid = self._strings.get(value)
+        if sid is None:
+            sid = len(self._strings) + 1
+            self._strings[value] = sid
+            raw = _text(value)
+            out.append(_HEADER.pack(TYPE_STRING, 0) + _STRING.pack(sid, len(raw)) + raw)
+        return sid
+
+    def encode(self, event):
+        "Returns the list of records (bytes) for the event."
+        size = len(self._strings)
+        try:
+            return self._encode(event)
+        except Exception:
+            # The records of the new strings are dropped with the event
+            for value in list(self._strings)[size:]:
+                del self._strings[value]
+            raise
+
+    def _encode(self, event):
+        out = []
+        data = event.data
+        ts = event.timestamp
+        if event.kind == telemetry.EVENT_TEMPERATURE:
+            for vessel, sample in sorted(data.items()):
+                vid = self._string_id(vessel, out)
+                out.append(_HEADER.pack(TYPE_TEMPERATURE, ts) + _TEMPERATURE.pack(
+                    vid, _float(sample.get('current')), _float(sample.get('target')), _float(sample.get('power'))))
+        elif event.kind == telemetry.EVENT_STATUS:
+            status_id = self._string_id(data['status'], out)
+            stage_id = self._string_id(data['current_stage'], out)
+            out.append(_HEADER.pack(TYPE_STATUS, ts) + _STATUS.pack(
+                data['version'], status_id, stage_id, int(data['stage_remaining']), int(data['process_remaining'])))
+        elif event.kind == telemetry.EVENT_TASK:
+            event_id = self._string_id(data['event'], out)
+            param = data.get('param')
+            if isinstance(param, (int, float)):
+                param_id, number = 0, float(param)
+            elif param is None:
+                param_id, number = 0, float('nan')
+            else:
+                param_id, number = self._string_id(param, out), float('nan')
+            out.append(_HEADER.pack(TYPE_TASK, ts) + _TASK.pack(event_id, param_id, number))
+        elif event.kind == telemetry.EVENT_NOTIFICATION:
+            raw = _text(data['message'])
+            out.append(_HEADER.pack(TYPE_NOTIFICATION, ts) + _LENGTH.pack(len(raw)) + raw)
+        else:
+            kind_id = self._string_id(event.kind, out)
+            raw = _text(json.dumps(data))
+            out.append(_HEADER.pack(TYPE_GENERIC, ts) + _GENERIC.pack(kind_id, len(raw)) + raw)
+        return out
+
+def decode(stream):
+    "Reads a segment from a binary stream and yields the records as dictionaries."
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a pombru event log segment")
+    strings = {0: None}
+    def read(size):
+        buf = stream.read(size)
+        if len(buf) < size:
+            raise EOFError()
+        return buf
+    try:
+        while True:
+            rtype, ts = _HEADER.unpack(read(_HEADER.size))
+            if rtype == TYPE_STRING:
+                sid, length = _STRING.unpack(read(_STRING.size))
+                strings[sid] = read(length).decode('utf-8')
+                continue
+            rec = {'kind': _KIND_NAMES.get(rtype), 'timestamp': ts}
+            if rtype == TYPE_TEMPERATURE:
+                vid, current, target, power = _TEMPERATURE.unpack(read(_TEMPERATURE.size))
+                rec.update({'vessel': strings[vid], 'current': current, 'target': target, 'power': power})
+            elif rtype == TYPE_STATUS:
+                version, status_id, stage_id, stage_remaining, process_remaining = _STATUS.unpack(read(_STATUS.size))
+                rec.update({'version': version, 'status': strings[status_id], 'current_stage': strings[stage_id],
+                            'stage_remaining': stage_remaining, 'process_remaining': process_remaining})
+            elif rtype == TYPE_TASK:
+                event_id, param_id, number = _TASK.unpack(read(_TASK.size))
+                rec.update({'event': strings[event_id], 'param': strings[param_id] if param_id else (None if math.isnan(number) else number)})
+            elif rtype == TYPE_NOTIFICATION:
+                length, = _LENGTH.unpack(read(_LENGTH.size))
+                rec['message'] = read(length).decode('utf-8')
+            elif rtype == TYPE_GENERIC:
+                kind_id, length = _GENERIC.unpack(read(_GENERIC.size))
+                rec['kind'] = strings[kind_id]
+                rec['data'] = json.loads(read(length).decode('utf-8'))
+            else:
+                raise ValueError("Unknown record type: %d" % rtype)
+            yield rec
+    except EOFError:
+        # A segment may end with a partially written record
+        return
+
+def open_segment(filename):
+    "Opens a segment file for reading, compressed or not."
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+class EventLog(object):
+    """Writes the telemetry events into rotating segment files on a background thread.
+
+    listener() is meant to be added to the telemetry hub: it only queues the event,
+    when the queue is full the event is dropped."""
+
+    SUFFIX = ".evl"
+
+    def __init__(self, directory, max_segment_bytes, max_segment_secs, max_segments, queue_size=10000, flush_secs=5):
+        self._directory = directory
+        self._max_segment_bytes = max_segment_bytes
+        self._max_segment_secs = max_segment_secs
+        self._max_segments = max_segments
+        self._flush_secs = flush_secs
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._file = None
+        self._filename = None
+        self._encoder = None
+        self._segment_started = None
+        self._segment_bytes = 0
+        self.dropped = 0
+
+    def listener(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        self._thread = threading.Thread(target=self._run, name="eventlog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        "Writes the queued events, then closes and compresses the current segment."
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        last_flush = time.time()
+        while True:
+            try:
+                event = self._queue.get(timeout=self._flush_secs)
+            except queue.Empty:
+                event = False
+            if event is None:
+                break
+            try:
+                if event:
+                    self._write(event)
+                now = time.time()
+                if self._file is not None and now - last_flush >= self._flush_secs:
+                    self._file.flush()
+                    last_flush = now
+                if self._file is not None and (self._segment_bytes >= self._max_segment_bytes or
+                                               now - self._segment_started >= self._max_segment_secs):
+                    self._close_segment()
+            except Exception:
+                # Only this event is lost, the writer goes on
+                logging.exception("Error while writing the event log")
+        if self._file is not None:
+            self._close_segment()
+
+    def _write(self, event):
+        if self._file is not None and self._encoder.is_full():
+            self._close_segment()
+        if self._file is None:
+            self._open_segment()
+        for record in self._encoder.encode(event):
+            self._file.write(record)
+            self._segment_bytes += len(record)
+
+    def _open_segment(self):
+        self._segment_started = time.time()
+        base = os.path.join(self._directory, "pombru-" + time.strftime("%Y%m%d-%H%M%S", time.localtime(self._segment_started)))
+        self._filename = base + EventLog.SUFFIX
+        counter = 0
+        while os.path.exists(self._filename) or os.path.exists(self._filename + ".gz"):
+            counter += 1
+            # Sorts after the base name, the rotation keeps the last segments by name
+            self._filename = "%s_%03d%s" % (base, counter, EventLog.SUFFIX)
+        self._file = open(self._filename, "wb")
+        self._file.write(MAGIC)
+        self._segment_bytes = len(MAGIC)
+        self._encoder = Encoder()
+
+    def _close_segment(self):
+        self._file.close()
+        self._file = None
+        with open(self._filename, "rb") as src, gzip.open(self._filename + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(self._filename)
+        segments = sorted(glob.glob(os.path.join(self._directory, "pombru-*" + EventLog.SUFFIX + ".gz")))
+        for old in segments[:max(0, len(segments) - self._max_segments)]:
+            os.remove(old)
+        if self.dropped:
+            logging.warning("Event log dropped %d events", self.dropped)
+
+def main():
+    parser = argparse.ArgumentParser(description="Decodes pombru event log segments into JSON lines.")
+    parser.add_argument("files", nargs="+", help="Segment files (.evl or .evl.gz)")
+    parser.add_argument("--kind", required=False, help="Print only this kind of records, e.g. temperature")
+    args = parser.parse_args()
+    for filename in args.files:
+        with open_segment(filename) as stream:
+            for rec in decode(stream):
+                if args.kind is None or rec['kind'] == args.kind:
+                    sys.stdout.write(json.dumps(rec) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+"""Fermentation monitoring between brew days.
+
+The Fermenter samples its thermistor every [fermentation] SampleSecs seconds and holds
+the fermenter at the target temperature with a heater pad (driven by a Heater like
+the panels of the jam makers) and a cooling relay, both optional: without a target
+the temperature is only recorded. The state is kept in the Directory, a running
+fermentation is continued after a restart of the service.
+
+The samples of a probe are stored in three tiers, files of a fixed size mapped
+into memory, so memory, disk and CPU use do not grow with the length of the
+fermentation:
+- <probe>.raw.pfs: every sample, for at least RawHours,
+- <probe>.1m.pfs: the means of the minutes, for at least MinuteDays,
+- <probe>.10m.pfs: the means of the ten minutes, for at least TenMinuteDays.
+
+File layout: the file header, then blocks of BLOCK_SIZE bytes. A block starts with a
+header of its sequence number (0: unused), the time (seconds) and the temperature
+(centi-Celsius) of its first sample and the bytes used, followed by the other
+samples as varint deltas to the previous one. When all the blocks are used the
+oldest one is overwritten.
+
+Decoding:
+    python fermentation.py fermentation/fermenter.raw.pfs [--since 1700000000]
+"""
+import argparse
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+
+import config
+import devices
+import lowlevel
+import metrics
+import utils
+
+MAGIC = b"PFSL\x01"
+BLOCK_SIZE = 4096
+PROBE = "fermenter"
+STATE_FILE = "fermentation.json"
+
+_FILE_HEADER = struct.Struct("<5sxHI")
+_BLOCK_HEADER = struct.Struct("<QqiH")
+# Bytes of a record assumed when sizing a tier: two varints of 14 bits, i.e. samples
+# less than 4.5 hours apart changing by less than 80 Celsius
+_RECORD_BYTES = 4
+
+# Names of the tiers, also the suffixes of their files
+TIER_RAW = "raw"
+TIER_MINUTE = "1m"
+TIER_TEN_MINUTES = "10m"
+
+def _varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+def _zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -(value >> 1) - 1
+
+def _read_varint(buf, pos):
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def tier_blocks(seconds, interval, block_size=BLOCK_SIZE):
+    """Returns how many blocks keep the samples of interval seconds for at least
+    seconds: one more for the block being filled and one for the oldest, which is
+    overwritten next."""
+    records = int(math.ceil(seconds / float(interval)))
+    per_block = (block_size - _BLOCK_HEADER.size) // _RECORD_BYTES
+    return int(math.ceil(records / float(per_block))) + 2
+
+class RingFile(object):
+    """A tier of samples: a file of delta encoded blocks mapped into memory, see the
+    module documentation. Samples are (seconds, centi-Celsius) integer pairs, only
+    samples later than the last one are appended. Not thread safe."""
+
+    def __init__(self, filename, blocks, block_size=BLOCK_SIZE):
+        self.filename = filename
+        self._blocks = blocks
+        self._block_size = block_size
+        size = _FILE_HEADER.size + blocks * block_size
+        old = None
+        if os.path.exists(filename):
+            header = None
+            with open(filename, "rb") as f:
+                header = f.read(_FILE_HEADER.size)
+            if len(header) != _FILE_HEADER.size or _FILE_HEADER.unpack(header) != (MAGIC, block_size, blocks):
+                # The tier was resized in the configuration, the samples are copied
+                old = filename + ".old"
+                os.rename(filename, old)
+        if not os.path.exists(filename):
+            with open(filename, "wb") as f:
+                f.write(_FILE_HEADER.pack(MAGIC, block_size, blocks))
+                f.truncate(size)
+        with open(filename, "r+b") as f:
+            self._map = mmap.mmap(f.fileno(), size)
+        self._block = None
+        self._sequence = 0
+        self._used = 0
+        self._last = None
+        self._find_last()
+        if old is not None:
+            logging.info("Copying the samples of %s into the resized tier", filename)
+            try:
+                source = RingFile.open_existing(old)
+                for ts, value in source.read():
+                    self.append(ts, value)
+                source.close()
+            except (IOError, OSError, ValueError):
+                logging.exception("Samples of %s could not be copied", old)
+            os.remove(old)
+
+    @staticmethod
+    def open_existing(filename):
+        "Opens a tier with the geometry stored in its header. Raises ValueError if it is not a tier file."
+        with open(filename, "rb") as f:
+            header = f.read(_FILE_HEADER.size)
+        if len(header) != _FILE_HEADER.size or _FILE_HEADER.unpack(header)[0] != MAGIC:
+            raise ValueError("Not a sample file: " + filename)
+        _, block_size, blocks = _FILE_HEADER.unpack(header)
+        return RingFile(filename, blocks, block_size)
+
+    def _offset(self, block):
+        return _FILE_HEADER.size + block * self._block_size
+
+    def _header(self, block):
+        return _BLOCK_HEADER.unpack_from(self._map, self._offset(block))
+
+    def _find_last(self):
+        newest = None
+        for block in range(self._blocks):
+            sequence = self._header(block)[0]
+            if sequence and (newest is None or sequence > self._sequence):
+                newest = block
+                self._sequence = sequence
+        if newest is None:
+            return
+        self._block = newest
+        self._used = self._header(newest)[3]
+        for sample in self._decode(newest):
+            self._last = sample
+
+    def _decode(self, block):
+        sequence, ts, value, used = self._header(block)
+        if not sequence:
+            return
+        yield ts, value
+        pos = self._offset(block) + _BLOCK_HEADER.size
+        end = pos + used
+        buf = self._map
+        while pos < end:
+            delta, pos = _read_varint(buf, pos)
+            change, pos = _read_varint(buf, pos)
+            ts += delta
+            value += _unzigzag(change)
+            yield ts, value
+
+    def append(self, ts, value):
+        "Appends a sample. Returns False if it is not later than the last one."
+        if self._last is not None and ts <= self._last[0]:
+            return False
+        if self._block is not None:
+            record = _varint(ts - self._last[0]) + _varint(_zigzag(value - self._last[1]))
+            if _BLOCK_HEADER.size + self._used + len(record) <= self._block_size:
+                start = self._offset(self._block) + _BLOCK_HEADER.size + self._used
+                self._map[start:start + len(record)] = bytes(record)
+                self._used += len(record)
+                # The header is updated after the record, a torn write loses the record only
+                struct.pack_into("<H", self._map, self._offset(self._block) + _BLOCK_HEADER.size - 2, self._used)
+                self._last = (ts, value)
+                return True
+            self._map.flush()
+        # The first sample of a block is in its header
+        self._block = 0 if self._block is None else (self._block + 1) % self._blocks
+        self._sequence += 1
+        self._used = 0
+        _BLOCK_HEADER.pack_into(self._map, self._offset(self._block), self._sequence, ts, value, 0)
+        self._last = (ts, value)
+        return True
+
+    def read(self, since=None, until=None):
+        "Yields the samples from since until until (both inclusive, None: no limit), oldest first."
+        blocks = sorted((self._header(b)[0], b) for b in range(self._blocks) if self._header(b)[0])
+        for index, (_, block) in enumerate(blocks):
+            if since is not None and index + 1 < len(blocks) and self._header(blocks[index + 1][1])[1] <= since:
+                # The next block starts before since: all of this one is older
+                continue
+            if until is not None and self._header(block)[1] > until:
+                break
+            for ts, value in self._decode(block):
+                if since is not None and ts < since:
+                    continue
+                if until is not None and ts > until:
+                    break
+                yield ts, value
+
+    def first(self):
+        "Returns the time of the oldest sample, None if there is none."
+        starts = [(self._header(b)[0], self._header(b)[1]) for b in range(self._blocks) if self._header(b)[0]]
+        return min(starts)[1] if starts else None
+
+    def last(self):
+        "Returns the last sample, None if there is none."
+        return self._last
+
+    def size(self):
+        return len(self._map)
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+
+class _Mean(object):
+    "Mean of the samples in buckets of secs seconds."
+
+    def __init__(self, secs):
+        self._secs = secs
+        self._bucket = None
+        self._sum = 0
+        self._count = 0
+
+    def add(self, ts, value):
+        """Adds a sample. Returns the (bucket start, mean) of the previous bucket when the
+        sample is in a new bucket, otherwise None."""
+        bucket = ts - ts % self._secs
+        ret = None
+        if bucket != self._bucket:
+            ret = self.take()
+            self._bucket = bucket
+        self._sum += value
+        self._count += 1
+        return ret
+
+    def take(self):
+        "Returns the (bucket start, mean) of the current bucket and empties it, None if it is empty."
+        if not self._count:
+            return None
+        ret = (self._bucket, int(round(self._sum / float(self._count))))
+        self._sum = self._count = 0
+        return ret
+
+class ProbeLog(object):
+    """The samples of a probe in the three tiers, see the module documentation.
+    Not thread safe."""
+
+    def __init__(self, directory, probe, sample_secs, raw_hours, minute_days, ten_minute_days):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        base = os.path.join(directory, probe)
+        self._tiers = [
+            (TIER_RAW, RingFile(base + "." + TIER_RAW + ".pfs", tier_blocks(raw_hours * 3600, sample_secs)), None),
+            (TIER_MINUTE, RingFile(base + "." + TIER_MINUTE + ".pfs", tier_blocks(minute_days * 86400, 60)), _Mean(60)),
+            (TIER_TEN_MINUTES, RingFile(base + "." + TIER_TEN_MINUTES + ".pfs", tier_blocks(ten_minute_days * 86400, 600)), _Mean(600)),
+        ]
+
+    def append(self, ts, temperature):
+        "Stores a temperature sample taken at ts (seconds)."
+        ts = int(ts)
+        value = int(round(temperature * 100))
+        for _, ring, mean in self._tiers:
+            sample = (ts, value) if mean is None else mean.add(ts, value)
+            if sample is not None:
+                ring.append(*sample)
+
+    def flush(self):
+        "Stores the means of the current buckets, and writes the files."
+        for _, ring, mean in self._tiers:
+            sample = mean.take() if mean is not None else None
+            if sample is not None:
+                ring.append(*sample)
+            ring.flush()
+
+    def samples(self, since=None, until=None):
+        """Returns the (seconds, Celsius) samples from since until until, of the finest
+        tier which has them: older ones are the means of the minutes or ten minutes."""
+        ret = []
+        end = until
+        for _, ring, _ in self._tiers:
+            first = ring.first()
+            if first is None:
+                continue
+            ret = [(ts, value / 100.0) for ts, value in ring.read(since, end)] + ret
+            end = first - 1 if end is None else min(end, first - 1)
+            if since is not None and end < since:
+                break
+        return ret
+
+    def get_status(self):
+        return dict((name, {'first': ring.first(), 'last': ring.last(), 'bytes': ring.size()}) for name, ring, _ in self._tiers)
+
+    def close(self):
+        self.flush()
+        for _, ring, _ in self._tiers:
+            ring.close()
+
+class Fermenter(object):
+    """Records the temperature of the fermenter and holds it at the target: the heater
+    pad is on from [fermentation] Band below the target until the target, the cooler
+    from Band above it until the target, after resting for CoolerMinOffSecs.
+    * adc: optional replacement of the MCP3208 channel, see lowlevel.Thermistor"""
+
+    def __init__(self, adc=None):
+        cfg = config.config.current
+        self._directory = cfg.fermentation_directory
+        self._thermistor = lowlevel.Thermistor(cfg.fermentation_sensor_channel, adc=adc)
+        self._heater = devices.Heater(cfg.fermentation_heater_pin, name="Fermenter") if cfg.fermentation_heater_pin else None
+        self._cooler = lowlevel.Relay(cfg.fermentation_cooler_pin) if cfg.fermentation_cooler_pin else None
+        if self._cooler is not None:
+            self._cooler.off()
+        self._lock = threading.RLock()
+        self._log = None
+        self._timer = None
+        self._due = None
+        self._target = None
+        self._started_at = None
+        self._last_sample = None
+        self._heating = False
+        self._cooling = False
+        self._cooler_off_at = None
+        self._lateness = metrics.TICK_LATENESS_SECONDS.labels(loop="Fermenter")
+        state = self._load_state()
+        if state.get('running'):
+            logging.info("Continuing the fermentation started at %s", state.get('started_at'))
+            self.start(state.get('target'), state.get('started_at'))
+
+    def _load_state(self):
+        try:
+            with open(os.path.join(self._directory, STATE_FILE)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        try:
+            with open(os.path.join(self._directory, STATE_FILE), "w") as f:
+                json.dump({'running': self._timer is not None, 'target': self._target, 'started_at': self._started_at}, f)
+        except (IOError, OSError):
+            logging.exception("The fermentation state could not be saved")
+
+    def _open_log(self):
+        if self._log is None:
+            cfg = config.config.current
+            self._log = ProbeLog(self._directory, PROBE, cfg.fermentation_sample_secs, cfg.fermentation_raw_hours,
+                                 cfg.fermentation_minute_days, cfg.fermentation_ten_minute_days)
+        return self._log
+
+    def start(self, target=None, started_at=None):
+        """Starts recording, and holding the target temperature if it is not None.
+        A running fermentation only gets the new target."""
+        with self._lock:
+            self._open_log()
+            self._target = target
+            if self._timer is None:
+                self._started_at = started_at or utils.clock.time()
+                self._set_timer(0)
+            self._save_state()
+
+    def set_target(self, target):
+        "Sets the target temperature, None only records the temperature."
+        with self._lock:
+            self._target = target
+            self._save_state()
+
+    def stop(self):
+        "Stops recording, the heater pad and the cooler are switched off."
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._switch(False, False)
+            if self._log is not None:
+                self._log.flush()
+            self._save_state()
+
+    def is_running(self):
+        return self._timer is not None
+
+    def get_status(self):
+        with self._lock:
+            ret = {'running': self._timer is not None, 'started_at': self._started_at, 'target': self._target,
+                   'heating': self._heating, 'cooling': self._cooling,
+                   'heater': self._heater is not None, 'cooler': self._cooler is not None}
+            if self._last_sample is not None:
+                ret['current'], ret['sampled_at'] = self._last_sample
+            if self._log is not None:
+                ret['storage'] = self._log.get_status()
+            return ret
+
+    def samples(self, since=None, until=None):
+        "Returns the recorded (seconds, Celsius) samples, see ProbeLog.samples()."
+        with self._lock:
+            if self._log is None:
+                if not os.path.isdir(self._directory):
+                    return []
+                self._open_log()
+            return self._log.samples(since, until)
+
+    def _set_timer(self, secs=None):
+        if secs is None:
+            secs = config.config.current.fermentation_sample_secs
+        self._due = utils.clock.time() + secs
+        self._timer = utils.clock.timer(secs, self._timeout)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _switch(self, heating, cooling):
+        if heating != self._heating and self._heater is not None:
+            self._heater.set_power(100 if heating else 0)
+            logging.info("Fermenter heater pad %s", "on" if heating else "off")
+        if cooling != self._cooling and self._cooler is not None:
+            if cooling:
+                self._cooler.on()
+            else:
+                self._cooler.off()
+                self._cooler_off_at = utils.clock.time()
+            logging.info("Fermenter cooler %s", "on" if cooling else "off")
+        self._heating = heating and self._heater is not None
+        self._cooling = cooling and self._cooler is not None
+
+    def _control(self, temp):
+        target = self._target
+        if target is None or temp != temp:
+            # Nothing to hold or an open or shorted probe
+            self._switch(False, False)
+            return
+        cfg = config.config.current
+        heating = temp <= target - cfg.fermentation_band or (self._heating and temp < target)
+        cooling = temp >= target + cfg.fermentation_band or (self._cooling and temp > target)
+        if cooling and not self._cooling and self._cooler_off_at is not None and \
+                utils.clock.time() - self._cooler_off_at < cfg.fermentation_cooler_min_off_secs:
+            cooling = False
+        self._switch(heating, cooling)
+
+    def _timeout(self):
+        with self._lock:
+            if self._timer is None:
+                return
+            self._lateness.observe(utils.clock.time() - self._due)
+            try:
+                temp = self._thermistor.get_temp()
+                now = utils.clock.time()
+                self._last_sample = (temp, now)
+                if temp == temp:
+                    self._log.append(now, temp)
+                else:
+                    logging.warning("Fermenter probe reads no temperature")
+                self._control(temp)
+            except Exception:
+                logging.exception("Fermentation tick failed, heater pad and cooler off")
+                self._switch(False, False)
+            finally:
+                self._set_timer()
+
+def main():
+    parser = argparse.ArgumentParser(description="Decodes a pombru fermentation sample file into JSON lines.")
+    parser.add_argument("file", help="Sample file (.pfs)")
+    parser.add_argument("--since", type=int, default=None, help="First second")
+    parser.add_argument("--until", type=int, default=None, help="Last second")
+    args = parser.parse_args()
+    ring = RingFile.open_existing(args.file)
+    for ts, value in ring.read(args.since, args.until):
+        sys.stdout.write(json.dumps({'at': ts, 'temperature': value / 100.0}) + "\n")
+    ring.close()
+
+if __name__ == "__main__":
+    main()
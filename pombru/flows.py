@@ -0,0 +1,331 @@
+"""Brewing flows defined in data: the stages of a brew other than the classic
+three-vessel sparge sequence of process.BrewStages, e.g. no-sparge, batch sparge or
+brew in a bag. A recipe selects a flow by name (Recipe.flow), without it the classic
+sequence is brewed.
+
+The flows are JSON files in the [flows] Directory, the name of a flow is its file
+name without ".json". A flow is validated as a whole when it is loaded:
+    {"description": "...",
+     "fill": {"boiler": "total_water"},        # where the brewer puts the water
+     "stages": [{
+        "key": "BIAB_MASH",                   # unique, upper case
+        "name": "Mashing in the bag - step {step}.",
+        "for_each": "mash_step",               # optional: one stage per mash step
+        "actions": [{"heat": "boiler", "to": "step_temperature", "volume": "total_water"},
+                    {"off": "mashtun"},
+                    {"notify": "Put {total_water} L of water in the boiler"}],
+        "routes": ["mashtun->mashtun:MASH_DISTRIBUTION"],   # the pumps running in the stage
+        "until": {"reached": "boiler", "hold": "step_minutes * 60"}}]}
+
+A stage is left when its "until" is met, one of:
+    {"seconds": VALUE}
+    {"reached": VESSEL, "hold": VALUE, "hops": true}  held for hold seconds after the
+        target temperature of the vessel is reached, the hop arms of the recipe are
+        released while holding if hops is true
+    {"transfer": "SOURCE->TARGET", "liters": VALUE, "empty": true}  the transfer is
+        made by the pumps in AUTOMATIC transfer mode, by the brewer in MANUAL
+    {"operator": true, "pause": true}  left by the brewer (next), a pause is skipped
+        if [process] Pause is off
+    {"cooled": true}  the wort is cooled to the pitch temperature, the stage is left
+        out if [cooling] is disabled
+A VALUE is a number or an arithmetic expression of the VALUES of the recipe."""
+import ast
+import json
+import logging
+import operator
+import os
+import threading
+
+import config
+import topology
+import transfers
+
+# The values of the recipe the expressions and messages may use
+VALUES = ('mash_water', 'sparge_water', 'total_water', 'boil_minutes', 'pitch_temperature',
+          'first_mash_temperature', 'sparging_temperature')
+# The values of a mash step, in the stages with "for_each": "mash_step"
+STEP_VALUES = ('step', 'step_temperature', 'step_minutes')
+
+FOR_EACH_MASH_STEP = "mash_step"
+
+ACTION_HEAT = "heat"
+ACTION_OFF = "off"
+ACTION_NOTIFY = "notify"
+
+UNTIL_SECONDS = "seconds"
+UNTIL_REACHED = "reached"
+UNTIL_TRANSFER = "transfer"
+UNTIL_OPERATOR = "operator"
+UNTIL_COOLED = "cooled"
+
+# The vessels the heaters of the process are commanded in
+HEATED = ('mashtun', 'boiler')
+DISTRIBUTIONS = ('MASH_DISTRIBUTION', 'SPARGE_DISTRIBUTION')
+
+_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+              ast.USub: operator.neg}
+
+def values(recipe, sparging_temperature, step=None):
+    "Returns the values of the recipe (and of the mash step) for the expressions."
+    ret = {'mash_water': recipe.mash_water, 'sparge_water': recipe.sparge_water,
+           'total_water': recipe.mash_water + recipe.sparge_water, 'boil_minutes': recipe.boiling_time,
+           'pitch_temperature': recipe.pitch_temperature, 'first_mash_temperature': recipe.mash_stages[0][0],
+           'sparging_temperature': sparging_temperature}
+    if step is not None:
+        ret['step'] = step
+        ret['step_temperature'], ret['step_minutes'] = recipe.mash_stages[step - 1]
+    return ret
+
+class Expression(object):
+    "A number or an arithmetic expression (+ - * / and parentheses) of named values."
+
+    def __init__(self, text, names):
+        self.text = str(text)
+        try:
+            self._tree = ast.parse(self.text, mode='eval').body
+        except SyntaxError:
+            raise ValueError("Invalid expression: " + self.text)
+        self._check(self._tree, names)
+
+    def _check(self, node, names):
+        if isinstance(node, ast.BinOp) and type(node.op) in _OPERATORS:
+            self._check(node.left, names)
+            self._check(node.right, names)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in _OPERATORS:
+            self._check(node.operand, names)
+        elif isinstance(node, ast.Name):
+            if node.id not in names:
+                raise ValueError("Unknown value '%s' in %s" % (node.id, self.text))
+        elif not (isinstance(node, ast.Constant) and type(node.value) in (int, float)):
+            raise ValueError("Invalid expression: " + self.text)
+
+    def __call__(self, values):
+        return self._eval(self._tree, values)
+
+    def _eval(self, node, values):
+        if isinstance(node, ast.BinOp):
+            return _OPERATORS[type(node.op)](self._eval(node.left, values), self._eval(node.right, values))
+        if isinstance(node, ast.UnaryOp):
+            return _OPERATORS[type(node.op)](self._eval(node.operand, values))
+        if isinstance(node, ast.Name):
+            return values[node.id]
+        return node.value
+
+    def __str__(self):
+        return self.text
+
+class Action(object):
+    "Done when a stage is entered: heat (vessel, to, volume), off (vessel) or notify (message)."
+
+    def __init__(self, kind, vessel=None, to=None, volume=None, message=None):
+        self.kind = kind
+        self.vessel = vessel
+        self.to = to
+        self.volume = volume
+        self.message = message
+
+class Until(object):
+    "How a stage is left, see the module documentation."
+
+    def __init__(self, kind, value=None, vessel=None, hold=None, hops=False, route=None, liters=None, empty=False, pause=False):
+        self.kind = kind
+        self.value = value
+        self.vessel = vessel
+        self.hold = hold
+        self.hops = hops
+        self.route = route
+        self.liters = liters
+        self.empty = empty
+        self.pause = pause
+
+class FlowStage(object):
+    def __init__(self, key, name, for_each, actions, routes, until):
+        self.key = key
+        self.name = name
+        self.for_each = for_each
+        self.actions = actions
+        self.routes = routes
+        self.until = until
+
+    def stage_key(self, step=None):
+        "Key of the stage in process.BrewStages, the mash steps are numbered as BIAB_MASH_1."
+        return self.key if step is None else self.key + "_" + str(step)
+
+    def stage_name(self, step=None):
+        return self.name if step is None else self.name.format(step=step)
+
+    def is_operator(self, transfer_mode, pause):
+        "True if the stage is left by the brewer."
+        if self.until.kind == UNTIL_OPERATOR:
+            return pause or not self.until.pause
+        return self.until.kind == UNTIL_TRANSFER and transfer_mode == 'MANUAL'
+
+class Flow(object):
+    def __init__(self, name, description, fill, stages):
+        self.name = name
+        self.description = description
+        self.fill = fill
+        self.stages = stages
+
+    def to_dict(self):
+        return {'name': self.name, 'description': self.description, 'fill': dict((v, str(e)) for v, e in self.fill.items()),
+                'stages': [{'key': s.key, 'name': s.name, 'for_each': s.for_each, 'until': s.until.kind} for s in self.stages]}
+
+def _value(text, names, where):
+    try:
+        return Expression(text, names)
+    except ValueError as e:
+        raise ValueError("%s: %s" % (where, e))
+
+def _expression(data, field, names, where):
+    if field not in data:
+        raise ValueError("%s: '%s' is missing" % (where, field))
+    return _value(data[field], names, where)
+
+def _message(text, names, where):
+    try:
+        str(text).format(**dict((n, 0) for n in names))
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError("%s: invalid message %r: %r" % (where, text, e))
+    return str(text)
+
+def _parse_action(data, names, where):
+    if not isinstance(data, dict):
+        raise ValueError(where + ": an action must be an object")
+    if ACTION_HEAT in data:
+        vessel = data[ACTION_HEAT]
+        if vessel not in HEATED:
+            raise ValueError("%s: cannot heat %s" % (where, vessel))
+        volume = _value(data['volume'], names, where) if 'volume' in data else None
+        return Action(ACTION_HEAT, vessel=vessel, to=_expression(data, 'to', names, where), volume=volume)
+    if ACTION_OFF in data:
+        if data[ACTION_OFF] not in HEATED:
+            raise ValueError("%s: cannot switch off %s" % (where, data[ACTION_OFF]))
+        return Action(ACTION_OFF, vessel=data[ACTION_OFF])
+    if ACTION_NOTIFY in data:
+        return Action(ACTION_NOTIFY, message=_message(data[ACTION_NOTIFY], names, where))
+    raise ValueError("%s: unknown action %s" % (where, json.dumps(data)))
+
+def _parse_route(spec, topo, where):
+    source, target, distribution = topology.parse_route(spec)
+    if distribution is not None and distribution not in DISTRIBUTIONS:
+        raise ValueError("%s: unknown pump distribution %s" % (where, distribution))
+    try:
+        topo.paths(source, target)
+    except ValueError as e:
+        raise ValueError("%s: %s" % (where, e))
+    return (source, target) if distribution is None else (source, target, distribution)
+
+def _parse_until(data, names, topo, where):
+    if not isinstance(data, dict):
+        raise ValueError(where + ": 'until' is missing")
+    kinds = [k for k in (UNTIL_SECONDS, UNTIL_REACHED, UNTIL_TRANSFER, UNTIL_OPERATOR, UNTIL_COOLED) if k in data]
+    if len(kinds) != 1:
+        raise ValueError(where + ": 'until' must have exactly one of seconds, reached, transfer, operator, cooled")
+    kind = kinds[0]
+    if kind == UNTIL_SECONDS:
+        return Until(kind, value=_expression(data, UNTIL_SECONDS, names, where))
+    if kind == UNTIL_REACHED:
+        if data[kind] not in HEATED:
+            raise ValueError("%s: %s is not heated" % (where, data[kind]))
+        hold = _value(data['hold'], names, where) if 'hold' in data else None
+        return Until(kind, vessel=data[kind], hold=hold, hops=bool(data.get('hops', False)))
+    if kind == UNTIL_TRANSFER:
+        route = _parse_route(data[kind], topo, where)
+        if route[0] == route[1] or len(route) > 2:
+            raise ValueError("%s: %s is not a transfer" % (where, data[kind]))
+        if transfers.SECONDS_PER_LITER_CONFIG.get(topology.route_name(*route)) is None:
+            raise ValueError("%s: no SecondsPerLiter is configured for %s" % (where, data[kind]))
+        return Until(kind, route=route, liters=_expression(data, 'liters', names, where),
+                     empty=bool(data.get('empty', False)))
+    if kind == UNTIL_OPERATOR:
+        return Until(kind, pause=bool(data.get('pause', False)))
+    return Until(kind)
+
+def _parse_stage(data, topo, where):
+    if not isinstance(data, dict):
+        raise ValueError(where + ": a stage must be an object")
+    key = data.get('key')
+    if not isinstance(key, str) or not key.isidentifier() or key != key.upper():
+        raise ValueError("%s: invalid key %r" % (where, key))
+    where = "%s %s" % (where, key)
+    for_each = data.get('for_each')
+    names = VALUES
+    name = str(data.get('name', ''))
+    if for_each is not None:
+        if for_each != FOR_EACH_MASH_STEP:
+            raise ValueError("%s: unknown for_each %s" % (where, for_each))
+        names = VALUES + STEP_VALUES
+        if "{step}" not in name:
+            raise ValueError(where + ": the name of a mash step stage must contain {step}")
+    elif "{" in name:
+        raise ValueError("%s: invalid name %r" % (where, name))
+    if not name:
+        raise ValueError(where + ": 'name' is missing")
+    actions = [_parse_action(a, names, where) for a in data.get('actions', [])]
+    routes = [_parse_route(r, topo, where) for r in data.get('routes', [])]
+    until = _parse_until(data.get('until'), names, topo, where)
+    if for_each is not None and until.kind not in (UNTIL_SECONDS, UNTIL_REACHED):
+        raise ValueError(where + ": a mash step stage is left after some time or a temperature")
+    if until.kind == UNTIL_REACHED and not any(a.kind == ACTION_HEAT and a.vessel == until.vessel for a in actions):
+        raise ValueError("%s: the stage waits for %s, but does not heat it" % (where, until.vessel))
+    return FlowStage(key, name, for_each, actions, routes, until)
+
+def parse(name, data, topo):
+    "Returns the Flow of the JSON data. Raises ValueError if it is invalid."
+    where = "Flow " + name
+    if not isinstance(data, dict) or not isinstance(data.get('stages'), list) or not data['stages']:
+        raise ValueError(where + " has no stages")
+    fill = {}
+    for vessel, liters in data.get('fill', {}).items():
+        if vessel not in topo.vessels:
+            raise ValueError("%s: unknown vessel %s" % (where, vessel))
+        fill[vessel] = _value(liters, VALUES, where)
+    stages = [_parse_stage(s, topo, where) for s in data['stages']]
+    keys = [s.key for s in stages]
+    names = [s.name for s in stages]
+    if len(set(keys)) != len(keys) or len(set(names)) != len(names):
+        raise ValueError(where + ": the keys and the names of the stages must be unique")
+    return Flow(name, str(data.get('description', '')), fill, stages)
+
+def load(directory, topo=None):
+    """Returns the flows of the directory by name. Raises ValueError if a flow is
+    invalid, or two flows use the same stage key."""
+    if topo is None:
+        topo = topology.parse(config.config.cp)
+    ret = {}
+    keys = {}
+    filenames = sorted(f for f in os.listdir(directory) if f.endswith(".json")) if os.path.isdir(directory) else []
+    for filename in filenames:
+        name = filename[:-len(".json")]
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                data = json.load(f)
+        except ValueError as e:
+            raise ValueError("Flow %s is not valid JSON: %s" % (name, e))
+        flow = parse(name, data, topo)
+        for stage in flow.stages:
+            if keys.setdefault(stage.key, name) != name:
+                raise ValueError("Stage %s is defined by the flows %s and %s" % (stage.key, keys[stage.key], name))
+        ret[name] = flow
+    logging.info("Flows loaded from %s: %s", directory, ", ".join(ret) or "none")
+    return ret
+
+_lock = threading.Lock()
+_loaded = {}
+
+def get_all(directory=None):
+    "Returns the flows of the directory ([flows] Directory by default), loaded once."
+    if directory is None:
+        directory = config.config.current.flows_directory
+    with _lock:
+        if directory not in _loaded:
+            _loaded[directory] = load(directory)
+        return _loaded[directory]
+
+def get(name, directory=None):
+    "Returns the flow of the given name. Raises ValueError if it is not defined or invalid."
+    flow = get_all(directory).get(name)
+    if flow is None:
+        raise ValueError("Unknown flow: " + str(name))
+    return flow
@@ -0,0 +1,465 @@
+"""Brew history stored in a local SQLite database.
+
+Every run of the BrewProcess is recorded from the telemetry events: the recipe,
+the configuration snapshot, stage timings, heat-ups, notifications and the
+temperature samples downsampled to [history] SampleSecs. The energy used by the
+heaters (energy.EnergyMeter) is recorded for the brew, the stages and the heat-ups.
+
+The events are queued by the telemetry listener and written by a background
+thread, one transaction per batch, so the control threads never wait for the
+disk. Queries use their own connections.
+
+Export for analysis:
+    python history.py export --out history-export [--format parquet|csv] [--last 20]
+"""
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import energy
+import process
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS brews (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    result TEXT,
+    recipe_key TEXT,
+    recipe TEXT,
+    config TEXT,
+    mash_water REAL,
+    sparge_water REAL,
+    mashtun_kwh REAL,
+    boiler_kwh REAL
+);
+CREATE INDEX IF NOT EXISTS brews_started_at ON brews (started_at);
+CREATE INDEX IF NOT EXISTS brews_recipe_key ON brews (recipe_key, started_at);
+
+CREATE TABLE IF NOT EXISTS stages (
+    id INTEGER PRIMARY KEY,
+    brew_id INTEGER NOT NULL REFERENCES brews (id),
+    stage TEXT NOT NULL,
+    name TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    ended_at REAL,
+    planned_seconds REAL,
+    mashtun_start REAL,
+    boiler_start REAL,
+    mashtun_end REAL,
+    boiler_end REAL,
+    mashtun_kwh REAL,
+    boiler_kwh REAL
+);
+CREATE INDEX IF NOT EXISTS stages_brew ON stages (brew_id, started_at);
+CREATE INDEX IF NOT EXISTS stages_stage ON stages (stage, brew_id);
+
+CREATE TABLE IF NOT EXISTS heatups (
+    id INTEGER PRIMARY KEY,
+    brew_id INTEGER NOT NULL REFERENCES brews (id),
+    stage TEXT NOT NULL,
+    vessel TEXT NOT NULL,
+    liters REAL,
+    target REAL NOT NULL,
+    start_temperature REAL,
+    set_at REAL NOT NULL,
+    reached_at REAL,
+    kwh REAL
+);
+CREATE INDEX IF NOT EXISTS heatups_query ON heatups (stage, vessel, liters, brew_id);
+
+CREATE TABLE IF NOT EXISTS tasks (
+    brew_id INTEGER NOT NULL REFERENCES brews (id),
+    at REAL NOT NULL,
+    event TEXT NOT NULL,
+    param TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_brew ON tasks (brew_id, at);
+
+CREATE TABLE IF NOT EXISTS notifications (
+    brew_id INTEGER NOT NULL REFERENCES brews (id),
+    at REAL NOT NULL,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS notifications_brew ON notifications (brew_id, at);
+
+CREATE TABLE IF NOT EXISTS samples (
+    brew_id INTEGER NOT NULL REFERENCES brews (id),
+    at REAL NOT NULL,
+    vessel TEXT NOT NULL,
+    current REAL,
+    target REAL,
+    power REAL
+);
+CREATE INDEX IF NOT EXISTS samples_brew ON samples (brew_id, vessel, at);
+"""
+
+# Columns added since the first version of the schema, added to older databases
+_ADDED_COLUMNS = (
+    ("brews", "mashtun_kwh REAL"), ("brews", "boiler_kwh REAL"),
+    ("stages", "mashtun_kwh REAL"), ("stages", "boiler_kwh REAL"),
+    ("heatups", "kwh REAL"),
+)
+
+TABLES = ("brews", "stages", "heatups", "tasks", "notifications", "samples")
+
+_STAGE_KEYS = dict((v[process.BrewStages.KEY_NAME], k) for k, v in vars(process.BrewStages).items() if isinstance(v, dict))
+
+_TARGET_TASKS = {process.BrewTask.MASH_TARGET_TEMP: 'mashtun', process.BrewTask.BOIL_TARGET_TEMP: 'boiler'}
+_FILL_TASKS = {process.BrewTask.MASH_FILL_VOLUME: 'mashtun', process.BrewTask.BOIL_FILL_VOLUME: 'boiler'}
+_OFF_TASKS = {process.BrewTask.STOP_MASHING_TUN: 'mashtun', process.BrewTask.STOP_BOIL_KETTLE: 'boiler'}
+
+def stage_key(stage):
+    "Returns the BrewStages attribute name (e.g. MASHING_1) of a stage given by key or display name."
+    if stage in _STAGE_KEYS:
+        return _STAGE_KEYS[stage]
+    if isinstance(getattr(process.BrewStages, stage, None), dict):
+        return stage
+    # Mash steps after the fourth and the stages of the flows are created on demand
+    for key, value in list(vars(process.BrewStages).items()):
+        if isinstance(value, dict) and value[process.BrewStages.KEY_NAME] == stage:
+            _STAGE_KEYS[stage] = key
+            return key
+    raise ValueError("Unknown stage: " + str(stage))
+
+def _recorded_key(name):
+    "The key of a stage for the record, its name if the stage is not known (anymore)."
+    try:
+        return stage_key(name)
+    except ValueError:
+        return name
+
+def connect(filename):
+    conn = sqlite3.connect(filename)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _migrate(conn):
+    for table, column in _ADDED_COLUMNS:
+        names = [row[1] for row in conn.execute("PRAGMA table_info(" + table + ")")]
+        if column.split()[0] not in names:
+            conn.execute("ALTER TABLE " + table + " ADD COLUMN " + column)
+
+def _used(end, start):
+    "Energy used between two readings of the meter, None if one of them is missing."
+    if end is None or start is None:
+        return None
+    return end - start
+
+class _Recorder(object):
+    "Turns telemetry events into rows. Only used on the writer thread."
+
+    def __init__(self, conn, sample_secs):
+        self._conn = conn
+        self._sample_secs = sample_secs
+        self._brew_id = None
+        self._stage_id = None
+        self._stage = None
+        self._entering = None
+        self._temperatures = {}
+        # Readings of the energy meter: the last one, at the start of the brew,
+        # the stage and the running heat-ups by vessel
+        self._kwh = {}
+        self._brew_kwh = {}
+        self._stage_kwh = {}
+        self._heatup_kwh = {}
+        self._volumes = {}
+        self._heatups = {}
+        self._next_sample = {}
+        self._samples = []
+
+    def record(self, event):
+        handler = getattr(self, "_on_" + event.kind, None)
+        if handler is not None:
+            handler(event.timestamp, event.data)
+
+    def flush_samples(self):
+        if self._samples:
+            self._conn.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?)", self._samples)
+            self._samples = []
+
+    def _on_brew(self, ts, data):
+        if data['action'] == 'start':
+            if self._brew_id is not None:
+                self._finish(ts, 'restarted')
+            recipe = json.dumps(data['recipe'], sort_keys=True)
+            cur = self._conn.execute(
+                "INSERT INTO brews (started_at, recipe_key, recipe, config, mash_water, sparge_water) VALUES (?, ?, ?, ?, ?, ?)",
+                (ts, hashlib.md5(recipe.encode()).hexdigest(), recipe, json.dumps(data['config'], sort_keys=True),
+                 data['recipe']['mash_water'], data['recipe']['sparge_water']))
+            self._brew_id = cur.lastrowid
+            self._brew_kwh = dict(self._kwh)
+            self._next_sample = {}
+        elif data['action'] == 'finish' and self._brew_id is not None:
+            self._finish(ts, 'completed')
+
+    def _on_stage(self, ts, data):
+        # The tasks of a stage are dispatched before its status is published,
+        # heat-ups are attributed to the stage being entered
+        self._entering = _recorded_key(data['name'])
+
+    def _on_status(self, ts, data):
+        if self._brew_id is None:
+            return
+        if data['status'] == 'stopped':
+            self._finish(ts, 'stopped')
+        elif data['current_stage'] != self._stage:
+            self._close_stage(ts)
+            self._stage = data['current_stage']
+            cur = self._conn.execute(
+                "INSERT INTO stages (brew_id, stage, name, started_at, planned_seconds, mashtun_start, boiler_start) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self._brew_id, _recorded_key(self._stage), self._stage, ts, data['stage_remaining'],
+                 self._temperatures.get('mashtun'), self._temperatures.get('boiler')))
+            self._stage_id = cur.lastrowid
+            self._stage_kwh = dict(self._kwh)
+
+    def _on_task(self, ts, data):
+        event = data['event']
+        if self._brew_id is not None:
+            self._conn.execute("INSERT INTO tasks VALUES (?, ?, ?, ?)",
+                               (self._brew_id, ts, event, None if data['param'] is None else str(data['param'])))
+        if event in _FILL_TASKS:
+            self._volumes[_FILL_TASKS[event]] = data['param']
+        elif event in _TARGET_TASKS and self._brew_id is not None and self._entering is not None:
+            vessel = _TARGET_TASKS[event]
+            cur = self._conn.execute(
+                "INSERT INTO heatups (brew_id, stage, vessel, liters, target, start_temperature, set_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self._brew_id, self._entering, vessel, self._volumes.get(vessel), data['param'],
+                 self._temperatures.get(vessel), ts))
+            self._heatups[vessel] = cur.lastrowid
+            self._heatup_kwh[vessel] = self._kwh.get(vessel)
+        elif event in _OFF_TASKS:
+            self._heatups.pop(_OFF_TASKS[event], None)
+
+    def _on_target_reached(self, ts, data):
+        vessel = data['vessel']
+        heatup_id = self._heatups.pop(vessel, None)
+        if heatup_id is not None:
+            self._conn.execute("UPDATE heatups SET reached_at = ?, kwh = ? WHERE id = ?",
+                               (ts, _used(self._kwh.get(vessel), self._heatup_kwh.get(vessel)), heatup_id))
+
+    def _on_notification(self, ts, data):
+        if self._brew_id is not None:
+            self._conn.execute("INSERT INTO notifications VALUES (?, ?, ?)", (self._brew_id, ts, data['message']))
+
+    def _on_temperature(self, ts, data):
+        for vessel, sample in data.items():
+            self._temperatures[vessel] = sample['current']
+            # Recordings of the event log have no energy
+            if sample.get('kwh') is not None:
+                self._kwh[vessel] = sample['kwh']
+                # The first reading is the start if there was none before
+                if self._brew_id is not None:
+                    self._brew_kwh.setdefault(vessel, sample['kwh'])
+                if self._stage_id is not None:
+                    self._stage_kwh.setdefault(vessel, sample['kwh'])
+                if vessel in self._heatups and self._heatup_kwh.get(vessel) is None:
+                    self._heatup_kwh[vessel] = sample['kwh']
+            if self._brew_id is None or ts < self._next_sample.get(vessel, 0):
+                continue
+            self._next_sample[vessel] = ts + self._sample_secs
+            self._samples.append((self._brew_id, ts, vessel, sample['current'], sample['target'], sample['power']))
+
+    def _close_stage(self, ts):
+        if self._stage_id is not None:
+            self._conn.execute("UPDATE stages SET ended_at = ?, mashtun_end = ?, boiler_end = ?, mashtun_kwh = ?, boiler_kwh = ? WHERE id = ?",
+                               (ts, self._temperatures.get('mashtun'), self._temperatures.get('boiler'),
+                                _used(self._kwh.get('mashtun'), self._stage_kwh.get('mashtun')),
+                                _used(self._kwh.get('boiler'), self._stage_kwh.get('boiler')), self._stage_id))
+        self._stage_id = None
+        self._stage = None
+
+    def _finish(self, ts, result):
+        self._close_stage(ts)
+        self.flush_samples()
+        self._conn.execute("UPDATE brews SET finished_at = ?, result = ?, mashtun_kwh = ?, boiler_kwh = ? WHERE id = ?",
+                           (ts, result, _used(self._kwh.get('mashtun'), self._brew_kwh.get('mashtun')),
+                            _used(self._kwh.get('boiler'), self._brew_kwh.get('boiler')), self._brew_id))
+        self._brew_id = None
+        self._entering = None
+        self._heatups = {}
+        self._heatup_kwh = {}
+
+class BrewHistory(object):
+    """Records the brews into the database. listener() is meant to be added to the
+    telemetry hub, it only queues the event, when the queue is full the event is dropped."""
+
+    def __init__(self, filename, batch_secs=5, sample_secs=10, queue_size=10000):
+        self.filename = filename
+        self._batch_secs = batch_secs
+        self._sample_secs = sample_secs
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self.dropped = 0
+        with connect(filename) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            _migrate(conn)
+        conn.close()
+
+    def listener(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="history")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        "Writes the queued events and stops the writer."
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        conn = connect(self.filename)
+        recorder = _Recorder(conn, self._sample_secs)
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            deadline = time.time() + self._batch_secs
+            while batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                running = False
+            try:
+                with conn:
+                    for event in batch:
+                        recorder.record(event)
+                    recorder.flush_samples()
+            except sqlite3.Error:
+                logging.exception("Error while writing the brew history, %d events lost", len(batch))
+        conn.close()
+
+    #########################################
+    ## Queries
+    #########################################
+
+    def brews(self, limit=20):
+        "Returns the last brews, newest first."
+        with connect(self.filename) as conn:
+            rows = conn.execute("SELECT id, started_at, finished_at, result, recipe_key, mash_water, sparge_water, mashtun_kwh, boiler_kwh FROM brews "
+                                "ORDER BY started_at DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def brew(self, brew_id, samples=False):
+        "Returns the complete record of a brew or None."
+        with connect(self.filename) as conn:
+            row = conn.execute("SELECT * FROM brews WHERE id = ?", (brew_id,)).fetchone()
+            if row is None:
+                return None
+            ret = dict(row)
+            ret['recipe'] = json.loads(ret['recipe'])
+            ret['config'] = json.loads(ret['config'])
+            for table, order in (('stages', 'started_at'), ('heatups', 'set_at'), ('notifications', 'at')):
+                ret[table] = [dict(r) for r in conn.execute(
+                    "SELECT * FROM " + table + " WHERE brew_id = ? ORDER BY " + order, (brew_id,))]
+            if samples:
+                ret['samples'] = [dict(r) for r in conn.execute(
+                    "SELECT at, vessel, current, target, power FROM samples WHERE brew_id = ? ORDER BY at", (brew_id,))]
+        return ret
+
+    def stage_stats(self, stage, vessel='mashtun', liters=None, last=20):
+        """Statistics of a stage over the last brews which have run it: heat-up time of
+        the vessel (from setting the target until it was reached) and stage duration, in
+        seconds. If liters is given, only heat-ups with that fill volume are counted.
+        The energy of the heat-ups is given per liter and Kelvin (Wh), and as the
+        efficiency of the heater: the part of it which heated the water.
+
+        E.g. the average heat-up of mash stage 1 at 15 L over the last 20 brews:
+            stage_stats('MASHING_1', 'mashtun', 15, 20)"""
+        key = stage_key(stage)
+        with connect(self.filename) as conn:
+            brew_ids = [r[0] for r in conn.execute(
+                "SELECT b.id FROM brews b WHERE EXISTS (SELECT 1 FROM stages s WHERE s.brew_id = b.id AND s.stage = ?) "
+                "ORDER BY b.started_at DESC LIMIT ?", (key, last))]
+            marks = ",".join("?" * len(brew_ids))
+            # Heat-ups of less than a Kelvin are only the noise of the probe for the energy
+            heatup_sql = ("SELECT COUNT(*), AVG(reached_at - set_at), MIN(reached_at - set_at), MAX(reached_at - set_at), "
+                          "AVG(CASE WHEN target - start_temperature >= 1 THEN kwh / (liters * (target - start_temperature)) END) "
+                          "FROM heatups WHERE stage = ? AND vessel = ? AND reached_at IS NOT NULL AND brew_id IN (" + marks + ")")
+            params = [key, vessel] + brew_ids
+            if liters is not None:
+                heatup_sql += " AND liters = ?"
+                params.append(liters)
+            heatup = conn.execute(heatup_sql, params).fetchone()
+            duration = conn.execute(
+                "SELECT COUNT(*), AVG(ended_at - started_at), MIN(ended_at - started_at), MAX(ended_at - started_at), AVG(planned_seconds), "
+                "AVG(" + {'mashtun': "mashtun_kwh", 'boiler': "boiler_kwh"}.get(vessel, "NULL") + ") "
+                "FROM stages WHERE stage = ? AND ended_at IS NOT NULL AND brew_id IN (" + marks + ")", [key] + brew_ids).fetchone()
+        kwh_per_liter_kelvin = heatup[4]
+        return {
+            'stage': key, 'vessel': vessel, 'liters': liters, 'brews': len(brew_ids),
+            'heatup': {'count': heatup[0], 'avg': heatup[1], 'min': heatup[2], 'max': heatup[3],
+                       'wh_per_liter_kelvin': kwh_per_liter_kelvin * 1000 if kwh_per_liter_kelvin else None,
+                       'efficiency': energy.WATER_KWH_PER_LITER_KELVIN / kwh_per_liter_kelvin if kwh_per_liter_kelvin else None},
+            'duration': {'count': duration[0], 'avg': duration[1], 'min': duration[2], 'max': duration[3], 'planned_avg': duration[4],
+                         'kwh_avg': duration[5]},
+        }
+
+    def export(self, directory, fmt='parquet', last=None):
+        """Exports the tables of the last brews (all if last is None) to directory, one
+        file per table. The parquet format needs pyarrow. Returns the written files."""
+        if fmt == 'parquet':
+            import pyarrow
+            import pyarrow.parquet
+        elif fmt != 'csv':
+            raise ValueError("Unknown export format: " + fmt)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        files = []
+        with connect(self.filename) as conn:
+            sql = "SELECT id FROM brews ORDER BY started_at DESC"
+            brew_ids = [r[0] for r in conn.execute(sql + (" LIMIT %d" % last if last is not None else ""))]
+            marks = ",".join("?" * len(brew_ids))
+            for table in TABLES:
+                cur = conn.execute("SELECT * FROM " + table + " WHERE " + ("id" if table == "brews" else "brew_id") +
+                                   " IN (" + marks + ")", brew_ids)
+                names = [d[0] for d in cur.description]
+                rows = cur.fetchall()
+                filename = os.path.join(directory, table + "." + fmt)
+                if fmt == 'parquet':
+                    columns = dict((name, [row[i] for row in rows]) for i, name in enumerate(names))
+                    pyarrow.parquet.write_table(pyarrow.table(columns), filename)
+                else:
+                    with open(filename, "w", newline="") as f:
+                        writer = csv.writer(f)
+                        writer.writerow(names)
+                        writer.writerows(rows)
+                files.append(filename)
+        return files
+
+def main():
+    import config
+    parser = argparse.ArgumentParser(description="Pombru brew history.")
+    parser.add_argument("command", choices=["export", "stats"])
+    parser.add_argument("--database", default=None, help="Database file, [history] Database by default")
+    parser.add_argument("--out", default="history-export", help="Export directory")
+    parser.add_argument("--format", default="parquet", choices=["parquet", "csv"], help="Export format")
+    parser.add_argument("--last", type=int, default=None, help="Number of last brews")
+    parser.add_argument("--stage", help="Stage for stats, e.g. MASHING_1")
+    parser.add_argument("--vessel", default="mashtun", help="Vessel for stats")
+    parser.add_argument("--volume", type=float, default=None, help="Fill volume in liters for stats")
+    args = parser.parse_args()
+    hist = BrewHistory(args.database or config.config.history_database)
+    if args.command == "export":
+        for filename in hist.export(args.out, args.format, args.last):
+            print(filename)
+    else:
+        print(json.dumps(hist.stage_stats(args.stage, args.vessel, args.volume, args.last or 20), indent=2))
+
+if __name__ == "__main__":
+    main()
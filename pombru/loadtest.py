@@ -0,0 +1,106 @@
+"""Load test for the Pombru REST API.
+
+Starts a number of concurrent pollers against a running server and reports
+the latency percentiles. Optionally a valve is switched back and forth during
+the test, to check that slow hardware requests do not delay the pollers.
+
+Example:
+    python loadtest.py --clients 20 --duration 30 --path /process --valve mashtunvalve
+"""
+import argparse
+import threading
+import time
+import requests
+
+API_BASE = "http://localhost:5000/pombru/api/v1"
+CT_FORM = {"Content-Type": "application/x-www-form-urlencoded"}
+
+def percentile(sorted_values, pct):
+    "Returns the pct percentile of an already sorted list."
+    if not sorted_values:
+        return float('nan')
+    idx = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+class Poller(threading.Thread):
+    "Polls url until the deadline and records the latencies in seconds."
+
+    def __init__(self, url, deadline, interval):
+        threading.Thread.__init__(self)
+        self.url = url
+        self.deadline = deadline
+        self.interval = interval
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        session = requests.Session()
+        while time.time() < self.deadline:
+            start = time.time()
+            try:
+                res = session.get(self.url, timeout=30)
+                if res.status_code >= 400:
+                    self.errors += 1
+            except requests.RequestException:
+                self.errors += 1
+            self.latencies.append(time.time() - start)
+            if self.interval > 0:
+                time.sleep(self.interval)
+
+class ValveToggler(threading.Thread):
+    "Switches a valve between its two targets until the deadline."
+
+    def __init__(self, url, deadline, targets=("mashtun", "temporary")):
+        threading.Thread.__init__(self)
+        self.url = url
+        self.deadline = deadline
+        self.targets = targets
+        self.latencies = []
+
+    def run(self):
+        i = 0
+        while time.time() < self.deadline:
+            start = time.time()
+            requests.put(self.url, headers=CT_FORM, data="target=" + self.targets[i % 2], timeout=60)
+            self.latencies.append(time.time() - start)
+            i += 1
+
+def report(name, latencies, errors=0):
+    values = sorted(latencies)
+    print("%-12s requests: %6d errors: %4d p50: %7.1fms p99: %7.1fms max: %7.1fms" % (
+        name, len(values), errors, percentile(values, 50) * 1000, percentile(values, 99) * 1000,
+        (values[-1] if values else float('nan')) * 1000))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base", default=API_BASE, help="Base URL of the API")
+    parser.add_argument("--path", default="/status", help="Resource to poll, relative to the base URL")
+    parser.add_argument("--clients", type=int, default=10, help="Number of concurrent pollers")
+    parser.add_argument("--duration", type=float, default=20, help="Test duration in seconds")
+    parser.add_argument("--interval", type=float, default=0, help="Delay between two polls of a client in seconds")
+    parser.add_argument("--valve", required=False, help="Valve to switch during the test, e.g. mashtunvalve")
+    args = parser.parse_args()
+
+    deadline = time.time() + args.duration
+    pollers = [Poller(args.base + args.path, deadline, args.interval) for _ in range(args.clients)]
+    threads = list(pollers)
+    toggler = None
+    if args.valve:
+        toggler = ValveToggler(args.base + "/" + args.valve, deadline)
+        threads.append(toggler)
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies = []
+    errors = 0
+    for p in pollers:
+        latencies.extend(p.latencies)
+        errors += p.errors
+    report(args.path, latencies, errors)
+    if toggler is not None:
+        report(args.valve, toggler.latencies)
+
+if __name__ == "__main__":
+    main()
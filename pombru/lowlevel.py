@@ -3,8 +3,12 @@ import math
 import os
 import random
 import threading
+import time
 from gpiozero import OutputDevice
 from gpiozero import MCP3208
+from gpiozero import DigitalInputDevice
+import metrics
+import utils
 
 class Relay(object):
     "Simple Relay class which is a gpiozero OutputDevice wrapper."
@@ -53,20 +57,62 @@ def create_spi_args(clock_pin=11, mosi_pin=10, miso_pin=9, select_pin=8):
     """ Creates a dictionary from the arguments. """
     return {'clock_pin':clock_pin, 'mosi_pin':mosi_pin, 'miso_pin':miso_pin, 'select_pin':select_pin}
 
+def adc_to_celsius(val):
+    """ Converts a relative MCP3208 value (0..1) of the thermistor's voltage divider
+        to Celsius.
+
+        From the value, it counts the resistance of the termistor.
+        The actual temperature is then calculated by the
+        Steinhart-Hart equation, see:
+        https://www.thermistor.com/calculators
+
+        Values at the rails (0 or 1) are read when the probe is open or shorted,
+        they are converted to NaN.
+    """
+    if not 0 < val < 1:
+        return float('nan')
+    const_a = 0.000607906373979
+    const_b = 0.000229555466739
+    const_c = 0.000000067688324
+    resistance = ((1-val) * 100000)/val
+    logrest = math.log(resistance)
+    temp_steinhart_hart = const_a + const_b * logrest + const_c * math.pow(logrest, 3)
+    temp_steinhart_hart = 1 / temp_steinhart_hart - 273.15
+    return temp_steinhart_hart
+
+def celsius_to_adc(temp):
+    """ Inverse of adc_to_celsius(): returns the relative MCP3208 value which
+        is converted to temp (or a hair above, never below). Solved by bisection,
+        the conversion is monotonic.
+    """
+    low, high = 1e-9, 1 - 1e-9
+    for _ in range(60):
+        mid = (low + high) / 2
+        if adc_to_celsius(mid) < temp:
+            low = mid
+        else:
+            high = mid
+    return high
+
 class Thermistor(object):
     """ Class representing a thermistor. The class assumes that
         the termistor is a variable resistor with impedance of 100 kOhm at
         25 Celsius. This variable resistor is then connected to an appropriate channel
-        of an MCP3208 integrated circuit
+        of an MCP3208 integrated circuit.
+        Instead of the MCP3208, any object with a value attribute (0..1)
+        can be passed as adc.
     """
 
     __DEFAULT_SPI_ARGS = create_spi_args()
+    MOCK_CELSIUS_PER_SEC = 0.5
 
-    def __init__(self, channel, sample_count=5, sample_delay=0.1, spi_args=None):
+    def __init__(self, channel, sample_count=5, sample_delay=0.1, spi_args=None, adc=None):
         if spi_args is None:
             spi_args = Thermistor.__DEFAULT_SPI_ARGS
         try:
-            if os.getenv('GPIOZERO_PIN_FACTORY') != 'mock':
+            if adc is not None:
+                self.__ic = adc
+            elif os.getenv('GPIOZERO_PIN_FACTORY') != 'mock':
                 self.__ic = MCP3208(channel=channel, differential=False, **spi_args)
             else:
                 self.__ic = None
@@ -74,26 +120,61 @@ class Thermistor(object):
             self.__ic = None
         self.__sample_count = sample_count
         self.__sample_delay = sample_delay
+        self.__mock_sample = (random.uniform(25, 30), utils.clock.time())
+        self.__read_seconds = metrics.SENSOR_READ_SECONDS.labels(channel=channel)
 
     def get_temp(self):
-        """ Reads the 3208 value n times and counts an average.
-
-            From this, it counts the resistance of the termistor.
-            The actual temperature is then calculated by the
-            Steinhart-Hart equation, see:
-            https://www.thermistor.com/calculators
+        """ Reads the 3208 value n times and counts an average,
+            then converts it with adc_to_celsius(). NaN is returned for an
+            open or shorted probe.
         """
         if self.__ic is None:
-            return random.randrange(25, 110)
-        const_a = 0.000607906373979
-        const_b = 0.000229555466739
-        const_c = 0.000000067688324
+            return self.__mock_temp()
         val = 0.0
+        start = time.time()
         for _ in range(self.__sample_count):
             val += self.__ic.value
+        self.__read_seconds.observe(time.time() - start)
         val /= self.__sample_count
-        resistance = ((1-val) * 100000)/val
-        logrest = math.log(resistance)
-        temp_steinhart_hart = const_a + const_b * logrest + const_c * math.pow(logrest, 3)
-        temp_steinhart_hart = 1 / temp_steinhart_hart - 273.15
-        return temp_steinhart_hart
+        return adc_to_celsius(val)
+
+    def __mock_temp(self):
+        """Without the MCP3208: a random walk between 20 and 99 Celsius changing by at most
+        MOCK_CELSIUS_PER_SEC, so the watchdog finds the readings plausible."""
+        temp, at = self.__mock_sample
+        now = utils.clock.time()
+        step = Thermistor.MOCK_CELSIUS_PER_SEC * min(max(now - at, 0), 10)
+        temp = min(99.0, max(20.0, temp + random.uniform(-step, step)))
+        self.__mock_sample = (temp, now)
+        return temp
+
+class FlowMeter(object):
+    """ Hall effect flow meter on a GPIO pin, which gives a pulse per a fixed
+        amount of liquid. The pulses are counted in the gpiozero callback thread.
+        Without GPIO the meter never counts.
+    """
+
+    def __init__(self, pin, pulses_per_liter):
+        self.__pulses_per_liter = pulses_per_liter
+        self.__pulses = 0
+        self.__last_pulse_at = None
+        self.__lock = threading.Lock()
+        self.__device = None
+        if os.getenv('GPIOZERO_PIN_FACTORY') != 'mock':
+            try:
+                self.__device = DigitalInputDevice(pin, pull_up=True)
+                self.__device.when_activated = self.__pulse
+            except IOError as _:
+                self.__device = None
+
+    def __pulse(self):
+        with self.__lock:
+            self.__pulses += 1
+            self.__last_pulse_at = utils.clock.time()
+
+    def read(self):
+        """ Returns the liters counted so far and the time of the last pulse
+            (None before the first one).
+        """
+        with self.__lock:
+            return self.__pulses / float(self.__pulses_per_liter), self.__last_pulse_at
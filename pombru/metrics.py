@@ -0,0 +1,191 @@
+"""Low-overhead metrics of the control stack, exported in the Prometheus text format.
+
+Observing a value is a bisect and a few increments, nothing is formatted until
+the metrics are scraped."""
+import bisect
+import threading
+import time
+
+import brewtrace
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+LATENESS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+LOCK_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1, 5, 10, 30)
+SETTLE_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60)
+TRANSFER_BUCKETS = (10, 30, 60, 120, 180, 300, 600, 900, 1200, 1800)
+
+def _format_labels(labels, extra=None):
+    items = list(labels)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + "}"
+
+class _HistogramChild(object):
+    "One labelled time series of a histogram."
+
+    def __init__(self, bounds, labels):
+        self._bounds = bounds
+        self._labels = labels
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        # Unlocked increments: a lost update on a race is acceptable for statistics
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._sum += value
+
+    def time(self):
+        "Returns a context manager which observes the duration of the block."
+        return _Timer(self)
+
+    def render(self, name, lines):
+        cumulative = 0
+        for bound, count in zip(self._bounds, self._counts):
+            cumulative += count
+            lines.append("%s_bucket%s %d" % (name, _format_labels(self._labels, ("le", repr(float(bound)))), cumulative))
+        cumulative += self._counts[-1]
+        lines.append("%s_bucket%s %d" % (name, _format_labels(self._labels, ("le", "+Inf")), cumulative))
+        lines.append("%s_sum%s %f" % (name, _format_labels(self._labels), self._sum))
+        lines.append("%s_count%s %d" % (name, _format_labels(self._labels), cumulative))
+
+class _Timer(object):
+
+    __slots__ = ('_child', '_start')
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *_):
+        self._child.observe(time.time() - self._start)
+
+class Histogram(object):
+    "A histogram metric family. Time series are selected by labels()."
+
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self._bounds = tuple(buckets)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        key = tuple(sorted(labels.items()))
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = _HistogramChild(self._bounds, key)
+                    self._children[key] = child
+        return child
+
+    def render(self, lines):
+        for child in list(self._children.values()):
+            child.render(self.name, lines)
+
+class Gauge(object):
+    """A gauge metric which is calculated by a function at scrape time only. With a
+    label the function returns the values by the value of the label."""
+
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, func, label=None):
+        self.name = name
+        self.documentation = documentation
+        self._func = func
+        self._label = label
+
+    def render(self, lines):
+        if self._label is None:
+            lines.append("%s %f" % (self.name, self._func()))
+            return
+        for key, value in sorted(self._func().items()):
+            lines.append("%s%s %f" % (self.name, _format_labels([(self._label, key)]), value))
+
+class Counter(Gauge):
+    "A counter metric whose total is kept elsewhere and read by a function at scrape time."
+
+    TYPE = "counter"
+
+_REGISTRY = []
+_REGISTRY_LOCK = threading.Lock()
+
+def register(metric):
+    with _REGISTRY_LOCK:
+        _REGISTRY.append(metric)
+    return metric
+
+def histogram(name, documentation, buckets=LATENCY_BUCKETS):
+    "Creates and registers a histogram."
+    return register(Histogram(name, documentation, buckets))
+
+def render():
+    "Returns all registered metrics in Prometheus text exposition format."
+    lines = []
+    for metric in list(_REGISTRY):
+        lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+        lines.append("# TYPE %s %s" % (metric.name, metric.TYPE))
+        metric.render(lines)
+    lines.append("")
+    return "\n".join(lines)
+
+class InstrumentedLock(object):
+    """Reentrant lock which observes how long threads wait for it and how long
+    it is held (outermost acquire to last release)."""
+
+    def __init__(self, name):
+        self._name = name
+        self._lock = threading.RLock()
+        self._wait = LOCK_WAIT_SECONDS.labels(lock=name)
+        self._hold = LOCK_HOLD_SECONDS.labels(lock=name)
+        self._depth = 0
+        self._acquired_at = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.time()
+        ret = self._lock.acquire(blocking, timeout)
+        if ret:
+            # Only the owner thread gets here, so the fields are not raced
+            self._depth += 1
+            if self._depth == 1:
+                self._acquired_at = time.time()
+                waited = self._acquired_at - start
+                self._wait.observe(waited)
+                if waited > brewtrace.LOCK_WAIT_THRESHOLD_SECS:
+                    brewtrace.tracer.complete("wait for " + self._name + " lock", brewtrace.CATEGORY_LOCK,
+                            int(start * 1000000), int(waited * 1000000))
+        return ret
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._hold.observe(time.time() - self._acquired_at)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
+SENSOR_READ_SECONDS = histogram("pombru_sensor_read_seconds", "Duration of a thermistor read (all samples).")
+TICK_LATENESS_SECONDS = histogram("pombru_tick_lateness_seconds", "How late periodic control loops fire compared to their schedule.", LATENESS_BUCKETS)
+TIMER_LATENESS_SECONDS = histogram("pombru_timer_lateness_seconds", "How late process timers fire compared to their timeout.", LATENESS_BUCKETS)
+LOCK_WAIT_SECONDS = histogram("pombru_lock_wait_seconds", "Time spent waiting for a lock.", LOCK_BUCKETS)
+LOCK_HOLD_SECONDS = histogram("pombru_lock_hold_seconds", "Time a lock was held.", LOCK_BUCKETS)
+VALVE_SETTLE_SECONDS = histogram("pombru_valve_settle_seconds", "Duration of valve moves including settling.", SETTLE_BUCKETS)
+ACTUATOR_COMMAND_SECONDS = histogram("pombru_actuator_command_seconds", "Duration of brew task execution by the brewery.")
+TRANSFER_SECONDS = histogram("pombru_transfer_seconds", "Duration of liquid transfers by route and by what ended them.", TRANSFER_BUCKETS)
+WATCHDOG_CHECK_SECONDS = histogram("pombru_watchdog_check_seconds", "Duration of a watchdog check of all loops and sensors.")
+WATCHDOG_DETECTION_SECONDS = histogram("pombru_watchdog_detection_seconds", "Time from the onset of a fault to the safe state.", LATENESS_BUCKETS)
+SET_VALVES_AND_PUMPS_SECONDS = histogram("pombru_set_valves_and_pumps_seconds", "Duration of setting all valves and pumps for a stage.", SETTLE_BUCKETS)
+register(Gauge("pombru_threads", "Number of live threads.", threading.active_count))
@@ -34,14 +34,15 @@ class PID:
     """PID Controller
     """
 
-    def __init__(self, P=1, I=3, D=0.2):
+    def __init__(self, P=1, I=3, D=0.2, time_func=time.time):
 
         self.Kp = P
         self.Ki = I
         self.Kd = D
+        self.time_func = time_func
 
         self.sample_time = 0.00
-        self.current_time = time.time()
+        self.current_time = self.time_func()
         self.last_time = self.current_time
 
         self.clear()
@@ -75,7 +76,7 @@ class PID:
         """
         error = self.SetPoint - feedback_value
 
-        self.current_time = time.time()
+        self.current_time = self.time_func()
         delta_time = self.current_time - self.last_time
         delta_error = error - self.last_error
 
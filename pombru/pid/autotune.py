@@ -0,0 +1,280 @@
+"""
+Automatic PID tuning for the jam makers.
+
+A step-response experiment is run on a vessel: the heater is driven with a
+constant power and the temperature is sampled every control tick. A
+first-order-plus-dead-time (FOPDT) model is fitted on the reaction curve and
+the gains are calculated with the Cohen-Coon method,
+see http://www.chem.mtu.edu/~tbco/cm416/tuning_methods.pdf for details.
+The gains are then validated in a short closed-loop trial and stored per
+vessel and fill volume.
+"""
+import configparser
+import logging
+import math
+import threading
+
+from pid.PID import PID
+
+def moving_average(values, window):
+    "Returns the centered moving average of values. The result has the same length."
+    if window <= 1 or len(values) < window:
+        return list(values)
+    half = window // 2
+    ret = []
+    for i in range(len(values)):
+        lo = max(0, i - half)
+        hi = min(len(values), i + half + 1)
+        ret.append(sum(values[lo:hi]) / (hi - lo))
+    return ret
+
+def fit_fopdt(times, temps, step_power, smoothing=15):
+    """Fits a first-order-plus-dead-time model on a step response.
+
+    times: sample times in seconds, starting with the time of the step
+    temps: temperatures sampled at times
+    step_power: the power change of the step (percent)
+
+    Returns a (gain, time_constant, dead_time) tuple: gain in Celsius per percent,
+    times in seconds.
+
+    The dead time is where the tangent of the steepest point crosses the starting
+    temperature. The slope of a first order response decays as exp(-t/tau), so tau
+    is estimated by a linear regression on the logarithm of the slope after the
+    steepest point. Gain is then max_slope * tau / step_power.
+    """
+    if len(times) < 2 * smoothing or step_power <= 0:
+        raise ValueError("Not enough samples to fit a model")
+    smooth = moving_average(temps, smoothing)
+    slopes = []
+    for i in range(1, len(smooth)):
+        slopes.append((smooth[i] - smooth[i - 1]) / (times[i] - times[i - 1]))
+    slopes = moving_average(slopes, smoothing)
+    idx_max = max(range(len(slopes)), key=lambda i: slopes[i])
+    max_slope = slopes[idx_max]
+    if max_slope <= 0:
+        raise ValueError("Temperature did not rise during the step")
+    t_max = (times[idx_max] + times[idx_max + 1]) / 2.0
+    y_max = (smooth[idx_max] + smooth[idx_max + 1]) / 2.0
+    dead_time = max(t_max - (y_max - smooth[0]) / max_slope, 1.0)
+
+    # Regression of ln(slope) on time after the steepest point
+    points = [(t, math.log(s)) for t, s in zip(times[idx_max + 1:], slopes[idx_max:]) if s > 0]
+    time_constant = None
+    if len(points) >= smoothing:
+        n = float(len(points))
+        mean_t = sum(p[0] for p in points) / n
+        mean_l = sum(p[1] for p in points) / n
+        var_t = sum((p[0] - mean_t) ** 2 for p in points)
+        if var_t > 0:
+            decay = sum((p[0] - mean_t) * (p[1] - mean_l) for p in points) / var_t
+            if decay < 0:
+                time_constant = -1.0 / decay
+    if time_constant is None or time_constant > Autotuner.MAX_TIME_CONSTANT:
+        # The response is practically integrating in the observed window
+        time_constant = Autotuner.MAX_TIME_CONSTANT
+    gain = max_slope * time_constant / step_power
+    return gain, time_constant, dead_time
+
+def cohen_coon(gain, time_constant, dead_time):
+    """Calculates PID gains for the PID class from a FOPDT model with the Cohen-Coon method.
+
+    Returns a (proportional, integral, derivative) tuple."""
+    ratio = dead_time / time_constant
+    kc = (1.0 / gain) * (time_constant / dead_time) * (4.0 / 3.0 + ratio / 4.0)
+    ti = dead_time * (32.0 + 6.0 * ratio) / (13.0 + 8.0 * ratio)
+    td = dead_time * 4.0 / (11.0 + 2.0 * ratio)
+    return kc, kc / ti, kc * td
+
+class PidGainStore(object):
+    """Stores PID gains per vessel and fill volume in an ini file.
+
+    Sections are named as "<vessel>:<liters>", e.g. "Mashtun:18"."""
+
+    PROPERTY_PROPORTIONAL = "Proportional"
+    PROPERTY_INTEGRAL = "Integral"
+    PROPERTY_DERIVATIVE = "Derivative"
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.RLock()
+        self._cp = configparser.ConfigParser()
+        self._cp.optionxform = str
+        self._cp.read(filename)
+
+    def get(self, vessel, liters=None):
+        """Returns the (p, i, d) gains stored for the vessel with the nearest fill volume.
+
+        Returns None if nothing is stored for the vessel."""
+        with self._lock:
+            candidates = []
+            for section in self._cp.sections():
+                name, _, volume = section.rpartition(":")
+                if name == str(vessel):
+                    candidates.append((float(volume), section))
+            if not candidates:
+                return None
+            if liters is None:
+                section = max(candidates)[1]
+            else:
+                section = min(candidates, key=lambda c: abs(c[0] - liters))[1]
+            sec = self._cp[section]
+            return (float(sec[PidGainStore.PROPERTY_PROPORTIONAL]),
+                    float(sec[PidGainStore.PROPERTY_INTEGRAL]),
+                    float(sec[PidGainStore.PROPERTY_DERIVATIVE]))
+
+    def put(self, vessel, liters, gains):
+        "Stores gains for the vessel and the fill volume, and writes the file."
+        with self._lock:
+            section = str(vessel) + ":" + str(int(round(liters)))
+            self._cp[section] = {
+                PidGainStore.PROPERTY_PROPORTIONAL: "%.4f" % gains[0],
+                PidGainStore.PROPERTY_INTEGRAL: "%.4f" % gains[1],
+                PidGainStore.PROPERTY_DERIVATIVE: "%.4f" % gains[2]}
+            with open(self._filename, "w") as f:
+                self._cp.write(f)
+
+class Autotuner(object):
+    """State machine of an autotune run. The jam maker calls update() on every
+    control tick with the current time and temperature, and sets the returned power.
+
+    States:
+    * STEP: constant step power is applied, samples are recorded
+    * VALIDATE: closed-loop trial with the calculated gains
+    * DONE: gains are calculated and validated
+    * FAILED: the experiment was aborted, see error
+    """
+
+    STATE_STEP = "step"
+    STATE_VALIDATE = "validate"
+    STATE_DONE = "done"
+    STATE_FAILED = "failed"
+
+    # Upper bound for the time constant, seconds
+    MAX_TIME_CONSTANT = 3 * 3600.0
+
+    # The step ends when the slope decays below this fraction of the max slope
+    _SLOPE_DECAY_END = 0.5
+    _DETUNE_FACTOR = 0.5
+
+    def __init__(self, step_power, max_step_secs, max_temperature, validate_rise, validate_secs, max_overshoot, validate_retries=2):
+        self.step_power = step_power
+        self.max_step_secs = max_step_secs
+        self.max_temperature = max_temperature
+        self.validate_rise = validate_rise
+        self.validate_secs = validate_secs
+        self.max_overshoot = max_overshoot
+        self.validate_retries = validate_retries
+        self.state = Autotuner.STATE_STEP
+        self.model = None
+        self.gains = None
+        self.overshoot = None
+        self.error = None
+        self._times = []
+        self._temps = []
+        self._started_at = None
+        self._pid = None
+        self._setpoint = None
+        self._validate_started_at = None
+        self._validate_max = None
+        self._retries_left = validate_retries
+
+    def update(self, now, temp):
+        "Processes a sample and returns the heater power to apply."
+        if self.state == Autotuner.STATE_STEP:
+            return self._step(now, temp)
+        elif self.state == Autotuner.STATE_VALIDATE:
+            return self._validate(now, temp)
+        return 0
+
+    def _step(self, now, temp):
+        if self._started_at is None:
+            self._started_at = now
+        self._times.append(now - self._started_at)
+        self._temps.append(temp)
+        if temp >= self.max_temperature or self._times[-1] >= self.max_step_secs or self._slope_decayed():
+            self._finish_step(temp)
+            return self.update(now, temp)
+        return self.step_power
+
+    def _slope_decayed(self):
+        # Checked once a minute on the last ten minutes of samples
+        if len(self._times) < 900 or len(self._times) % 60 != 0:
+            return False
+        try:
+            _, tau, dead_time = fit_fopdt(self._times, self._temps, self.step_power)
+        except ValueError:
+            return False
+        return tau < Autotuner.MAX_TIME_CONSTANT and self._times[-1] > dead_time + tau * math.log(1 / Autotuner._SLOPE_DECAY_END)
+
+    def _finish_step(self, temp):
+        try:
+            self.model = fit_fopdt(self._times, self._temps, self.step_power)
+            self.gains = cohen_coon(*self.model)
+        except (ValueError, ZeroDivisionError) as e:
+            self._fail("Model fitting failed: " + str(e))
+            return
+        logging.info("Autotune model (gain, tau, dead time): %s, gains: %s", self.model, self.gains)
+        self._times = []
+        self._temps = []
+        self._start_validation(temp)
+
+    def _start_validation(self, temp):
+        self.state = Autotuner.STATE_VALIDATE
+        self._pid = PID(*self.gains)
+        self._setpoint = min(temp + self.validate_rise, self.max_temperature)
+        self._pid.SetPoint = self._setpoint
+        self._validate_started_at = None
+        self._validate_max = temp
+
+    def _validate(self, now, temp):
+        if self._validate_started_at is None:
+            self._validate_started_at = now
+        self._validate_max = max(self._validate_max, temp)
+        if temp > self.max_temperature + self.max_overshoot:
+            self._fail("Maximum temperature exceeded during validation")
+            return 0
+        if now - self._validate_started_at >= self.validate_secs:
+            self.overshoot = max(self._validate_max - self._setpoint, 0)
+            if self.overshoot <= self.max_overshoot:
+                self.state = Autotuner.STATE_DONE
+                logging.info("Autotune validated with overshoot %.1f, gains: %s", self.overshoot, self.gains)
+                return 0
+            if self._retries_left == 0:
+                self._fail("Overshoot %.1f too large" % self.overshoot)
+                return 0
+            self._retries_left -= 1
+            self.gains = tuple(g * Autotuner._DETUNE_FACTOR for g in self.gains)
+            logging.info("Autotune overshoot %.1f too large, detuned gains: %s", self.overshoot, self.gains)
+            self._start_validation(temp)
+            return self.update(now, temp)
+        self._pid.update(round(temp))
+        return min(max(self._pid.output, 0), 100)
+
+    def _fail(self, error):
+        logging.error("Autotune failed: %s", error)
+        self.error = error
+        self.state = Autotuner.STATE_FAILED
+
+    def get_status(self):
+        "Returns the status of the run as a dictionary."
+        ret = {"state": self.state}
+        if self.model is not None:
+            ret["model"] = {"gain": self.model[0], "time_constant": self.model[1], "dead_time": self.model[2]}
+        if self.gains is not None:
+            ret["gains"] = {"proportional": self.gains[0], "integral": self.gains[1], "derivative": self.gains[2]}
+        if self.overshoot is not None:
+            ret["overshoot"] = self.overshoot
+        if self.error is not None:
+            ret["error"] = self.error
+        return ret
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+def get_gain_store(filename):
+    "Returns the shared gain store of the file, so vessels do not overwrite each other's gains."
+    with _STORES_LOCK:
+        if filename not in _STORES:
+            _STORES[filename] = PidGainStore(filename)
+        return _STORES[filename]
@@ -0,0 +1,329 @@
+"""What-if planning: predicts the timeline of a brew without touching the devices.
+
+A headless Brewery and BrewProcess run on a VirtualClock, with the thermistors
+reading a PlantModel instead of the MCP3208: the vessels are heated with the
+power of the jam makers ([heaters]) and lose heat to the ambient, the pumps move
+the liquid with the configured rates, the chiller cools the boiler while its
+valve is open. The brewer's actions (pauses and manual
+transfers) are taken [planner] OperatorSecs after they are asked for. The water
+is filled as the flow of the recipe tells (flows.py), or as [process] MashStart.
+
+The simulation replaces the global configuration and clock, so the Planner runs
+it in a separate process. Results are cached by the hash of the recipe and the
+configuration.
+
+    python planner.py recipe.json --set process.TransferMode=MANUAL
+"""
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+
+import brewery
+import config
+import flows
+import history
+import lowlevel
+import process
+import recipes
+import telemetry
+import topology
+import utils
+
+# J/(kg*K), a liter of wort is taken as a kilogram of water
+HEAT_CAPACITY = 4186.0
+
+# Time constant of an uncovered thermistor reaching the temperature of the air
+_PROBE_AIR_SECS = 30.0
+
+# Transfers made by the brewer in manual transfer mode when leaving a stage:
+# (from, to, part of the liquid in the source)
+_MANUAL_TRANSFERS = {
+    'MASHING_BOIL_TO_MASH': [('boiler', 'mashtun', 1.0), ('temporary', 'boiler', 1.0)],
+    'SPARGE_MASH_TO_TEMP_1': [('mashtun', 'temporary', 1.0), ('boiler', 'mashtun', 0.5)],
+    'SPARGE_MASH_TO_TEMP_2': [('mashtun', 'temporary', 1.0), ('boiler', 'mashtun', 1.0), ('temporary', 'boiler', 1.0)],
+    'SPARGE_MASH_TO_TEMP_3': [('mashtun', 'boiler', 1.0)],
+}
+
+class Vessel(object):
+    "Liquid in a vessel of the model."
+
+    def __init__(self, temperature):
+        self.liters = 0.0
+        self.temperature = temperature
+
+    def add(self, liters, temperature):
+        if liters <= 0:
+            return
+        total = self.liters + liters
+        self.temperature = (self.temperature * self.liters + temperature * liters) / total
+        self.liters = total
+
+    def take(self, liters):
+        "Removes at most liters, returns the amount removed."
+        liters = min(liters, self.liters)
+        self.liters -= liters
+        return liters
+
+class ModelAdc(object):
+    "Replaces an MCP3208 channel: value is the ADC value of the temperature of a vessel of the model."
+
+    def __init__(self, vessel):
+        self._vessel = vessel
+
+    @property
+    def value(self):
+        return lowlevel.celsius_to_adc(self._vessel.temperature)
+
+class PlantModel(object):
+    """Thermal and hydraulic model of the brewery. The vessels are mixed ideally,
+    the heaters work with their average power and boiling stops the temperature
+    at 100 Celsius."""
+
+    def __init__(self, cfg):
+        self._cfg = cfg
+        self._brewery = None
+        self._recipe = None
+        self.vessels = dict((name, Vessel(cfg.planner_ambient_temperature)) for name in topology.parse(cfg.cp).vessels)
+
+    def attach(self, brwry, recipe):
+        "Connects the model to the devices and fills the water of the recipe as the brewer would."
+        self._brewery = brwry
+        self._recipe = recipe
+        ambient = self._cfg.planner_ambient_temperature
+        if recipe.flow is not None:
+            values = flows.values(recipe, self._cfg.sparging_temperature)
+            for vessel, liters in flows.get(recipe.flow).fill.items():
+                self.vessels[vessel].add(liters(values), ambient)
+        elif self._cfg.mash_start == 'BOILER':
+            self.vessels['boiler'].add(recipe.mash_water, ambient)
+            self.vessels['temporary'].add(recipe.sparge_water, ambient)
+        else:
+            self.vessels['mashtun'].add(recipe.mash_water, ambient)
+            self.vessels['boiler'].add(recipe.sparge_water, ambient)
+
+    def _flows(self):
+        b = self._brewery
+        for path in b.router.active().values():
+            if path.source == path.target or not b.pumps[path.pump].is_started():
+                continue
+            secs_per_liter = b.transfers.configured_seconds_per_liter(topology.route_name(path.source, path.target))
+            if secs_per_liter is not None:
+                yield path.source, path.target, secs_per_liter
+
+    def transfer(self, source, target, liters):
+        src = self.vessels[source]
+        self.vessels[target].add(src.take(liters), src.temperature)
+
+    def manual_transfers(self, stage_key):
+        "Makes the transfers the brewer is asked for when leaving a stage in manual transfer mode."
+        definition, step = getattr(process.BrewStages, stage_key).get(process.BrewStages.KEY_FLOW_STAGE, (None, None))
+        if definition is not None:
+            until = definition.until
+            if until.kind == flows.UNTIL_TRANSFER:
+                source, target = until.route
+                liters = self.vessels[source].liters if until.empty else \
+                    until.liters(flows.values(self._recipe, self._cfg.sparging_temperature, step))
+                self.transfer(source, target, liters)
+            return
+        if stage_key == 'MASHING_BOIL_TO_MASH' and self._cfg.mash_start != 'BOILER':
+            # Only the malt is infused
+            return
+        for source, target, part in _MANUAL_TRANSFERS.get(stage_key, []):
+            self.transfer(source, target, self.vessels[source].liters * part)
+
+    def step(self, secs):
+        "Advances the model. Returns the electric power of the heaters in watts."
+        for source, target, secs_per_liter in list(self._flows()):
+            self.transfer(source, target, secs / secs_per_liter)
+        ambient = self._cfg.planner_ambient_temperature
+        loss = self._cfg.planner_heat_loss_watts_per_kelvin
+        total = 0.0
+        for name, jm, watts in (('mashtun', self._brewery.mashtun, self._cfg.heater_mashtun_watts),
+                                ('boiler', self._brewery.boiler, self._cfg.heater_boiler_watts)):
+            power = watts * jm.get_power() / 100.0
+            total += power
+            vessel = self.vessels[name]
+            if vessel.liters < 0.5:
+                # The thermistor is not covered, it reads the heater plate or the air
+                air = (vessel.temperature - ambient) * min(1.0, secs / _PROBE_AIR_SECS)
+                vessel.temperature = min(100.0, vessel.temperature + power * secs / (0.5 * HEAT_CAPACITY) - air)
+                continue
+            heat = (power - loss * (vessel.temperature - ambient)) * secs
+            if name == 'boiler' and self._brewery.chiller is not None and self._brewery.chiller.is_valve_open():
+                heat -= self._cfg.planner_chiller_watts_per_kelvin * (vessel.temperature - self._cfg.cooling_coolant_temperature) * secs
+            vessel.temperature = min(100.0, vessel.temperature + heat / (vessel.liters * HEAT_CAPACITY))
+        return total
+
+def simulate(recipe_dict, sections):
+    """Simulates a brew and returns the predicted timeline as a dictionary.
+
+    Replaces the global configuration and clock: must be called in a process of its own."""
+    # The relays of the simulated devices must never switch the real ones
+    os.environ['GPIOZERO_PIN_FACTORY'] = 'mock'
+
+    config.config.load_dict(sections)
+    cfg = config.config.current
+    recipe = recipes.from_dict(recipe_dict)
+    plan = process.compile_plan(recipe, cfg)
+    clock = utils.VirtualClock(0.0)
+    utils.clock = clock
+
+    model = PlantModel(cfg)
+    brwry = brewery.Brewery(mashtun_adc=ModelAdc(model.vessels['mashtun']), boiler_adc=ModelAdc(model.vessels['boiler']))
+    model.attach(brwry, recipe)
+    # The flow model learned on the rig is used, but not taught by the simulation
+    brwry.transfers.learn = False
+    prcss = process.BrewProcess(recipe)
+    prcss.actor = brwry
+    brwry.process = prcss
+
+    operator = set(process.operator_stages(cfg.transfer_mode, cfg.pause, flows.get(recipe.flow) if recipe.flow is not None else None))
+    stages = []
+    human = []
+    last_message = [None]
+
+    def listener(event):
+        if event.kind == telemetry.EVENT_NOTIFICATION:
+            last_message[0] = event.data['message']
+        elif event.kind == telemetry.EVENT_STATUS and event.data['status'] == 'running':
+            key = history.stage_key(event.data['current_stage'])
+            if not stages or stages[-1][1] != key:
+                stages.append((clock.time(), key))
+                if key in operator:
+                    human.append({'stage': key, 'at': clock.time(), 'message': last_message[0]})
+
+    telemetry.hub.add_listener(listener)
+    telemetry.hub.add_listener(brwry.energy.listener)
+    step = cfg.planner_step_secs
+    peak_watts, peak_at, joules = 0.0, 0.0, 0.0
+    complete = False
+    advanced = 0
+    prcss.start()
+    while clock.time() < cfg.planner_max_hours * 3600:
+        now = clock.time()
+        clock.run_until(now + step)
+        watts = model.step(step)
+        joules += watts * step
+        if watts > peak_watts:
+            peak_watts, peak_at = watts, now
+        if stages and stages[-1][1] in operator and advanced < len(stages) and \
+                clock.time() - stages[-1][0] >= cfg.planner_operator_secs:
+            advanced = len(stages)
+            if cfg.transfer_mode == 'MANUAL':
+                model.manual_transfers(stages[-1][1])
+            prcss.next()
+        if stages and prcss.get_status_snapshot().status == 'stopped':
+            complete = True
+            break
+    end = clock.time()
+    prcss.stop()
+    telemetry.hub.remove_listener(listener)
+    telemetry.hub.remove_listener(brwry.energy.listener)
+    used = brwry.energy.get_status()['brew']
+    stage_kwh = dict((entry.pop('stage'), entry) for entry in used['stages'])
+
+    timeline = []
+    for (started, key), (ended, _) in zip(stages, stages[1:] + [(end, None)]):
+        name = getattr(process.BrewStages, key)[process.BrewStages.KEY_NAME]
+        timeline.append({'stage': key, 'name': name, 'start': started, 'seconds': ended - started,
+                         'estimated_seconds': plan.seconds.get(name), 'kwh': stage_kwh.get(name, {})})
+    return {'complete': complete, 'total_seconds': end, 'estimated_seconds': plan.total_seconds,
+            'stages': timeline, 'human_needed': human,
+            'peak_power_watts': peak_watts, 'peak_power_at': peak_at, 'energy_kwh': joules / 3.6e6,
+            'vessel_kwh': used['kwh']}
+
+def merge_config(sections, overrides):
+    """Returns the configuration sections with the overrides ({section: {key: value}})
+    applied. Raises ValueError if the result is not a valid configuration."""
+    merged = dict((section, dict(values)) for section, values in sections.items())
+    for section, values in (overrides or {}).items():
+        if not isinstance(values, dict):
+            raise ValueError("Overrides of section " + str(section) + " must be an object")
+        merged.setdefault(section, {}).update((key.lower(), str(value)) for key, value in values.items())
+    config.ConfigSnapshot.from_dict(merged)
+    return merged
+
+class Planner(object):
+    """Runs the simulations in a worker process, one at a time, and caches the results
+    by the hash of the recipe and the configuration. A simulation which is still
+    running for the same input is shared by the callers."""
+
+    def __init__(self, cache_size, timeout):
+        self._cache_size = cache_size
+        self._timeout = timeout
+        self._cache = collections.OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def plan(self, recipe, overrides=None):
+        """Returns the predicted timeline of the recipe with the current configuration and the
+        overrides. Raises ValueError for an invalid recipe or configuration, and
+        concurrent.futures.TimeoutError if the simulation takes longer than the timeout;
+        its result is cached when it is ready."""
+        recipe.validate()
+        sections = merge_config(config.config.as_dict(), overrides)
+        key = hashlib.sha256(json.dumps({'recipe': recipe.to_dict(), 'config': sections}, sort_keys=True).encode()).hexdigest()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return dict(self._cache[key], key=key, cached=True)
+            future = self._pending.get(key)
+            if future is None:
+                if self._executor is None:
+                    # spawn: the worker must not inherit the threads and devices of the server
+                    self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+                future = self._executor.submit(simulate, recipe.to_dict(), sections)
+                self._pending[key] = future
+                future.add_done_callback(lambda f: self._done(key, f))
+        return dict(future.result(timeout=self._timeout), key=key, cached=False)
+
+    def _done(self, key, future):
+        with self._lock:
+            self._pending.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            self._cache[key] = future.result()
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates a brew and prints the predicted timeline.")
+    parser.add_argument("recipe", nargs="?", help="BeerXML or JSON recipe file, the [recipe] section by default")
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.KEY=VALUE", help="Configuration override")
+    parser.add_argument("--format", default="text", choices=["text", "json"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    recipe = recipes.load_file(args.recipe)[0] if args.recipe else recipes.from_config()
+    overrides = {}
+    for item in args.set:
+        name, _, value = item.partition("=")
+        section, _, key = name.partition(".")
+        overrides.setdefault(section, {})[key] = value
+    result = simulate(recipe.to_dict(), merge_config(config.config.as_dict(), overrides))
+    if args.format == "json":
+        sys.stdout.write(json.dumps(result, indent=2) + "\n")
+        return
+    print("%-32s %9s %9s %9s %9s" % ("STAGE", "START", "SECONDS", "ESTIMATE", "KWH"))
+    for row in result['stages']:
+        print("%-32s %9.0f %9.0f %9s %9.2f" % (row['stage'], row['start'], row['seconds'],
+                                               '-' if row['estimated_seconds'] is None else "%.0f" % row['estimated_seconds'],
+                                               sum(row['kwh'].values())))
+    print("total: %.0f s (%s), estimated %.0f s" % (result['total_seconds'], "complete" if result['complete'] else "incomplete",
+                                                  result['estimated_seconds']))
+    print("peak power: %.0f W at %.0f s, energy: %.2f kWh (%s)" % (
+        result['peak_power_watts'], result['peak_power_at'], result['energy_kwh'],
+        ", ".join("%s %.2f kWh" % item for item in sorted(result['vessel_kwh'].items()))))
+    for point in result['human_needed']:
+        print("brewer needed at %.0f s (%s): %s" % (point['at'], point['stage'], point['message']))
+
+if __name__ == "__main__":
+    main()
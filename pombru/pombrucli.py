@@ -1,10 +1,11 @@
 import argparse
+import json
 import requests
 
 API_BASE = "http://localhost:5000/pombru/api/v1"
 CT_FORM = {"Content-Type": "application/x-www-form-urlencoded"}
 
-def jammaker_command(jammaker, command, parameter=None):
+def jammaker_command(jammaker, command, parameter=None, volume=None):
     url = API_BASE + "/" + jammaker
     res = None
     data = ''
@@ -17,6 +18,11 @@ def jammaker_command(jammaker, command, parameter=None):
     elif command == 'target':
         res = requests.put(url, headers=CT_FORM, data="mode=controlled&target=" + str(parameter))
         data="mode=controlled&target=" + str(parameter)
+    elif command == 'autotune':
+        data = "mode=autotune"
+        if volume is not None:
+            data += "&volume=" + str(volume)
+        res = requests.put(url, headers=CT_FORM, data=data)
     print(data)
     print(res.json() if res is not None else "ERR: unknown command '" + command + "'")
 
@@ -39,18 +45,14 @@ def process_command(command, stage=None):
 
 def all_command(command):
     if command == 'status':
+        status = requests.get(API_BASE + "/status").json()
         print("PROCESS:")
-        process_command('status')
-        print("MASH TUN:")
-        jammaker_command('mashtun', 'status')
-        twvalve_command('mashtunvalve', 'status')
-        pump_command('mashtunpump', 'status')
-        print("BOILER:")
-        jammaker_command('boiler', 'status')
-        twvalve_command('boilervalve', 'status')
-        pump_command('boilerpump', 'status')
-        print("TEMPORARY:")
-        pump_command('temppump', 'status')
+        print(status.pop('process'))
+        print("ROUTES:")
+        print(status.pop('routes'))
+        for name in sorted(status):
+            print(name.upper() + ":")
+            print(status[name])
 
 def twvalve_command(valve, command, target=None):
     url = API_BASE + "/" + valve
@@ -72,6 +74,37 @@ def pump_command(pump, command):
         res = requests.put(url, headers=CT_FORM, data="status=off")
     print(res.json() if res is not None else "ERR: unknown command '" + command + "'")
 
+def topology_command(command, routes=None):
+    url = API_BASE + '/topology'
+    res = None
+    if command == 'status':
+        res = requests.get(url)
+    elif command == 'plan':
+        res = requests.get(url, params={'routes': routes})
+    print(res.json() if res is not None else "ERR: unknown command '" + command + "'")
+
+def flow_command(command):
+    url = API_BASE + '/flows'
+    res = None
+    if command == 'list':
+        res = requests.get(url)
+    print(res.json() if res is not None else "ERR: unknown command '" + command + "'")
+
+def fermentation_command(command, target=None, since=None):
+    url = API_BASE + '/fermentation'
+    res = None
+    if command == 'status':
+        res = requests.get(url)
+    elif command == 'start':
+        res = requests.put(url, headers=CT_FORM, data='command=start' + ('&target=' + str(target) if target is not None else ''))
+    elif command == 'target':
+        res = requests.put(url, headers=CT_FORM, data='command=target' + ('&target=' + str(target) if target is not None else ''))
+    elif command == 'stop':
+        res = requests.put(url, headers=CT_FORM, data='command=stop')
+    elif command == 'samples':
+        res = requests.get(url + '/samples', params={'since': since} if since is not None else None)
+    print(res.json() if res is not None else "ERR: unknown command '" + command + "'")
+
 def config_command(command):
     url = API_BASE + '/config'
     res = None
@@ -95,6 +128,63 @@ def notify_command(command):
         return
     print(res.json() if res is not None else "ERR: unknown command '" + command + "'")
 
+def watchdog_command(command):
+    url = API_BASE + '/watchdog'
+    res = None
+    if command == 'status':
+        res = requests.get(url)
+    elif command == 'clear':
+        res = requests.put(url, headers=CT_FORM, data='command=clear')
+    print(res.json() if res is not None else "ERR: unknown command '" + command + "'")
+
+def history_command(command, brew=None, stage=None, vessel=None, volume=None, last=None):
+    url = API_BASE + '/history'
+    res = None
+    if command == 'list':
+        res = requests.get(url, params={'limit': last or 20})
+    elif command == 'show':
+        res = requests.get(url + '/' + str(brew))
+    elif command == 'stats':
+        params = {'stage': stage, 'vessel': vessel or 'mashtun', 'last': last or 20}
+        if volume is not None:
+            params['liters'] = volume
+        res = requests.get(url + '/stats', params=params)
+    print(res.json() if res is not None else "ERR: unknown command '" + command + "'")
+
+def recipe_command(command, recipe=None, filename=None):
+    url = API_BASE + '/recipes'
+    res = None
+    if command == 'list':
+        res = requests.get(url)
+    elif command == 'show':
+        res = requests.get(url + '/' + recipe) if recipe else requests.get(API_BASE + '/recipe')
+    elif command == 'import':
+        with open(filename, 'rb') as f:
+            res = requests.post(url, data=f.read(), params={'format': 'beerxml' if filename.lower().endswith('.xml') else 'json'})
+    elif command == 'select':
+        res = requests.put(API_BASE + '/recipe', headers=CT_FORM, data='id=' + recipe)
+    elif command == 'delete':
+        res = requests.delete(url + '/' + recipe)
+        print(res.status_code)
+        return
+    print(res.json() if res is not None else "ERR: unknown command '" + command + "'")
+
+def plan_command(filename=None, recipe=None, overrides=None):
+    body = {}
+    if filename is not None:
+        with open(filename) as f:
+            body['recipe'] = json.load(f)
+    elif recipe is not None:
+        body['recipe_id'] = recipe
+    if overrides:
+        body['config'] = {}
+        for item in overrides:
+            name, _, value = item.partition('=')
+            section, _, key = name.partition('.')
+            body['config'].setdefault(section, {})[key] = value
+    res = requests.post(API_BASE + '/plan', json=body)
+    print(res.json())
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("object", help="The object on which the command is executed")
@@ -102,24 +192,51 @@ def main():
     parser.add_argument("--temperature", required=False, type=int, help="Temperature when setting a jam maker's temperature.")
     parser.add_argument("--stage", required=False, type=str, help="Target stage when continuing the process.")
     parser.add_argument("--target", required=False, help="Target for a two-way valve (mashtun or temporary)")
+    parser.add_argument("--routes", required=False, help="Routes for topology plan, e.g. boiler->mashtun,temporary->boiler")
+    parser.add_argument("--volume", required=False, type=float, help="Fill volume in liters when autotuning a jam maker or for history stats.")
+    parser.add_argument("--brew", required=False, type=int, help="Brew id for history show.")
+    parser.add_argument("--vessel", required=False, help="Vessel (mashtun or boiler) for history stats.")
+    parser.add_argument("--last", required=False, type=int, help="Number of last brews for history list and stats.")
+    parser.add_argument("--recipe", required=False, help="Recipe id for recipe show, select and delete.")
+    parser.add_argument("--file", required=False, help="BeerXML (.xml) or JSON file for recipe import, JSON recipe for plan.")
+    parser.add_argument("--set", action="append", metavar="SECTION.KEY=VALUE", help="Configuration override for plan.")
+    parser.add_argument("--since", required=False, type=float, help="First second (epoch) of the fermentation samples.")
     args = parser.parse_args()
 
     o = args.object
     c = args.command
-    if o in ['mashtun', 'boiler']:
-        jammaker_command(o, c, args.temperature)
+    devices = {}
+    if o not in ['process', 'all', 'topology', 'flow', 'config', 'notify', 'watchdog', 'history', 'recipe', 'plan', 'fermentation']:
+        # The jam makers, valves and pumps are named in the topology
+        devices = requests.get(API_BASE + '/topology').json()
+    if devices.get('vessels', {}).get(o, {}).get('heated'):
+        jammaker_command(o, c, args.temperature, args.volume)
     elif o == 'process':
         process_command(c, args.stage)
     elif o == 'all':
         all_command(c)
-    elif o in ['mashtunvalve', 'boilervalve']:
+    elif o in devices.get('valves', {}):
         twvalve_command(o, c, args.target)
-    elif o in ['mashtunpump', 'boilerpump', 'temppump']:
+    elif o in devices.get('pumps', {}):
         pump_command(o, c)
+    elif o == 'topology':
+        topology_command(c, args.routes)
+    elif o == 'flow':
+        flow_command(c)
     elif o == 'config':
         config_command(c)
     elif o == 'notify':
         notify_command(c)
+    elif o == 'watchdog':
+        watchdog_command(c)
+    elif o == 'history':
+        history_command(c, args.brew, args.stage, args.vessel, args.volume, args.last)
+    elif o == 'recipe':
+        recipe_command(c, args.recipe, args.file)
+    elif o == 'plan':
+        plan_command(args.file, args.recipe, args.set)
+    elif o == 'fermentation':
+        fermentation_command(c, args.temperature, args.since)
 
 if __name__ == "__main__":
     main()
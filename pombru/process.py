@@ -1,34 +1,56 @@
 "Module contains classes which manage the brewing process."
-import datetime
+import collections
 import functools
+import json
 import logging
 import threading
 from time import sleep
 import traceback
 from pushnoti import notify
 
+import brewtrace
 import config
+import flows
+import metrics
+import recipes
+import telemetry
+import topology
+import transfers
 import utils
 
 class BrewTask(object):
     "Describes a task during brewing."
-    SET_MASH_VALVE_TARGET_MASH = "SET_MASH_VALVE_TARGET_MASH"
-    SET_MASH_VALVE_TARGET_TEMP = "SET_MASH_VALVE_TARGET_TEMP"
-    START_MASH_PUMP = "START_MASH_PUMP"
-    STOP_MASH_PUMP = "STOP_MASH_PUMP"
+    # Param: comma separated route specifications, see topology.parse_route()
+    SET_ROUTES = "SET_ROUTES"
+    START_ROUTE = "START_ROUTE"
+    STOP_ROUTE = "STOP_ROUTE"
+    # Device commands of the routes, see topology.Router
+    SET_VALVE = topology.EVENT_SET_VALVE
+    START_PUMP = topology.EVENT_START_PUMP
+    STOP_PUMP = topology.EVENT_STOP_PUMP
     MASH_TARGET_TEMP = "MASH_TARGET_TEMP"
     BOIL_TARGET_TEMP = "BOIL_TARGET_TEMP"
     STOP_MASHING_TUN = "STOP_MASHING_TUN"
     STOP_BOIL_KETTLE = "STOP_BOIL_KETTLE"
+    ENGAGE_COOLING_VALVE = "ENGAGE_COOLING_VALVE"
+    STOP_COOLING_VALVE = "STOP_COOLING_VALVE"
+    RELEASE_ARM = "RELEASE_ARM"
+    MASH_FILL_VOLUME = "MASH_FILL_VOLUME"
+    BOIL_FILL_VOLUME = "BOIL_FILL_VOLUME"
+    # Param of PAUSE: [process] PauseHeaters, HOLD or IDLE
+    PAUSE = "PAUSE"
+    RESUME = "RESUME"
+    # Valve and pump commands of the fixed rig, in the brews recorded before [topology]
+    SET_MASH_VALVE_TARGET_MASH = "SET_MASH_VALVE_TARGET_MASH"
+    SET_MASH_VALVE_TARGET_TEMP = "SET_MASH_VALVE_TARGET_TEMP"
+    START_MASH_PUMP = "START_MASH_PUMP"
+    STOP_MASH_PUMP = "STOP_MASH_PUMP"
     START_TEMP_PUMP = "START_TEMP_PUMP"
     STOP_TEMP_PUMP = "STOP_TEMP_PUMP"
     START_BOIL_PUMP = "START_BOIL_PUMP"
     STOP_BOIL_PUMP = "STOP_BOIL_PUMP"
     SET_BOIL_VALVE_TARGET_MASH = "SET_BOIL_VALVE_TARGET_MASH"
     SET_BOIL_VALVE_TARGET_TEMP = "SET_BOIL_VALVE_TARGET_TEMP"
-    ENGAGE_COOLING_VALVE = "ENGAGE_COOLING_VALVE"
-    STOP_COOLING_VALVE = "STOP_COOLING_VALVE"
-    RELEASE_ARM = "RELEASE_ARM"
 
     def __init__(self, event, param=None):
         self.event = event
@@ -38,11 +60,13 @@ class BrewTask(object):
         return "BrewTask(" + self.event + ", " + str(self.param) + ")"
 
 class BrewStages(object):
-    "Name, mash stage, next stage."
+    "Name, mash stage, next stage. The stages of the flows also have their flows.FlowStage and mash step."
     KEY_NAME = "name"
     KEY_MASH_STAGE_NUM = "mash"
     KEY_NEXT_STAGE = "next"
-    BOIL = {KEY_NAME: "Boiling wort", KEY_MASH_STAGE_NUM: 0, KEY_NEXT_STAGE: None}
+    KEY_FLOW_STAGE = "flow_stage"
+    COOLING = {KEY_NAME: "Cooling wort", KEY_MASH_STAGE_NUM: 0, KEY_NEXT_STAGE: None}
+    BOIL = {KEY_NAME: "Boiling wort", KEY_MASH_STAGE_NUM: 0, KEY_NEXT_STAGE: COOLING}
     SPARGE_TEMP_TO_BOIL_2 = {KEY_NAME: "Transferring wort to boiling kettle", KEY_MASH_STAGE_NUM: 0, KEY_NEXT_STAGE: BOIL}
     SPARGE_MASH_TO_TEMP_3 = {KEY_NAME: "Sparging - transferring wort to temporary III.", KEY_MASH_STAGE_NUM: 0, KEY_NEXT_STAGE: SPARGE_TEMP_TO_BOIL_2}
     SPARGE_PAUSE_2 = {KEY_NAME: "Second pause while sparging", KEY_MASH_STAGE_NUM: 0, KEY_NEXT_STAGE: SPARGE_MASH_TO_TEMP_3}
@@ -65,6 +89,230 @@ class BrewStages(object):
     MASHING_PREPARE = {KEY_NAME: "Prepare for mashing - heat up for first step", KEY_MASH_STAGE_NUM: 0, KEY_NEXT_STAGE: MASHING_BOIL_TO_MASH}
     INITIAL = {KEY_NAME: "Initial stage", KEY_MASH_STAGE_NUM: 0, KEY_NEXT_STAGE: MASHING_PREPARE}
 
+    _lock = threading.Lock()
+
+    @classmethod
+    def mashing(cls, step):
+        """Returns the stage of a mash step. The stages after MASHING_4 are created
+        on first use, as MASHING_5, MASHING_6..."""
+        with cls._lock:
+            stage = getattr(cls, "MASHING_" + str(step), None)
+            if stage is None:
+                stage = {cls.KEY_NAME: "Mashing - step " + str(step) + ".", cls.KEY_MASH_STAGE_NUM: step,
+                         cls.KEY_NEXT_STAGE: cls.MASHING_PAUSE}
+                setattr(cls, "MASHING_" + str(step), stage)
+            return stage
+
+    @classmethod
+    def flow_stage(cls, definition, step=None):
+        """Returns the stage of a flows.FlowStage (of a mash step), created on first use
+        with the key of the definition, e.g. BIAB_MASH_1. Raises ValueError if the key or
+        the name is used by another stage."""
+        key = definition.stage_key(step)
+        name = definition.stage_name(step)
+        with cls._lock:
+            stage = getattr(cls, key, None)
+            if stage is None:
+                for other in vars(cls).values():
+                    if isinstance(other, dict) and other[cls.KEY_NAME] == name:
+                        raise ValueError("Stage name '%s' of %s is already used" % (name, key))
+                stage = {cls.KEY_NAME: name, cls.KEY_MASH_STAGE_NUM: 0, cls.KEY_NEXT_STAGE: None}
+                setattr(cls, key, stage)
+            elif not isinstance(stage, dict) or cls.KEY_FLOW_STAGE not in stage or stage[cls.KEY_NAME] != name:
+                raise ValueError("Stage %s is already defined" % key)
+            # The flows may have been loaded again
+            stage[cls.KEY_FLOW_STAGE] = (definition, step)
+            return stage
+
+class BrewPlan(object):
+    """Compiled timeline of a recipe: the stages in brewing order with their estimated
+    length in seconds. Plans are immutable and shared, see compile_plan()."""
+
+    __slots__ = ('stages', 'seconds', 'total_seconds', '_next', '_following')
+
+    def __init__(self, stages, seconds):
+        following = {}
+        total = 0
+        for stage in reversed(stages):
+            following[stage[BrewStages.KEY_NAME]] = total
+            total += seconds[stage[BrewStages.KEY_NAME]]
+        object.__setattr__(self, 'stages', tuple(stages))
+        object.__setattr__(self, 'seconds', seconds)
+        object.__setattr__(self, 'total_seconds', total)
+        object.__setattr__(self, '_next', dict((a[BrewStages.KEY_NAME], b) for a, b in zip(stages, stages[1:])))
+        object.__setattr__(self, '_following', following)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("BrewPlan is immutable")
+
+    def next_stage(self, stage):
+        "Returns the stage following the given one, with the mash steps of the recipe."
+        return self._next.get(stage[BrewStages.KEY_NAME], stage[BrewStages.KEY_NEXT_STAGE])
+
+    def following_seconds(self, stage):
+        "Estimated seconds of the stages after the given one."
+        return self._following.get(stage[BrewStages.KEY_NAME], 0)
+
+    def to_list(self):
+        return [{'stage': stage[BrewStages.KEY_NAME], 'seconds': self.seconds[stage[BrewStages.KEY_NAME]]} for stage in self.stages]
+
+def operator_stages(transfer_mode, pause, flow=None):
+    """Returns the keys of the stages which are left by the brewer (BrewProcess.next()),
+    not by a timer or a temperature. The stages of the flow (flows.Flow) if given."""
+    if flow is not None:
+        return [stage.key for stage in flow.stages if stage.is_operator(transfer_mode, pause)]
+    stages = ['MASHING_PAUSE', 'SPARGE_PAUSE_1', 'SPARGE_PAUSE_2'] if pause else []
+    if transfer_mode == 'MANUAL':
+        stages += ['MASHING_BOIL_TO_MASH', 'SPARGE_MASH_TO_TEMP_1', 'SPARGE_MASH_TO_TEMP_2', 'SPARGE_MASH_TO_TEMP_3']
+    return stages
+
+# Configuration values the plan depends on
+_PLAN_CONFIG = ('pump_seconds_per_liter_mash_to_temp', 'pump_seconds_per_liter_temp_to_boil',
+                'pump_seconds_per_liter_boil_to_temp', 'pump_seconds_per_liter_boil_to_mash',
+                'sparging_circulate_secs', 'sparging_temperature', 'cooling_enabled', 'cooling_celsius_per_minute',
+                'flows_directory')
+
+def compile_plan(recipe, cfg):
+    """Returns the BrewPlan of a recipe with a configuration snapshot. Raises ValueError
+    if the recipe is invalid. Plans are cached by the recipe content and the configuration."""
+    return _compile_plan(json.dumps(recipe.to_dict(), sort_keys=True), tuple(getattr(cfg, name) for name in _PLAN_CONFIG))
+
+@functools.lru_cache(maxsize=32)
+def _compile_plan(recipe_json, settings):
+    recipe = recipes.from_dict(json.loads(recipe_json))
+    recipe.validate()
+    cfg = dict(zip(_PLAN_CONFIG, settings))
+    if recipe.flow is not None:
+        stages, seconds = _flow_plan(recipe, flows.get(recipe.flow, cfg['flows_directory']), cfg)
+    else:
+        stages, seconds = _classic_plan(recipe, cfg)
+    for stage in stages:
+        if seconds[stage[BrewStages.KEY_NAME]] < 0:
+            raise ValueError("Negative duration of stage " + stage[BrewStages.KEY_NAME])
+    plan = BrewPlan(stages, seconds)
+    logging.info("Brew plan of %s compiled: %d stages, %d seconds", recipe.name or "recipe", len(stages), plan.total_seconds)
+    return plan
+
+def _pump_time(liters, seconds_per_liter, to_empty=True):
+    if to_empty:
+        # Pumping until the vessel is empty
+        return (liters - 1) * seconds_per_liter + 60
+    return liters * seconds_per_liter
+
+def _classic_plan(recipe, cfg):
+    "The stages and their estimated seconds of the classic sparge sequence."
+    stages = []
+    stage = BrewStages.INITIAL
+    while stage is not None:
+        if stage is BrewStages.MASHING_1:
+            stages.extend(BrewStages.mashing(step) for step in range(1, len(recipe.mash_stages) + 1))
+            stage = BrewStages.MASHING_PAUSE
+        stages.append(stage)
+        stage = stage[BrewStages.KEY_NEXT_STAGE]
+
+    seconds = dict((stage[BrewStages.KEY_NAME], 0) for stage in stages)
+    def put(stage, value):
+        seconds[stage[BrewStages.KEY_NAME]] = value
+    # Assumption: 30 seconds per degrees celsius while heating
+    put(BrewStages.MASHING_PREPARE, (recipe.mash_stages[0][0] - 20) / 2.0 * 60)
+    put(BrewStages.MASHING_BOIL_TO_MASH, _pump_time(recipe.mash_water, cfg['pump_seconds_per_liter_boil_to_mash']))
+    put(BrewStages.MASHING_TEMP_TO_BOIL, _pump_time(recipe.sparge_water, cfg['pump_seconds_per_liter_temp_to_boil']))
+    put(BrewStages.MASHING_1, recipe.mash_stages[0][1] * 60)
+    for step in range(2, len(recipe.mash_stages) + 1):
+        (prev_temp, _), (temp, minutes) = recipe.mash_stages[step - 2:step]
+        put(BrewStages.mashing(step), ((temp - prev_temp) / 2.0 + minutes) * 60)
+    sparge_half = _pump_time(recipe.sparge_water / 2.0, cfg['pump_seconds_per_liter_boil_to_mash'])
+    put(BrewStages.SPARGE_MASH_TO_TEMP_1, _pump_time(recipe.mash_water, cfg['pump_seconds_per_liter_mash_to_temp']))
+    put(BrewStages.SPARGE_BOIL_TO_MASH_1, sparge_half)
+    put(BrewStages.SPARGE_CIRCULATE_IN_MASH_1, cfg['sparging_circulate_secs'])
+    put(BrewStages.SPARGE_MASH_TO_TEMP_2, sparge_half)
+    put(BrewStages.SPARGE_BOIL_TO_MASH_2, sparge_half)
+    put(BrewStages.SPARGE_TEMP_TO_BOIL_1, _pump_time(recipe.mash_water + recipe.sparge_water / 2, cfg['pump_seconds_per_liter_temp_to_boil']))
+    put(BrewStages.SPARGE_CIRCULATE_IN_MASH_2, cfg['sparging_circulate_secs'])
+    put(BrewStages.SPARGE_MASH_TO_TEMP_3, sparge_half)
+    put(BrewStages.SPARGE_TEMP_TO_BOIL_2, _pump_time(recipe.mash_water + recipe.sparge_water, cfg['pump_seconds_per_liter_temp_to_boil']))
+    put(BrewStages.BOIL, ((100 - cfg['sparging_temperature']) / 2.0 + recipe.boiling_time) * 60)
+    if cfg['cooling_enabled']:
+        put(BrewStages.COOLING, (100 - recipe.pitch_temperature) / cfg['cooling_celsius_per_minute'] * 60)
+    return stages, seconds
+
+def _flow_plan(recipe, flow, cfg):
+    """The stages and their estimated seconds of a flow: a stage per mash step of the
+    recipe in the for_each stages, the cooling is left out if it is disabled."""
+    stages = [BrewStages.INITIAL]
+    seconds = {BrewStages.INITIAL[BrewStages.KEY_NAME]: 0}
+    # The last target temperature of the vessels, heating is estimated from it, the
+    # transfers carry it
+    targets = collections.defaultdict(lambda: 20)
+    for definition in flow.stages:
+        until = definition.until
+        if until.kind == flows.UNTIL_COOLED and not cfg['cooling_enabled']:
+            continue
+        for step in (range(1, len(recipe.mash_stages) + 1) if definition.for_each else [None]):
+            values = flows.values(recipe, cfg['sparging_temperature'], step)
+            heating = {}
+            for action in definition.actions:
+                if action.kind == flows.ACTION_HEAT:
+                    to = action.to(values)
+                    # Assumption: 30 seconds per degrees celsius while heating
+                    heating[action.vessel] = max(0, to - targets[action.vessel]) / 2.0 * 60
+                    targets[action.vessel] = to
+            if until.kind == flows.UNTIL_SECONDS:
+                secs = until.value(values)
+            elif until.kind == flows.UNTIL_REACHED:
+                secs = heating[until.vessel] + (until.hold(values) if until.hold is not None else 0)
+            elif until.kind == flows.UNTIL_TRANSFER:
+                targets[until.route[1]] = targets[until.route[0]]
+                secs = _pump_time(until.liters(values), cfg[transfers.SECONDS_PER_LITER_CONFIG[topology.route_name(*until.route)]],
+                                  until.empty)
+            elif until.kind == flows.UNTIL_COOLED:
+                secs = max(0, targets['boiler'] - recipe.pitch_temperature) / cfg['cooling_celsius_per_minute'] * 60
+            else:
+                secs = 0
+            stage = BrewStages.flow_stage(definition, step)
+            stages.append(stage)
+            seconds[stage[BrewStages.KEY_NAME]] = secs
+    return stages, seconds
+
+class ProcessStatus(object):
+    """Immutable snapshot of the process state.
+
+    A new snapshot is published by the process on every state change, readers get
+    a consistent view without locking. The version is increased with every
+    snapshot, clients can use it for change detection. The remaining times do not
+    decrease while the process is paused (paused_at is set)."""
+
+    __slots__ = ('version', 'status', 'stage', 'stage_started_at', 'stage_seconds', 'following_seconds', 'paused_at')
+
+    def __init__(self, version, status, stage, stage_started_at, stage_seconds, following_seconds, paused_at=None):
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'status', status)
+        object.__setattr__(self, 'stage', stage)
+        object.__setattr__(self, 'stage_started_at', stage_started_at)
+        object.__setattr__(self, 'stage_seconds', stage_seconds)
+        object.__setattr__(self, 'following_seconds', following_seconds)
+        object.__setattr__(self, 'paused_at', paused_at)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ProcessStatus is immutable")
+
+    def _elapsed(self, now):
+        if self.stage_started_at is None:
+            return 0
+        if self.paused_at is not None:
+            now = self.paused_at
+        elif now is None:
+            now = utils.utcnow()
+        return (now - self.stage_started_at).seconds
+
+    def stage_remaining(self, now=None):
+        "Remaining time of the current stage in seconds."
+        return self.stage_seconds - self._elapsed(now)
+
+    def process_remaining(self, now=None):
+        "Remaining time of the whole process in seconds."
+        return self.stage_seconds + self.following_seconds - self._elapsed(now)
+
 class BrewProcess(object):
     "Manages a process of the whole brewing."
 
@@ -72,64 +320,92 @@ class BrewProcess(object):
         self.recipe = recipe
         self._timers = []
         self.actor = None
-        self._lock = threading.RLock()
+        self._lock = metrics.InstrumentedLock("process")
         self._brewing_stage = BrewStages.INITIAL
         self._sparging_water_ready = False
+        # Flows: the target temperatures set by the stages, and if the current stage holds one
+        self._flow_targets = {}
+        self._flow_holding = False
         self._stage_minutes = {}
         self._brewing_stage_started_at = None
         self._paused_at = None
+        # Callbacks arrived while paused, called by cont(): (callback, args)
+        self._deferred = []
+        self._status = None
+        self._plan = None
         self.reload_config()
-        self._calculate_stage_minutes()
+        self._compile_plan()
+        self._publish_status()
+
+    _PROCESS_CONFIG = frozenset(['pump_seconds_per_liter_mash_to_temp', 'pump_seconds_per_liter_temp_to_boil',
+                                 'pump_seconds_per_liter_boil_to_temp', 'pump_seconds_per_liter_boil_to_mash',
+                                 'sparging_temperature', 'sparging_circulate_secs',
+                                 'cooling_enabled', 'cooling_celsius_per_minute'])
 
     def reload_config(self):
-        self._pump_seconds_per_liter_mash_to_temp = config.config.pump_seconds_per_liter_mash_to_temp
-        self._pump_seconds_per_liter_temp_to_boil = config.config.pump_seconds_per_liter_temp_to_boil
-        self._pump_seconds_per_liter_boil_to_temp = config.config.pump_seconds_per_liter_boil_to_temp
-        self._pump_seconds_per_liter_boil_to_mash = config.config.pump_seconds_per_liter_boil_to_mash
-        self._sparging_temperature = config.config.sparging_temperature
-        self._sparging_circulate_secs = config.config.sparging_circulate_secs
-
-    def _calculate_stage_minutes(self):
-        self._stage_minutes[BrewStages.INITIAL["name"]] = 0
-        def mashtime(recipe, mashstage):
-            if mashstage > len(recipe.mash_stages):
-                return 0
-            start = 20
-            if mashstage > 1:
-                start = recipe.mash_stages[mashstage - 2][0]
-            # Assumption: 30 seconds per degrees celsius
-            return ((recipe.mash_stages[mashstage - 1][0] - start) / 2.0 + recipe.mash_stages[mashstage - 1][1]) * 60
-        self._stage_minutes[BrewStages.MASHING_PREPARE["name"]] = (self.recipe.mash_stages[0][0] - 20) / 2.0
-        self._stage_minutes[BrewStages.MASHING_BOIL_TO_MASH["name"]] = (self.recipe.mash_water - 1) * self._pump_seconds_per_liter_boil_to_mash + 60
-        self._stage_minutes[BrewStages.MASHING_TEMP_TO_BOIL["name"]] = (self.recipe.sparge_water - 1) * self._pump_seconds_per_liter_temp_to_boil + 60
-        self._stage_minutes[BrewStages.MASHING_1["name"]] = self.recipe.mash_stages[0][1] * 60
-        self._stage_minutes[BrewStages.MASHING_2["name"]] = mashtime(self.recipe, 2)
-        self._stage_minutes[BrewStages.MASHING_3["name"]] = mashtime(self.recipe, 3)
-        self._stage_minutes[BrewStages.MASHING_4["name"]] = mashtime(self.recipe, 4)
-        self._stage_minutes[BrewStages.MASHING_PAUSE["name"]] = 0
-        self._stage_minutes[BrewStages.WAIT_FOR_SPARGING_WATER["name"]] = 0
-        self._stage_minutes[BrewStages.SPARGE_MASH_TO_TEMP_1["name"]] = (self.recipe.mash_water - 1) * self._pump_seconds_per_liter_mash_to_temp + 60
-        self._stage_minutes[BrewStages.SPARGE_BOIL_TO_MASH_1["name"]] = (self.recipe.sparge_water / 2.0 - 1) * self._pump_seconds_per_liter_boil_to_mash + 60
-        self._stage_minutes[BrewStages.SPARGE_CIRCULATE_IN_MASH_1["name"]] = self._sparging_circulate_secs
-        self._stage_minutes[BrewStages.SPARGE_PAUSE_1["name"]] = 0
-        self._stage_minutes[BrewStages.SPARGE_MASH_TO_TEMP_2["name"]] = self._stage_minutes[BrewStages.SPARGE_BOIL_TO_MASH_1["name"]]
-        self._stage_minutes[BrewStages.SPARGE_BOIL_TO_MASH_2["name"]] = self._stage_minutes[BrewStages.SPARGE_BOIL_TO_MASH_1["name"]]
-        self._stage_minutes[BrewStages.SPARGE_TEMP_TO_BOIL_1["name"]] = (self.recipe.mash_water + self.recipe.sparge_water/2 - 1) * self._pump_seconds_per_liter_temp_to_boil + 60
-        self._stage_minutes[BrewStages.SPARGE_CIRCULATE_IN_MASH_2["name"]] = self._stage_minutes[BrewStages.SPARGE_CIRCULATE_IN_MASH_1["name"]]
-        self._stage_minutes[BrewStages.SPARGE_PAUSE_2["name"]] = 0
-        self._stage_minutes[BrewStages.SPARGE_MASH_TO_TEMP_3["name"]] = self._stage_minutes[BrewStages.SPARGE_BOIL_TO_MASH_1["name"]]
-        self._stage_minutes[BrewStages.SPARGE_TEMP_TO_BOIL_2["name"]] = (self.recipe.mash_water + self.recipe.sparge_water - 1) * self._pump_seconds_per_liter_temp_to_boil + 60
-        self._stage_minutes[BrewStages.BOIL["name"]] = ((100 - self._sparging_temperature) / 2.0 + self.recipe.boiling_time) * 60
-        logging.info("Stage minutes: " + str(self._stage_minutes))
-
-    _MASH_VALVE_TO_MASH = "_MASH_VALVE_TO_MASH"
-    _MASH_VALVE_TO_TEMP = "_MASH_VALVE_TO_TEMP"
-    _BOIL_VALVE_TO_MASH = "_BOIL_VALVE_TO_MASH"
-    _BOIL_VALVE_TO_TEMP = "_BOIL_VALVE_TO_TEMP"
+        cfg = config.config.current
+        self._pump_seconds_per_liter_mash_to_temp = cfg.pump_seconds_per_liter_mash_to_temp
+        self._pump_seconds_per_liter_temp_to_boil = cfg.pump_seconds_per_liter_temp_to_boil
+        self._pump_seconds_per_liter_boil_to_temp = cfg.pump_seconds_per_liter_boil_to_temp
+        self._pump_seconds_per_liter_boil_to_mash = cfg.pump_seconds_per_liter_boil_to_mash
+        self._sparging_temperature = cfg.sparging_temperature
+        self._sparging_circulate_secs = cfg.sparging_circulate_secs
+
+    def config_changed(self, old, new, changed):
+        "Configuration subscriber: reapplies the pump and sparging settings if they changed."
+        if changed & BrewProcess._PROCESS_CONFIG:
+            self.reload_config()
+            with self._lock:
+                # The time of the current stage may have been adjusted while brewing
+                current = self._stage_minutes[self._brewing_stage["name"]]
+                self._compile_plan()
+                if self._brewing_stage is not BrewStages.INITIAL:
+                    self._stage_minutes[self._brewing_stage["name"]] = current
+                self._publish_status()
+
+    def _compile_plan(self):
+        "Compiles the plan of the recipe and resets the stage times to it."
+        self._plan = compile_plan(self.recipe, config.config.current)
+        self._stage_minutes = dict(self._plan.seconds)
+        logging.info("Stage seconds: %s", self._stage_minutes)
+
+    def get_plan(self):
+        "Returns the BrewPlan of the current recipe."
+        return self._plan
+
+    def set_recipe(self, recipe):
+        "Replaces the recipe. Raises ValueError if the recipe is invalid or the process is running."
+        with self._lock:
+            if self._brewing_stage is not BrewStages.INITIAL:
+                raise ValueError("The recipe cannot be changed while brewing")
+            # Compiling first, so an invalid recipe changes nothing
+            compile_plan(recipe, config.config.current)
+            self.recipe = recipe
+            self._compile_plan()
+            logging.info("Recipe: %s", recipe)
+            self._publish_status()
+
+    # Transfer routes: (source, target[, pump work-idle distribution])
+    _ROUTE_MASH_CIRCULATE = ('mashtun', 'mashtun', 'MASH_DISTRIBUTION')
+    _ROUTE_SPARGE_CIRCULATE = ('mashtun', 'mashtun', 'SPARGE_DISTRIBUTION')
+    _ROUTE_MASH_TO_TEMP = ('mashtun', 'temporary')
+    _ROUTE_TEMP_TO_BOIL = ('temporary', 'boiler')
+    _ROUTE_BOIL_TO_TEMP = ('boiler', 'temporary')
+    _ROUTE_BOIL_TO_MASH = ('boiler', 'mashtun')
+
+    # Fill volume, target temperature and stop tasks of the heaters, for the flows
+    _HEATER_TASKS = {'mashtun': (BrewTask.MASH_FILL_VOLUME, BrewTask.MASH_TARGET_TEMP, BrewTask.STOP_MASHING_TUN),
+                     'boiler': (BrewTask.BOIL_FILL_VOLUME, BrewTask.BOIL_TARGET_TEMP, BrewTask.STOP_BOIL_KETTLE)}
 
     def start(self):
         "Starts the brewing process."
-        self._enter_stage(BrewStages.INITIAL["next"])
+        brewtrace.tracer.clear(utils.utcnow().strftime("%Y%m%d-%H%M%S"))
+        if self.recipe.flow is not None:
+            flow = flows.get(self.recipe.flow)
+            values = flows.values(self.recipe, self._sparging_temperature)
+            notify("Brewing with the flow %s, the water: %s" % (flow.name, ", ".join(
+                "%g L in the %s" % (liters(values), vessel) for vessel, liters in sorted(flow.fill.items()))))
+        self._enter_stage(self._next_stage(BrewStages.INITIAL))
         # Set up timer to start heating the sparging water
 
         # Commented out, does not work with python3:
@@ -140,15 +416,39 @@ class BrewProcess(object):
         self._reset()
 
     def pause(self):
-        "Pauses the brewing."
-        # TODO
-        pass
+        """Pauses the brewing: the timers are frozen, the pumps are stopped and the heaters
+        hold their targets or are off, as [process] PauseHeaters tells. cont() continues
+        where the brewing stopped."""
+        with self._lock:
+            if self._brewing_stage is BrewStages.INITIAL or self._paused_at is not None:
+                return
+            self._paused_at = utils.utcnow()
+            for timer in self._timers:
+                timer.pause()
+            self.actor.task(BrewTask(BrewTask.PAUSE, config.config.current.pause_heaters))
+            brewtrace.tracer.instant("paused", brewtrace.CATEGORY_STAGE)
+            self._publish_status()
 
     def cont(self):
-        pass
+        "Continues the paused brewing. The paused time is added to the stage and the timers."
+        with self._lock:
+            if self._paused_at is None:
+                return
+            self.actor.task(BrewTask(BrewTask.RESUME))
+            if self._brewing_stage_started_at is not None:
+                self._brewing_stage_started_at += utils.utcnow() - self._paused_at
+            self._paused_at = None
+            for timer in self._timers:
+                timer.resume()
+            brewtrace.tracer.instant("resumed", brewtrace.CATEGORY_STAGE)
+            self._publish_status()
+            deferred, self._deferred = self._deferred, []
+            for callback, args in deferred:
+                callback(*args)
 
     def cont_with(self, stage):
         with self._lock:
+            self._leave_pause()
             for timer in self._timers:
                 timer.cancel()
             self._timers = []
@@ -156,11 +456,30 @@ class BrewProcess(object):
         self._enter_stage(stage)
 
     def next(self):
+        with self._lock:
+            self._leave_pause()
         for timer in self._timers:
             timer.cancel()
         self._timers = []
         self._enter_stage(self._next_stage(self._brewing_stage))
 
+    def _leave_pause(self):
+        "Ends a pause for another stage: the paused routes are dropped, the heaters and the chiller resume."
+        if self._paused_at is None:
+            return
+        self._set_routes()
+        self.actor.task(BrewTask(BrewTask.RESUME))
+        self._paused_at = None
+        self._deferred = []
+
+    def _defer(self, callback, *args):
+        "Keeps the callback for cont() while paused. Returns True if it was deferred."
+        if self._paused_at is None:
+            return False
+        logging.debug("Paused, %s deferred", callback.__name__)
+        self._deferred.append((callback, args))
+        return True
+
     def get_status(self):
         """Returns a tuple with:
         - stopped|running|paused
@@ -168,90 +487,76 @@ class BrewProcess(object):
         - remaining time to complmeting the brewing stage in seconds
         - remaining time to complete the brewing in seconds
         """
-        status = 'stopped' if self._brewing_stage is BrewStages.INITIAL else 'running'
-        stage_remaining = self._stage_minutes[self._brewing_stage["name"]]
-        stage_elapsed = 0
-        if self._brewing_stage_started_at:
-            stage_elapsed = datetime.datetime.utcnow() - self._brewing_stage_started_at
-            stage_elapsed = stage_elapsed.seconds
-        return status, self._brewing_stage, stage_remaining - stage_elapsed, self._get_all_process_remaining_time()
-
-    def _get_all_process_remaining_time(self):
-        # TODO handle paused state
-        ret = self._get_time_remaining(self._brewing_stage)
-        now = datetime.datetime.utcnow()
-        if self._brewing_stage_started_at:
-            elapsed = now - self._brewing_stage_started_at
-            return ret - elapsed.seconds
-        else:
-            return ret
+        snapshot = self._status
+        now = utils.utcnow()
+        return snapshot.status, snapshot.stage, snapshot.stage_remaining(now), snapshot.process_remaining(now)
 
-    def _get_time_remaining(self, stage):
-        # TODO handle paused state
-        if stage[BrewStages.KEY_NEXT_STAGE] is None:
-            return self._stage_minutes[stage["name"]]
-        else:
-            return self._stage_minutes[stage["name"]] + self._get_time_remaining(stage[BrewStages.KEY_NEXT_STAGE])
-
-    def _set_valves_and_pumps(self, mash_pump=False, temp_pump=False, boil_pump=False, mash_valve=_MASH_VALVE_TO_MASH, boil_valve=_BOIL_VALVE_TO_MASH, param=None):
-        logging.debug("set_valves_and_pumps: " + str(locals()))
-        events = []
-        # Stop all pumps
-        events.append(BrewTask(BrewTask.STOP_MASH_PUMP))
-        events.append(BrewTask(BrewTask.STOP_TEMP_PUMP))
-        events.append(BrewTask(BrewTask.STOP_BOIL_PUMP))
-
-        # Set valves
-        if mash_valve == BrewProcess._MASH_VALVE_TO_MASH:
-            events.append(BrewTask(BrewTask.SET_MASH_VALVE_TARGET_MASH))
-        elif mash_valve == BrewProcess._MASH_VALVE_TO_TEMP:
-            events.append(BrewTask(BrewTask.SET_MASH_VALVE_TARGET_TEMP))
-
-        if boil_valve == BrewProcess._BOIL_VALVE_TO_MASH:
-            events.append(BrewTask(BrewTask.SET_BOIL_VALVE_TARGET_MASH))
-        elif boil_valve == BrewProcess._BOIL_VALVE_TO_TEMP:
-            events.append(BrewTask(BrewTask.SET_BOIL_VALVE_TARGET_TEMP))
-
-        # Set pumps
-        if mash_pump:
-            events.append(BrewTask(BrewTask.START_MASH_PUMP, param))
-        else:
-            events.append(BrewTask(BrewTask.STOP_MASH_PUMP))
+    def get_status_snapshot(self):
+        "Returns the last published ProcessStatus."
+        return self._status
 
-        if temp_pump:
-            events.append(BrewTask(BrewTask.START_TEMP_PUMP))
-        else:
-            events.append(BrewTask(BrewTask.STOP_TEMP_PUMP))
+    def _publish_status(self):
+        "Publishes a new status snapshot. Must be called after every change of the stage or the stage times."
+        with self._lock:
+            stage = self._brewing_stage
+            stage_seconds = self._stage_minutes[stage["name"]]
+            version = self._status.version + 1 if self._status is not None else 1
+            self._status = ProcessStatus(
+                version,
+                'stopped' if stage is BrewStages.INITIAL else 'running' if self._paused_at is None else 'paused',
+                stage,
+                self._brewing_stage_started_at,
+                stage_seconds,
+                self._get_time_remaining(stage) - stage_seconds,
+                self._paused_at)
+            if telemetry.hub.has_subscribers():
+                telemetry.hub.publish(telemetry.EVENT_STATUS, {
+                    'version': self._status.version, 'status': self._status.status, 'current_stage': stage['name'],
+                    'stage_remaining': self._status.stage_remaining(), 'process_remaining': self._status.process_remaining()})
 
-        if boil_pump:
-            events.append(BrewTask(BrewTask.START_BOIL_PUMP))
-        else:
-            events.append(BrewTask(BrewTask.STOP_BOIL_PUMP))
+    def _publish_stage_enter(self, stage):
+        "Publishes the start of a brew when leaving the initial stage, and the stage being entered."
+        if not telemetry.hub.has_subscribers():
+            return
+        if self._brewing_stage is BrewStages.INITIAL and stage is not BrewStages.INITIAL:
+            telemetry.hub.publish(telemetry.EVENT_BREW, {'action': 'start', 'recipe': self.recipe.to_dict(), 'config': config.config.as_dict()})
+        telemetry.hub.publish(telemetry.EVENT_STAGE, {'name': stage['name']})
+
+    def _get_time_remaining(self, stage):
+        # The time elapsed in the stage is subtracted by ProcessStatus, frozen while paused
+        return self._stage_minutes[stage["name"]] + self._plan.following_seconds(stage)
 
-        for event in events:
-            self.actor.task(event)
+    def _set_routes(self, *routes):
+        """Runs exactly the given routes, stops the other pumps. The brewery plans the
+        valves and pumps, the valves stay where they are when the pumps are stopped."""
+        specs = [topology.route_name(r[0], r[1]) + (":" + r[2] if len(r) > 2 else "") for r in routes]
+        logging.debug("set_routes: %s", specs)
+        with metrics.SET_VALVES_AND_PUMPS_SECONDS.labels().time():
+            self.actor.task(BrewTask(BrewTask.SET_ROUTES, ",".join(specs)))
 
     def _stop_all(self):
         self.actor.task(BrewTask(BrewTask.STOP_COOLING_VALVE))
         self.actor.task(BrewTask(BrewTask.STOP_MASHING_TUN))
         self.actor.task(BrewTask(BrewTask.STOP_BOIL_KETTLE))
-        self._set_valves_and_pumps() # Without parameters it switches off all pumps
+        self._set_routes() # Without parameters it switches off all pumps
 
     def _reset(self):
         with self._lock:
             self._stop_all()
-            self._calculate_stage_minutes()
+            self._compile_plan()
+            if self._brewing_stage is not BrewStages.INITIAL:
+                brewtrace.tracer.end(self._brewing_stage["name"], brewtrace.CATEGORY_STAGE, "stage")
             self._brewing_stage = BrewStages.INITIAL
             self._brewing_stage_started_at = None
+            self._paused_at = None
+            self._deferred = []
             self._sparging_water_ready = False
+            self._flow_targets = {}
+            self._flow_holding = False
+            self._publish_status()
  
     def _next_stage(self, stage):
-        next_stage = stage["next"]
-        mashstage = next_stage["mash"]
-        if mashstage > len(self.recipe.mash_stages):
-            # This mash stage is not defined in the recipe
-            return BrewStages.MASHING_4["next"]
-        return next_stage
+        return self._plan.next_stage(stage)
 
     def _get_pump_time_mash_to_temp(self, liters, to_empty):
         if to_empty:
@@ -277,53 +582,85 @@ class BrewProcess(object):
         else:
             return liters * self._pump_seconds_per_liter_boil_to_mash
 
+    def _get_pump_time(self, route, liters, to_empty):
+        return {BrewProcess._ROUTE_MASH_TO_TEMP: self._get_pump_time_mash_to_temp,
+                BrewProcess._ROUTE_TEMP_TO_BOIL: self._get_pump_time_temp_to_boil,
+                BrewProcess._ROUTE_BOIL_TO_TEMP: self._get_pump_time_boil_to_temp,
+                BrewProcess._ROUTE_BOIL_TO_MASH: self._get_pump_time_boil_to_mash}[route](liters, to_empty)
+
+    def _transfer_timer(self, route, liters, to_empty, callback, name, *args):
+        """Returns a timer which fires when the transfer is detected complete by the transfer
+        monitor of the actor, at the latest at the fixed pump time. Without a monitor it
+        is the fixed timer."""
+        ceiling = self._get_pump_time(route, liters, to_empty)
+        monitor = getattr(self.actor, 'transfers', None)
+        if monitor is None:
+            return utils.PausableTimer(ceiling, callback, name, *args)
+        return monitor.watch(route[0], route[1], liters, to_empty, ceiling, callback, name, *args)
+
     #################################################
     ## State machine
     #################################################
     def _enter_stage(self, stage):
-        logging.info("enter stage: " + stage["name"])
+        if stage is None:
+            # The last stage of a flow is left
+            self._finish()
+            return
+        logging.info("enter stage: %s", stage["name"])
+        if self.recipe.flow is not None and stage not in self._plan.stages:
+            raise ValueError("Stage '%s' is not in the flow %s" % (stage["name"], self.recipe.flow))
         notify("Entering stage: " + stage["name"])
         #self.log_call_stack()
-        pause_stage = stage in [BrewStages.SPARGE_PAUSE_1, BrewStages.SPARGE_PAUSE_2, BrewStages.MASHING_PAUSE]
-        if not config.config.pause and pause_stage:
+        cfg = config.config.current
+        definition, step = stage.get(BrewStages.KEY_FLOW_STAGE, (None, None))
+        pause_stage = stage in [BrewStages.SPARGE_PAUSE_1, BrewStages.SPARGE_PAUSE_2, BrewStages.MASHING_PAUSE] or \
+            (definition is not None and definition.until.kind == flows.UNTIL_OPERATOR and definition.until.pause)
+        if not cfg.pause and pause_stage:
             logging.info("Pausing not enabled by config, skipping automatically to next stage")
-            self._enter_stage(stage[BrewStages.KEY_NEXT_STAGE])
+            self._enter_stage(self._next_stage(stage))
             return
+        self._publish_stage_enter(stage)
         mashstage = stage["mash"]
         first_mash_temp = self.recipe.mash_stages[0][0]
-        self._brewing_stage_started_at = datetime.datetime.utcnow()
+        self._brewing_stage_started_at = utils.utcnow()
         if stage == BrewStages.INITIAL:
             raise ValueError("Initial is not a valid stage to resume to.")
+        elif definition is not None:
+            self._enter_flow_stage(definition, step, cfg)
         elif stage == BrewStages.MASHING_PREPARE:
-            if config.config.mash_start == 'BOILER':
+            if cfg.mash_start == 'BOILER':
+                self.actor.task(BrewTask(BrewTask.BOIL_FILL_VOLUME, self.recipe.mash_water))
                 self.actor.task(BrewTask(BrewTask.BOIL_TARGET_TEMP, first_mash_temp + 5))
             else:
+                self.actor.task(BrewTask(BrewTask.MASH_FILL_VOLUME, self.recipe.mash_water))
                 self.actor.task(BrewTask(BrewTask.MASH_TARGET_TEMP, first_mash_temp + 5))
         elif stage == BrewStages.MASHING_BOIL_TO_MASH:
-            if config.config.transfer_mode == "MANUAL":
-                if config.config.mash_start == "BOILER":
+            if cfg.transfer_mode == "MANUAL":
+                if cfg.mash_start == "BOILER":
                     notify("Water is ready in boiler. Please transfer manually to mash tun, move the water from temporary to boiler and hit next.")
                 else:
                     notify("Water is ready in mash tun. Infuse the malt")
             else:
-                self._set_valves_and_pumps(boil_valve=BrewProcess._BOIL_VALVE_TO_MASH, boil_pump=True)
-                timer = utils.PausableTimer(self._get_pump_time_boil_to_mash(
-                    self.recipe.mash_water, True), self._enter_next_stage_on_timer, name='timer: mash water from boil to mash')
+                self._set_routes(BrewProcess._ROUTE_BOIL_TO_MASH)
+                timer = self._transfer_timer(BrewProcess._ROUTE_BOIL_TO_MASH, self.recipe.mash_water, True,
+                    self._enter_next_stage_on_timer, 'timer: mash water from boil to mash')
                 self._timers.append(timer)
                 timer.start()
                 #self.actor.task(BrewTask(BrewTask.MASH_TARGET_TEMP, first_mash_temp))
         elif stage == BrewStages.MASHING_TEMP_TO_BOIL:
-            if config.config.transfer_mode == "MANUAL":
+            if cfg.transfer_mode == "MANUAL":
                 # this is not used in manual mode, go to next stage
                 self._enter_stage(stage["next"])
                 return
-            self._set_valves_and_pumps(temp_pump=True)
-            timer = utils.PausableTimer(self._get_pump_time_temp_to_boil(
-                self.recipe.sparge_water, True), self._enter_next_stage_on_timer, name='timer: sparging water from temp to boil')
+            self._set_routes(BrewProcess._ROUTE_TEMP_TO_BOIL)
+            timer = self._transfer_timer(BrewProcess._ROUTE_TEMP_TO_BOIL, self.recipe.sparge_water, True,
+                self._enter_next_stage_on_timer, 'timer: sparging water from temp to boil')
             self._timers.append(timer)
             timer.start()
         elif mashstage > 0:
             if mashstage == 1:
+                self.actor.task(BrewTask(BrewTask.MASH_FILL_VOLUME, self.recipe.mash_water))
+                self.actor.task(BrewTask(BrewTask.BOIL_FILL_VOLUME, self.recipe.sparge_water))
                 self.actor.task(BrewTask(BrewTask.BOIL_TARGET_TEMP, self._sparging_temperature))
             self._mash(mashstage)
         elif stage == BrewStages.WAIT_FOR_SPARGING_WATER:
@@ -332,74 +669,88 @@ class BrewProcess(object):
                 self._enter_stage(stage["next"])
                 return # to avoid setting the brewing stage at the end...
         elif stage == BrewStages.SPARGE_MASH_TO_TEMP_1:
-            if config.config.transfer_mode == "MANUAL":
+            if cfg.transfer_mode == "MANUAL":
                 notify("Mashing ended. Please 1) transfer wort from mash to temporary 2) half of the sparging water from bolier to mash tun.")
-                self._set_valves_and_pumps()
+                self._set_routes()
             else:
-                self._sparge(self._get_pump_time_mash_to_temp(self.recipe.mash_water, True), mash_pump=True, mash_valve=BrewProcess._MASH_VALVE_TO_TEMP)
+                self._sparge_transfer(BrewProcess._ROUTE_MASH_TO_TEMP, self.recipe.mash_water, True)
         elif stage == BrewStages.SPARGE_BOIL_TO_MASH_1:
-            if config.config.transfer_mode == "MANUAL":
+            if cfg.transfer_mode == "MANUAL":
                 self._enter_stage(stage["next"])
                 return
-            self._sparge(self._get_pump_time_boil_to_mash(self.recipe.sparge_water / 2.0, False), boil_pump=True, boil_valve=BrewProcess._BOIL_VALVE_TO_MASH)
-            self.actor.task(BrewTask(BrewTask.MASH_TARGET_TEMP, config.config.sparging_temperature))
+            self._sparge_transfer(BrewProcess._ROUTE_BOIL_TO_MASH, self.recipe.sparge_water / 2.0, False)
+            self.actor.task(BrewTask(BrewTask.MASH_TARGET_TEMP, cfg.sparging_temperature))
         elif stage == BrewStages.SPARGE_CIRCULATE_IN_MASH_1:
-            self._sparge(config.config.sparging_circulate_secs, mash_pump=True, mash_valve=BrewProcess._MASH_VALVE_TO_MASH, param='SPARGE_DISTRIBUTION')
+            self._sparge(cfg.sparging_circulate_secs, BrewProcess._ROUTE_SPARGE_CIRCULATE)
         elif stage == BrewStages.SPARGE_PAUSE_1 or stage == BrewStages.SPARGE_PAUSE_2:
-            self._set_valves_and_pumps(mash_valve=None, boil_valve=None)
+            self._set_routes()
         elif stage == BrewStages.SPARGE_MASH_TO_TEMP_2:
-            if config.config.transfer_mode == "MANUAL":
+            if cfg.transfer_mode == "MANUAL":
                 notify("1st stage sparging ended. Please 1) transfer wort from mash to temporary 2) other half of the sparging water from bolier to mash tun. 3) wort from temporary to boiler, and start heating up")
-                self._set_valves_and_pumps()
+                self._set_routes()
             else:
-                self._sparge(self._get_pump_time_mash_to_temp(self.recipe.sparge_water / 2.0, True), mash_pump=True, mash_valve=BrewProcess._MASH_VALVE_TO_TEMP)
+                self._sparge_transfer(BrewProcess._ROUTE_MASH_TO_TEMP, self.recipe.sparge_water / 2.0, True)
         elif stage == BrewStages.SPARGE_BOIL_TO_MASH_2:
-            if config.config.transfer_mode == "MANUAL":
+            if cfg.transfer_mode == "MANUAL":
                 self._enter_stage(stage["next"])
                 return
-            self._sparge(self._get_pump_time_boil_to_mash(self.recipe.sparge_water / 2.0, True), boil_pump=True, boil_valve=BrewProcess._BOIL_VALVE_TO_MASH)
+            self._sparge_transfer(BrewProcess._ROUTE_BOIL_TO_MASH, self.recipe.sparge_water / 2.0, True)
             self.actor.task(BrewTask(BrewTask.STOP_BOIL_KETTLE))
         elif stage == BrewStages.SPARGE_TEMP_TO_BOIL_1:
-            if config.config.transfer_mode == "MANUAL":
+            if cfg.transfer_mode == "MANUAL":
                 self._enter_stage(stage["next"])
                 return
-            self._sparge(self._get_pump_time_temp_to_boil(self.recipe.mash_water + self.recipe.sparge_water/2.0, True), temp_pump=True)
+            self._sparge_transfer(BrewProcess._ROUTE_TEMP_TO_BOIL, self.recipe.mash_water + self.recipe.sparge_water/2.0, True)
             self.actor.task(BrewTask(BrewTask.BOIL_TARGET_TEMP, 99))
         elif stage == BrewStages.SPARGE_CIRCULATE_IN_MASH_2:
-            self._sparge(config.config.sparging_circulate_secs, mash_pump=True, mash_valve=BrewProcess._MASH_VALVE_TO_MASH, param='SPARGE_DISTRIBUTION')
+            self._sparge(cfg.sparging_circulate_secs, BrewProcess._ROUTE_SPARGE_CIRCULATE)
         elif stage == BrewStages.SPARGE_MASH_TO_TEMP_3:
-            if config.config.transfer_mode == "MANUAL":
+            if cfg.transfer_mode == "MANUAL":
                 notify("2nd stage sparging ended. Please transfer wort from mash to boiler")
-                self._set_valves_and_pumps()
+                self._set_routes()
             else:
                 self.actor.task(BrewTask(BrewTask.STOP_MASHING_TUN))
-                self._sparge(self._get_pump_time_mash_to_temp(self.recipe.sparge_water / 2.0, True), mash_pump=True, mash_valve=BrewProcess._MASH_VALVE_TO_TEMP)
+                self._sparge_transfer(BrewProcess._ROUTE_MASH_TO_TEMP, self.recipe.sparge_water / 2.0, True)
         elif stage == BrewStages.SPARGE_TEMP_TO_BOIL_2:
-            if config.config.transfer_mode == "MANUAL":
+            if cfg.transfer_mode == "MANUAL":
                 self._enter_stage(stage["next"])
                 return
-            self._sparge(self._get_pump_time_temp_to_boil(self.recipe.mash_water + self.recipe.sparge_water, True), temp_pump=True)
+            self._sparge_transfer(BrewProcess._ROUTE_TEMP_TO_BOIL, self.recipe.mash_water + self.recipe.sparge_water, True)
         elif stage == BrewStages.BOIL:
             self._stop_all()
+            self.actor.task(BrewTask(BrewTask.BOIL_FILL_VOLUME, self.recipe.mash_water + self.recipe.sparge_water))
             self.actor.task(BrewTask(BrewTask.BOIL_TARGET_TEMP, 100))
             # start preboil cycles (transfer remaining wort from mash->temp->boil)
             self._preboil_cycle_start()
+        elif stage == BrewStages.COOLING:
+            self._stop_all()
+            self.actor.task(BrewTask(BrewTask.ENGAGE_COOLING_VALVE, self.recipe.pitch_temperature))
         elif pause_stage:
             pass
         else:
             raise ValueError("Unhandled target stage:" + stage["name"])
-        self._brewing_stage_started_at = datetime.datetime.utcnow()
-        self._brewing_stage = stage
+        with self._lock:
+            if self._brewing_stage is not BrewStages.INITIAL:
+                brewtrace.tracer.end(self._brewing_stage["name"], brewtrace.CATEGORY_STAGE, "stage")
+            brewtrace.tracer.begin(stage["name"], brewtrace.CATEGORY_STAGE, "stage")
+            self._brewing_stage_started_at = utils.utcnow()
+            self._brewing_stage = stage
+            self._publish_status()
 
     ####################################################
     ## Callbacks from jam makers
     ####################################################
     def mash_target_reached(self, temp):
         with self._lock:
-            logging.info("mashtun target reached: " + str(temp))
+            if self._defer(self.mash_target_reached, temp):
+                return
+            logging.info("mashtun target reached: %s", temp)
             if self._brewing_stage == BrewStages.INITIAL:
                 logging.info("--> This is the initial stage, do nothing")
                 return
+            elif BrewStages.KEY_FLOW_STAGE in self._brewing_stage:
+                self._flow_target_reached('mashtun', temp)
+                return
             elif self._brewing_stage == BrewStages.MASHING_PREPARE and config.config.mash_start == 'MASHTUN':
                 self._enter_stage(self._brewing_stage["next"])
             elif temp == config.config.sparging_temperature:
@@ -411,13 +762,19 @@ class BrewProcess(object):
             self._timers.append(timer)
             # Update to reflect correct remaining time
             self._stage_minutes[self._brewing_stage["name"]] = 60 * minutes
-            self._brewing_stage_started_at = datetime.datetime.utcnow()
+            self._brewing_stage_started_at = utils.utcnow()
+            self._publish_status()
 
     def boil_target_reached(self, temp):
         with self._lock:
-            logging.info("boiler target reached: " + str(temp) + " stage: " + self._brewing_stage["name"])
+            if self._defer(self.boil_target_reached, temp):
+                return
+            logging.info("boiler target reached: %s stage: %s", temp, self._brewing_stage["name"])
             if self._brewing_stage == BrewStages.INITIAL:
                 return
+            if BrewStages.KEY_FLOW_STAGE in self._brewing_stage:
+                self._flow_target_reached('boiler', temp)
+                return
             if temp == 99:
                 logging.debug("99C reached while preheating wort in boiler, do nothing.")
                 return
@@ -428,25 +785,88 @@ class BrewProcess(object):
                 self._enter_stage(BrewStages.WAIT_FOR_SPARGING_WATER["next"])
             elif self._brewing_stage == BrewStages.BOIL:
                 # Boiling
-                # TODO: hops
                 notify("Wort has reached 100 Celsius. Prepare your hops!")
                 timer = utils.PausableTimer(self.recipe.boiling_time * 60, self._boil_finished, name="boiler timer")
                 self._timers.append(timer)
                 timer.start()
+                self._start_hop_timers()
                 # Update remaining time
                 self._stage_minutes[self._brewing_stage["name"]] = self.recipe.boiling_time * 60
+                self._publish_status()
             elif self._brewing_stage == BrewStages.MASHING_PREPARE and config.config.mash_start == 'BOILER':
                 self._enter_stage(self._brewing_stage["next"])
 
     def _enter_next_stage_on_timer(self, timer, *_, **__):
         with self._lock:
-            logging.debug("args: " + str(_) + ", kwargs: " + str(__))
-            logging.debug("_enter_next_stage_on_timer: " + timer.name)
+            if self._defer(self._enter_next_stage_on_timer, timer):
+                return
+            logging.debug("args: %s, kwargs: %s", _, __)
+            logging.debug("_enter_next_stage_on_timer: %s", timer.name)
             self._timers.remove(timer)
             if self._brewing_stage == BrewStages.INITIAL:
                 return
             self._enter_stage(self._next_stage(self._brewing_stage))
 
+    ########################################################
+    ## Flows
+    ########################################################
+    def _enter_flow_stage(self, definition, step, cfg):
+        "Does the actions of a stage of a flow and sets up how the stage is left, see flows.py."
+        values = flows.values(self.recipe, cfg.sparging_temperature, step)
+        self._flow_holding = False
+        for action in definition.actions:
+            if action.kind == flows.ACTION_HEAT:
+                fill_volume, target_temp, _ = BrewProcess._HEATER_TASKS[action.vessel]
+                if action.volume is not None:
+                    self.actor.task(BrewTask(fill_volume, action.volume(values)))
+                self._flow_targets[action.vessel] = action.to(values)
+                self.actor.task(BrewTask(target_temp, self._flow_targets[action.vessel]))
+            elif action.kind == flows.ACTION_OFF:
+                self._flow_targets.pop(action.vessel, None)
+                self.actor.task(BrewTask(BrewProcess._HEATER_TASKS[action.vessel][2]))
+            else:
+                notify(action.message.format(**values))
+        until = definition.until
+        pumped = until.kind == flows.UNTIL_TRANSFER and cfg.transfer_mode != "MANUAL"
+        self._set_routes(*(definition.routes + ([until.route] if pumped else [])))
+        timer = None
+        if until.kind == flows.UNTIL_SECONDS:
+            timer = utils.PausableTimer(until.value(values), self._enter_next_stage_on_timer, "flow timer: " + definition.key)
+        elif pumped:
+            timer = self._transfer_timer(until.route, until.liters(values), until.empty, self._enter_next_stage_on_timer,
+                                         "flow transfer: " + topology.route_name(*until.route))
+        elif until.kind == flows.UNTIL_TRANSFER:
+            notify("Please transfer %g L from %s to %s and continue." % (until.liters(values), until.route[0], until.route[1]))
+        elif until.kind == flows.UNTIL_COOLED:
+            self.actor.task(BrewTask(BrewTask.ENGAGE_COOLING_VALVE, self.recipe.pitch_temperature))
+        if timer is not None:
+            self._timers.append(timer)
+            timer.start()
+
+    def _flow_target_reached(self, vessel, temp):
+        "A heater reached its target in a stage of a flow: the stage is held or left if it waited for it."
+        definition, step = self._brewing_stage[BrewStages.KEY_FLOW_STAGE]
+        until = definition.until
+        if until.kind != flows.UNTIL_REACHED or until.vessel != vessel or self._flow_holding or \
+                self._flow_targets.get(vessel) != temp:
+            logging.debug("--> %s reached %s, not waited for", vessel, temp)
+            return
+        if until.hold is None:
+            self._enter_stage(self._next_stage(self._brewing_stage))
+            return
+        self._flow_holding = True
+        hold = until.hold(flows.values(self.recipe, self._sparging_temperature, step))
+        timer = utils.PausableTimer(hold, self._enter_next_stage_on_timer, name="hold timer for temperature " + str(temp))
+        self._timers.append(timer)
+        timer.start()
+        if until.hops:
+            notify("Wort has reached %s Celsius. Prepare your hops!" % temp)
+            self._start_hop_timers()
+        # Update to reflect correct remaining time
+        self._stage_minutes[self._brewing_stage["name"]] = hold
+        self._brewing_stage_started_at = utils.utcnow()
+        self._publish_status()
+
     ########################################################
     ## Mashing
     ########################################################
@@ -455,38 +875,49 @@ class BrewProcess(object):
             raise ValueError("Mashing step " + str(step) + " is not defined in recipe!")
         temp, _ = self.recipe.mash_stages[step - 1]
         self.actor.task(BrewTask(BrewTask.MASH_TARGET_TEMP, temp))
-        self._set_valves_and_pumps(mash_pump=True, param='MASH_DISTRIBUTION')
+        self._set_routes(BrewProcess._ROUTE_MASH_CIRCULATE)
 
     #########################################
     ## SPARGING
     #########################################
 
-    def _sparge(self, waittime, **kwargs):
+    def _sparge(self, waittime, route):
         with self._lock:
-            self._set_valves_and_pumps(**kwargs)
-            if 'mash_pump' in kwargs and kwargs['mash_pump'] and 'mash_valve' in kwargs and kwargs['mash_valve'] == BrewProcess._MASH_VALVE_TO_TEMP:
+            self._set_routes(route)
+            timer = utils.PausableTimer(waittime, self._enter_next_stage_on_timer, "sparging timer")
+            self._timers.append(timer)
+            timer.start()
+
+    def _sparge_transfer(self, route, liters, to_empty):
+        with self._lock:
+            self._set_routes(route)
+            if route == BrewProcess._ROUTE_MASH_TO_TEMP:
                 # This is from mash to temp. In this case, we pause the process at 67%
-                timer = utils.PausableTimer(waittime * 0.67, self._sparge_pause, "pumping 67% to temp", waittime * 0.33)
-                logging.debug("This is from mash to temp, pumping only 67% percent of the time, then there will be a pause")
+                timer = self._transfer_timer(route, liters * 0.67, False, self._sparge_pause, "pumping 67% to temp", liters * 0.33, to_empty)
+                logging.debug("This is from mash to temp, pumping only 67% percent of the liquid, then there will be a pause")
             else:
-                timer = utils.PausableTimer(waittime, self._enter_next_stage_on_timer, "sparging timer")
+                timer = self._transfer_timer(route, liters, to_empty, self._enter_next_stage_on_timer, "sparging timer")
             self._timers.append(timer)
             timer.start()
 
-    def _sparge_pause(self, timer, waittime, *_, **__):
-        "Called when the 75% of the wort has been transferred from mash to temp at sparging"
+    def _sparge_pause(self, timer, liters, to_empty, *_, **__):
+        "Called when the 67% of the wort has been transferred from mash to temp at sparging"
         with self._lock:
+            if self._defer(self._sparge_pause, timer, liters, to_empty):
+                return
             self._timers.remove(timer)
-            self._set_valves_and_pumps(mash_valve=BrewProcess._MASH_VALVE_TO_TEMP)
-            timer = utils.PausableTimer(config.config.sparging_delay_between_mash_to_temp_stages, self._sparge_continue, "waiting for wort to settle in mashtun", waittime)
+            self._set_routes()
+            timer = utils.PausableTimer(config.config.sparging_delay_between_mash_to_temp_stages, self._sparge_continue, "waiting for wort to settle in mashtun", liters, to_empty)
             self._timers.append(timer)
             timer.start()
 
-    def _sparge_continue(self, timer, waittime, *_, **__):
+    def _sparge_continue(self, timer, liters, to_empty, *_, **__):
         with self._lock:
+            if self._defer(self._sparge_continue, timer, liters, to_empty):
+                return
             self._timers.remove(timer)
-            self._set_valves_and_pumps(mash_pump=True, mash_valve=BrewProcess._MASH_VALVE_TO_TEMP)
-            timer = utils.PausableTimer(waittime, self._enter_next_stage_on_timer, "pumping remaining 33% to temp")
+            self._set_routes(BrewProcess._ROUTE_MASH_TO_TEMP)
+            timer = self._transfer_timer(BrewProcess._ROUTE_MASH_TO_TEMP, liters, to_empty, self._enter_next_stage_on_timer, "pumping remaining 33% to temp")
             self._timers.append(timer)
             timer.start()
             
@@ -500,16 +931,18 @@ class BrewProcess(object):
         # Preboil idle time up, wait
         # If this is the last cycle, pump from temp to boil
         with self._lock:
+            if timer is not None and self._defer(self._preboil_cycle_idle, timer, cycle_left):
+                return
             if timer is not None:
                 self._timers.remove(timer)
             if cycle_left == 0:
                 # last cycle
-                self._set_valves_and_pumps(temp_pump=True)
+                self._set_routes(BrewProcess._ROUTE_TEMP_TO_BOIL)
                 timer = utils.PausableTimer(70, self._preboil_cycle_end, "Pumping remaining wort from temp to boil")
                 self._timers.append(timer)
                 timer.start()
             else:
-                self._set_valves_and_pumps()
+                self._set_routes()
                 timer = utils.PausableTimer(config.config.preboil_mash_to_temp_period, self._preboil_cycle_pump, "Preboil idle cycle", cycle_left)
                 self._timers.append(timer)
                 timer.start()
@@ -517,32 +950,89 @@ class BrewProcess(object):
     def _preboil_cycle_pump(self, timer, cycle_left, *_, **__):
         # Preboil next cycle, turn on mash pump
         with self._lock:
+            if self._defer(self._preboil_cycle_pump, timer, cycle_left):
+                return
             self._timers.remove(timer)
-            self._set_valves_and_pumps(mash_pump=True, mash_valve=BrewProcess._MASH_VALVE_TO_TEMP)
+            self._set_routes(BrewProcess._ROUTE_MASH_TO_TEMP)
             timer = utils.PausableTimer(10, self._preboil_cycle_idle, "pumping remaining wort from mash to temp", cycle_left - 1)
             self._timers.append(timer)
             timer.start()
 
     def _preboil_cycle_end(self, timer, *_, **__):
         with self._lock:
+            if self._defer(self._preboil_cycle_end, timer):
+                return
             logging.info("Preboil cycles ended.")
             self._timers.remove(timer)
-            self._set_valves_and_pumps()
+            self._set_routes()
 
     ################################################
     ## Boiling
     ################################################
 
+    def _start_hop_timers(self):
+        for arm, minutes in self.recipe.hop_timing:
+            timer = utils.PausableTimer(minutes * 60, self._release_arm, "hop arm " + str(arm), arm)
+            self._timers.append(timer)
+            timer.start()
+
+    def _release_arm(self, timer, arm, *_, **__):
+        with self._lock:
+            if self._defer(self._release_arm, timer, arm):
+                return
+            self._timers.remove(timer)
+            self.actor.task(BrewTask(BrewTask.RELEASE_ARM, arm))
+
     def _boil_finished(self, timer, *_, **__):
         with self._lock:
-            self._reset()
+            if self._defer(self._boil_finished, timer):
+                return
             self._timers.remove(timer)
-            # TODO cooling
+            if config.config.cooling_enabled:
+                self._enter_stage(BrewStages.COOLING)
+            else:
+                self._finish()
+
+    ################################################
+    ## Cooling
+    ################################################
+
+    def _cooling(self):
+        "True if the current stage cools the wort."
+        definition, _ = self._brewing_stage.get(BrewStages.KEY_FLOW_STAGE, (None, None))
+        if definition is not None:
+            return definition.until.kind == flows.UNTIL_COOLED
+        return self._brewing_stage == BrewStages.COOLING
+
+    def cooling_target_reached(self, temp):
+        with self._lock:
+            if self._defer(self.cooling_target_reached, temp):
+                return
+            if not self._cooling():
+                return
+            notify("Wort has cooled down to %s Celsius. Pitch the yeast!" % temp)
+            if self._brewing_stage == BrewStages.COOLING:
+                self._finish()
+            else:
+                self._enter_stage(self._next_stage(self._brewing_stage))
+
+    def cooling_progress(self, eta):
+        "Called by the chiller with the estimated seconds to the pitch temperature."
+        with self._lock:
+            if self._paused_at is not None or not self._cooling():
+                return
+            elapsed = (utils.utcnow() - self._brewing_stage_started_at).seconds
+            self._stage_minutes[self._brewing_stage["name"]] = elapsed + int(eta)
+            self._publish_status()
+
+    def _finish(self):
+        telemetry.hub.publish(telemetry.EVENT_BREW, {'action': 'finish'})
+        self._reset()
 
     def log_call_stack(self):
         for line in traceback.format_stack():
             logging.debug(line)
-        logging.debug("timers: " + str(self._timers))
+        logging.debug("timers: %s", self._timers)
 
 if __name__ == "__main__":
     print(BrewStages.INITIAL)
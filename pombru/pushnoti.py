@@ -1,13 +1,18 @@
 "Send a push notification to my phone"
 import argparse
+import concurrent.futures
 import logging
 import sys
 
 from pushsafer import init, Client
 import requests
+import telemetry
 requests.packages.urllib3.disable_warnings()
 
 __CLIENT = None
+# Push messages are sent one by one, in order
+__EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
 def pushnoti_init():
     parser = argparse.ArgumentParser()
     parser.add_argument("--pushsafer_key", required=True, type=str, help="PushSafer private key")
@@ -18,11 +23,20 @@ def pushnoti_init():
     __CLIENT = Client("")
 
 def notify(msg):
+    telemetry.hub.publish(telemetry.EVENT_NOTIFICATION, {'message': msg})
+    if __CLIENT is None:
+        logging.debug("Push notifications are not initialized, not sending: %s", msg)
+        return
     try:
         resp = __CLIENT.send_message(msg, "PomBru", "36659", "1", "4", "2", "https://www.pushsafer.com", "Open Pushsafer", "0", "", "", "")
-        logging.debug("response for push notification '" + msg + "' is: " + str(resp))
+        logging.debug("response for push notification '%s' is: %s", msg, resp)
     except:
-        logging.error("Error while sending push notification: " + sys.exc_info()[0])
+        logging.error("Error while sending push notification: %s", sys.exc_info()[0])
+
+def notify_async(msg):
+    """Same as notify(), but the message is sent on a background thread, so the caller
+    never waits for the push service."""
+    __EXECUTOR.submit(notify, msg)
 
 if __name__ == "__main__":
     print("trying to send test message")
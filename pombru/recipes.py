@@ -1,12 +1,27 @@
-"""Contains classes for beer recipe handling"""
+"""Contains classes for beer recipe handling.
+
+Recipes are read from the [recipe] section of the config, or kept in a
+RecipeLibrary: a directory of JSON files with an index, filled by importing
+BeerXML or JSON files."""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
 
 import config
+import flows
 
 
 class Recipe(object):
     "Contains data needed for Pombru to brew a beer."
 
-    def __init__(self, mash_stages=None, boiling_time=60, mash_water=15, sparge_water=20, hop_timing=None):
+    def __init__(self, mash_stages=None, boiling_time=60, mash_water=15, sparge_water=20, hop_timing=None, name=None, pitch_temperature=20,
+                 flow=None):
         """Constructor. The parameters are:
         mash_stages: array of (temperature, minutes) pairs
         boiling_time: how long boil the wort (minutes)
@@ -15,6 +30,9 @@ class Recipe(object):
         hop_timing: array of (arm id, minutes) pairs, after start of boil,
             how many minutes later should an arm release its hop
             arms start from 1
+        name: name of the beer
+        pitch_temperature: the wort is cooled to this temperature after the boil (Celsius)
+        flow: name of the brewing flow (see flows.py), None for the classic sparge sequence
         """
         if mash_stages is None:
             mash_stages = [(64, 90)]
@@ -25,11 +43,59 @@ class Recipe(object):
         self.mash_water = mash_water
         self.sparge_water = sparge_water
         self.hop_timing = hop_timing
+        self.name = name
+        self.pitch_temperature = pitch_temperature
+        self.flow = flow
+
+    def validate(self):
+        "Raises ValueError if the recipe cannot be brewed."
+        try:
+            self._validate()
+        except TypeError as e:
+            raise ValueError("Invalid recipe: " + str(e))
+
+    def _validate(self):
+        if not self.mash_stages:
+            raise ValueError("Recipe has no mash stages")
+        for temp, minutes in self.mash_stages:
+            if not 20 <= temp < 100 or minutes < 0:
+                raise ValueError("Invalid mash stage: %s C, %s min" % (temp, minutes))
+        if self.boiling_time < 0:
+            raise ValueError("Invalid boiling time: " + str(self.boiling_time))
+        # The flows without sparging may take all the water into the mash
+        if self.mash_water <= 0 or self.sparge_water < 0 or (self.sparge_water == 0 and self.flow is None):
+            raise ValueError("Invalid water amounts: %s L mash, %s L sparge" % (self.mash_water, self.sparge_water))
+        for arm, minutes in self.hop_timing:
+            if arm < 1 or not 0 <= minutes <= self.boiling_time:
+                raise ValueError("Invalid hop timing: arm %s at %s min" % (arm, minutes))
+        if not 0 < self.pitch_temperature < 100:
+            raise ValueError("Invalid pitch temperature: " + str(self.pitch_temperature))
+        if self.flow is not None:
+            flows.get(self.flow)
+
+    def to_dict(self):
+        ret = {'name': self.name, 'mash_stages': [list(s) for s in self.mash_stages], 'boiling_time': self.boiling_time,
+               'mash_water': self.mash_water, 'sparge_water': self.sparge_water, 'hop_timing': [list(h) for h in self.hop_timing],
+               'pitch_temperature': self.pitch_temperature}
+        # Recipes of the classic flow keep their content, and their ids in the library
+        if self.flow is not None:
+            ret['flow'] = self.flow
+        return ret
 
     def __str__(self):
-        return ("Recipe[mash stages: " + str(self.mash_stages) + ", boiling time: " +
-                str(self.boiling_time) + "min, mash water: " + str(self.mash_water) + "L, sparge water: " + str(self.sparge_water) + "L]")
+        return ("Recipe[" + (str(self.name) + ", " if self.name else "") + "mash stages: " + str(self.mash_stages) + ", boiling time: " +
+                str(self.boiling_time) + "min, mash water: " + str(self.mash_water) + "L, sparge water: " + str(self.sparge_water) + "L" +
+                (", flow: " + self.flow if self.flow is not None else "") + "]")
+
 
+def from_dict(data):
+    "Creates a recipe from a dictionary returned by Recipe.to_dict()."
+    try:
+        return Recipe([tuple(s) for s in data['mash_stages']], data['boiling_time'], data['mash_water'], data['sparge_water'],
+                      [tuple(h) for h in data.get('hop_timing', [])], data.get('name'), data.get('pitch_temperature', 20),
+                      data.get('flow'))
+    except (KeyError, TypeError) as e:
+        raise ValueError("Invalid recipe: " + repr(e))
 
 def from_config():
     cp = config.config.cp
@@ -45,7 +111,189 @@ def from_config():
     boiling_time = int(recipe["BoilingTime"])
     mash_water = int(recipe["MashWaterLiter"])
     sparge_water = int(recipe["SpargeWaterLiter"])
-    # TODO hop timing
 
-    ret = Recipe(mash_stages, boiling_time, mash_water, sparge_water)
+    hop_timing = []
+    for hop in range(1, int(recipe.get("HopCount", "0")) + 1):
+        hop_timing.append((int(recipe["Hop" + str(hop) + "Arm"]), int(recipe["Hop" + str(hop) + "Time"])))
+
+    ret = Recipe(mash_stages, boiling_time, mash_water, sparge_water, hop_timing, recipe.get("Name"), float(recipe.get("PitchTemp", "20")),
+                 recipe.get("Flow"))
     return ret
+
+def from_json(text):
+    "Reads recipes from JSON: one recipe or a list of them, in the format of Recipe.to_dict()."
+    data = json.loads(text)
+    if isinstance(data, dict):
+        data = [data]
+    return [from_dict(d) for d in data]
+
+def _xml_float(element, tag, default=None):
+    value = element.findtext(tag)
+    if value is None or not value.strip():
+        if default is None:
+            raise ValueError("BeerXML element " + tag + " is missing")
+        return default
+    return float(value)
+
+def from_beerxml(text):
+    """Reads the recipes of a BeerXML 1.0 document.
+
+    Mash steps come from MASH_STEPS, the mash water is the sum of the infusions, the
+    sparge water is the rest of BOIL_SIZE, the pitch temperature is PRIMARY_TEMP. Boil hops are assigned to the hop arms in
+    the order of their addition: hops added at the same time share an arm."""
+    root = ElementTree.fromstring(text)
+    elements = [root] if root.tag == 'RECIPE' else root.findall('RECIPE')
+    ret = []
+    for element in elements:
+        steps = element.findall('MASH/MASH_STEPS/MASH_STEP')
+        mash_stages = [(round(_xml_float(step, 'STEP_TEMP'), 1), int(round(_xml_float(step, 'STEP_TIME'))))
+                       for step in steps]
+        mash_water = sum(_xml_float(step, 'INFUSE_AMOUNT', 0.0) for step in steps)
+        if mash_water <= 0:
+            raise ValueError("BeerXML recipe has no mash infusion amount")
+        boiling_time = int(round(_xml_float(element, 'BOIL_TIME')))
+        sparge_water = _xml_float(element, 'BOIL_SIZE') - mash_water
+        additions = sorted(set(boiling_time - int(round(_xml_float(hop, 'TIME')))
+                               for hop in element.findall('HOPS/HOP') if (hop.findtext('USE') or '').lower() == 'boil'))
+        hop_timing = [(arm, max(minutes, 0)) for arm, minutes in enumerate(additions, 1)]
+        ret.append(Recipe(mash_stages, boiling_time, round(mash_water, 1), round(sparge_water, 1), hop_timing, element.findtext('NAME'),
+                          round(_xml_float(element, 'PRIMARY_TEMP', 20.0), 1)))
+    return ret
+
+def load_file(filename):
+    "Reads the recipes of a BeerXML (.xml) or JSON file."
+    with open(filename, encoding='utf-8') as f:
+        text = f.read()
+    return parse(text, 'beerxml' if filename.lower().endswith('.xml') else 'json')
+
+def parse(text, fmt=None):
+    "Reads recipes from text in beerxml or json format. The format is guessed if not given."
+    if fmt is None:
+        fmt = 'beerxml' if text.lstrip().startswith('<') else 'json'
+    try:
+        if fmt == 'beerxml':
+            return from_beerxml(text)
+        elif fmt == 'json':
+            return from_json(text)
+    except ElementTree.ParseError as e:
+        raise ValueError("Invalid BeerXML: " + str(e))
+    raise ValueError("Unknown recipe format: " + str(fmt))
+
+def recipe_id(recipe):
+    "Returns the library id of a recipe: its name and a hash of its content."
+    content = json.dumps(recipe.to_dict(), sort_keys=True)
+    slug = re.sub(r'[^a-z0-9]+', '-', (recipe.name or 'recipe').lower()).strip('-')[:40] or 'recipe'
+    return slug + '-' + hashlib.md5(content.encode()).hexdigest()[:8]
+
+class RecipeLibrary(object):
+    """Recipes stored as JSON files in a directory.
+
+    The index file holds the summaries of the recipes and the selected one, so
+    listing does not read the recipe files. Recipes are validated when added;
+    the same recipe imported twice gets the same id."""
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._cache = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        try:
+            with open(self._path(RecipeLibrary.INDEX_FILE)) as f:
+                self._index = json.load(f)
+        except (IOError, OSError, ValueError):
+            self._index = self._rebuild_index()
+
+    def _path(self, filename):
+        return os.path.join(self._directory, filename)
+
+    def _rebuild_index(self):
+        index = {'selected': None, 'recipes': {}}
+        for filename in sorted(os.listdir(self._directory)):
+            if not filename.endswith('.json') or filename == RecipeLibrary.INDEX_FILE:
+                continue
+            try:
+                with open(self._path(filename)) as f:
+                    recipe = from_dict(json.load(f))
+            except (IOError, OSError, ValueError):
+                logging.warning("Skipping invalid recipe file %s", filename)
+                continue
+            index['recipes'][filename[:-5]] = self._summary(recipe, os.path.getmtime(self._path(filename)))
+        if index['recipes']:
+            logging.info("Recipe index rebuilt, %d recipes", len(index['recipes']))
+        return index
+
+    @staticmethod
+    def _summary(recipe, added_at):
+        return {'name': recipe.name, 'mash_steps': len(recipe.mash_stages), 'boiling_time': recipe.boiling_time,
+                'mash_water': recipe.mash_water, 'sparge_water': recipe.sparge_water, 'added_at': added_at}
+
+    def _write_index(self):
+        tmp = self._path(RecipeLibrary.INDEX_FILE + ".tmp")
+        with open(tmp, 'w') as f:
+            json.dump(self._index, f, indent=1, sort_keys=True)
+        os.replace(tmp, self._path(RecipeLibrary.INDEX_FILE))
+
+    def list(self):
+        "Returns the summaries of the recipes, newest first."
+        with self._lock:
+            ret = [dict(summary, id=rid, selected=rid == self._index['selected']) for rid, summary in self._index['recipes'].items()]
+        return sorted(ret, key=lambda r: r['added_at'], reverse=True)
+
+    def get(self, rid):
+        "Returns a recipe by id, or None."
+        with self._lock:
+            if rid not in self._index['recipes']:
+                return None
+            if rid not in self._cache:
+                with open(self._path(rid + '.json')) as f:
+                    self._cache[rid] = from_dict(json.load(f))
+            return self._cache[rid]
+
+    def add(self, recipe):
+        "Validates and stores a recipe. Returns its id."
+        recipe.validate()
+        rid = recipe_id(recipe)
+        with self._lock:
+            if rid not in self._index['recipes']:
+                with open(self._path(rid + '.json'), 'w') as f:
+                    json.dump(recipe.to_dict(), f, indent=1)
+                self._index['recipes'][rid] = self._summary(recipe, time.time())
+                self._write_index()
+            self._cache[rid] = recipe
+        return rid
+
+    def import_text(self, text, fmt=None):
+        "Adds all the recipes of a BeerXML or JSON document. Returns their ids."
+        return [self.add(recipe) for recipe in parse(text, fmt)]
+
+    def delete(self, rid):
+        "Removes a recipe. Returns False if there is no such recipe."
+        with self._lock:
+            if self._index['recipes'].pop(rid, None) is None:
+                return False
+            if self._index['selected'] == rid:
+                self._index['selected'] = None
+            self._cache.pop(rid, None)
+            self._write_index()
+        os.remove(self._path(rid + '.json'))
+        return True
+
+    def select(self, rid):
+        "Marks a recipe as the one to brew. Returns the recipe, raises KeyError if there is no such recipe."
+        recipe = self.get(rid)
+        if recipe is None:
+            raise KeyError(rid)
+        with self._lock:
+            self._index['selected'] = rid
+            self._write_index()
+        return recipe
+
+    def selected(self):
+        "Returns the (id, recipe) selected last, or (None, None)."
+        rid = self._index['selected']
+        if rid is None:
+            return None, None
+        return rid, self.get(rid)
@@ -0,0 +1,220 @@
+"""Replays a recorded brew through the process engine on a virtual timeline.
+
+The recorded temperatures are fed to the thermistors of the jam makers in place
+of the MCP3208 (converted back to ADC values, so the conversion path is the same
+as on the hardware). The device loops, the pump cycles and the process timers
+run on a virtual clock, so hours of brewing are replayed in seconds. The stage
+and task sequence of the replay is printed next to the original one.
+
+The heaters do not affect the recorded temperatures: the replay shows how the
+process reacts to what the sensors read. Operator actions (continuing from the
+pause and manual transfer stages) are repeated after the recorded time spent
+in the stage.
+
+    python replay.py 12                       # brew 12 from the history database
+    python replay.py 12 --eventlog eventlog/pombru-*.evl.gz --format json
+"""
+import os
+os.environ.setdefault('GPIOZERO_PIN_FACTORY', 'mock')
+
+import argparse
+import bisect
+import itertools
+import json
+import logging
+import sys
+
+import brewery
+import config
+import eventlog
+import flows
+import history
+import lowlevel
+import process
+import recipes
+import telemetry
+import utils
+
+class TraceAdc(object):
+    """Replaces an MCP3208 channel: value is the ADC value of the last recorded
+    temperature at the time of the clock."""
+
+    def __init__(self, times, temperatures, clock):
+        self._times = list(times)
+        self._values = [lowlevel.celsius_to_adc(t) for t in temperatures]
+        self._clock = clock
+
+    @property
+    def value(self):
+        idx = bisect.bisect_right(self._times, self._clock.time()) - 1
+        return self._values[max(idx, 0)]
+
+class Recording(object):
+    "A recorded brew: recipe, config, temperature traces, stage and task sequence."
+
+    def __init__(self, started_at, recipe, cfg):
+        self.started_at = started_at
+        self.recipe = recipe
+        self.config = cfg
+        self.traces = {}
+        self.stages = []
+        self.tasks = []
+
+    def end(self):
+        return max([times[-1] for times, _ in self.traces.values() if times] +
+                   [t for t, _ in self.stages] + [t for t, _, _ in self.tasks] + [self.started_at])
+
+def from_history(hist, brew_id):
+    "Loads a Recording from the brew history."
+    brew = hist.brew(brew_id, samples=True)
+    if brew is None:
+        raise ValueError("No such brew: " + str(brew_id))
+    rec = Recording(brew['started_at'], recipes.from_dict(brew['recipe']), brew['config'])
+    for sample in brew['samples']:
+        if sample['current'] is None:
+            continue
+        times, temps = rec.traces.setdefault(sample['vessel'], ([], []))
+        times.append(sample['at'])
+        temps.append(sample['current'])
+    rec.stages = [(s['started_at'], s['stage']) for s in brew['stages']]
+    conn = history.connect(hist.filename)
+    try:
+        rec.tasks = [(r[0], r[1], r[2]) for r in conn.execute(
+            "SELECT at, event, param FROM tasks WHERE brew_id = ? ORDER BY at", (brew_id,))]
+    finally:
+        conn.close()
+    return rec
+
+def add_eventlog_traces(rec, filenames):
+    "Replaces the temperature traces of the recording by the denser ones of event log segments."
+    end = rec.end()
+    traces = {}
+    for filename in filenames:
+        with eventlog.open_segment(filename) as stream:
+            for r in eventlog.decode(stream):
+                if r['kind'] == telemetry.EVENT_TEMPERATURE and rec.started_at <= r['timestamp'] <= end and r['current'] == r['current']:
+                    times, temps = traces.setdefault(r['vessel'], ([], []))
+                    times.append(r['timestamp'])
+                    temps.append(r['current'])
+    for vessel, (times, temps) in traces.items():
+        order = sorted(range(len(times)), key=times.__getitem__)
+        rec.traces[vessel] = ([times[i] for i in order], [temps[i] for i in order])
+
+class _RecordingBrewery(brewery.Brewery):
+    "Brewery which records the executed tasks with the virtual time."
+
+    def __init__(self, clock, **adcs):
+        brewery.Brewery.__init__(self, **adcs)
+        self._clock = clock
+        self.tasks = []
+
+    def task(self, task):
+        self.tasks.append((self._clock.time(), task.event, None if task.param is None else str(task.param)))
+        brewery.Brewery.task(self, task)
+
+def _operator_stages(cfg, recipe):
+    "Stages which are left by the brewer, not by a timer or a temperature."
+    # Recordings have the pause stages only if pausing was enabled
+    return process.operator_stages(
+        cfg.get(config.PombruConfig.SECTION_PROCESS, {}).get(config.PombruConfig.PROPERTY_TRANSFER_MODE.lower()), True,
+        flows.get(recipe.flow) if recipe.flow is not None else None)
+
+def replay(rec, step=1.0):
+    """Runs the recording on a virtual clock. Returns the (stages, tasks) of the replay,
+    with the same layout as the ones of the recording. The configuration of the recording
+    is used while replaying, the current one is restored afterwards."""
+    saved_config = config.config.current
+    config.config.load_dict(rec.config)
+    clock = utils.VirtualClock(rec.started_at)
+    saved_clock, utils.clock = utils.clock, clock
+    stages = []
+
+    def status_listener(event):
+        if event.kind == telemetry.EVENT_STATUS and event.data['status'] == 'running' and \
+                (not stages or stages[-1][1] != history.stage_key(event.data['current_stage'])):
+            stages.append((clock.time(), history.stage_key(event.data['current_stage'])))
+
+    telemetry.hub.add_listener(status_listener)
+    try:
+        adcs = {}
+        for vessel in ('mashtun', 'boiler'):
+            times, temps = rec.traces.get(vessel, ([rec.started_at], [20.0]))
+            adcs[vessel + '_adc'] = TraceAdc(times, temps, clock)
+        brwry = _RecordingBrewery(clock, **adcs)
+        brwry.transfers.learn = False
+        prcss = process.BrewProcess(rec.recipe)
+        prcss.actor = brwry
+        brwry.process = prcss
+
+        first = rec.stages[0][1] if rec.stages else None
+        if first is None or getattr(process.BrewStages, first, None) is prcss.get_plan().stages[1]:
+            prcss.start()
+        else:
+            prcss.cont_with(getattr(process.BrewStages, first))
+
+        # Operator actions: the brewer's time spent in the operator stages is repeated
+        operator = set(_operator_stages(rec.config, rec.recipe))
+        dwells = {}
+        for (started, stage), (ended, _) in zip(rec.stages, rec.stages[1:]):
+            if stage in operator:
+                dwells.setdefault(stage, []).append(ended - started)
+        end = rec.end()
+        now = rec.started_at
+        while now < end:
+            now = min(now + step, end)
+            clock.run_until(now)
+            if stages and dwells.get(stages[-1][1]) and now - stages[-1][0] >= dwells[stages[-1][1]][0]:
+                dwells[stages[-1][1]].pop(0)
+                prcss.next()
+            if stages and prcss.get_status_snapshot().status == 'stopped':
+                break
+        prcss.stop()
+        return stages, brwry.tasks
+    finally:
+        telemetry.hub.remove_listener(status_listener)
+        utils.clock = saved_clock
+        config.config.restore(saved_config)
+
+def compare(rec, stages, tasks):
+    """Returns the stage sequences side by side (times relative to the start) and the
+    index of the first task which differs from the recording, or None."""
+    rows = []
+    for orig, new in itertools.zip_longest(rec.stages, stages):
+        rows.append({'original': None if orig is None else orig[1],
+                     'original_at': None if orig is None else round(orig[0] - rec.started_at, 1),
+                     'replay': None if new is None else new[1],
+                     'replay_at': None if new is None else round(new[0] - rec.started_at, 1)})
+    first_diff = None
+    for i, (orig, new) in enumerate(itertools.zip_longest(rec.tasks, tasks)):
+        if orig is None or new is None or orig[1:] != new[1:]:
+            first_diff = i
+            break
+    return {'stages': rows, 'original_tasks': len(rec.tasks), 'replay_tasks': len(tasks), 'first_task_difference': first_diff}
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a recorded brew on a virtual timeline.")
+    parser.add_argument("brew", type=int, help="Brew id in the history database")
+    parser.add_argument("--database", default=None, help="Database file, [history] Database by default")
+    parser.add_argument("--eventlog", nargs="*", help="Event log segments with denser temperature traces")
+    parser.add_argument("--step", type=float, default=1.0, help="Virtual seconds per replay step")
+    parser.add_argument("--format", default="text", choices=["text", "json"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    rec = from_history(history.BrewHistory(args.database or config.config.history_database), args.brew)
+    if args.eventlog:
+        add_eventlog_traces(rec, args.eventlog)
+    stages, tasks = replay(rec, args.step)
+    result = compare(rec, stages, tasks)
+    if args.format == "json":
+        sys.stdout.write(json.dumps(result, indent=2) + "\n")
+    else:
+        print("%-32s %9s   %-32s %9s" % ("ORIGINAL", "AT", "REPLAY", "AT"))
+        for row in result['stages']:
+            print("%-32s %9s   %-32s %9s" % (row['original'] or '-', '-' if row['original_at'] is None else row['original_at'],
+                                             row['replay'] or '-', '-' if row['replay_at'] is None else row['replay_at']))
+        print("tasks: original %d, replay %d, first difference at %s" % (
+            result['original_tasks'], result['replay_tasks'], result['first_task_difference']))
+
+if __name__ == "__main__":
+    main()
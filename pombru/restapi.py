@@ -1,35 +1,72 @@
 "REST API for Pombru brewer"
+import concurrent.futures
+import hashlib
+import json
 import logging
+import logging.handlers
 import threading
 
-from flask import Flask
+from flask import Flask, Response, request
 from flask_restful import Api, Resource, reqparse, abort
 
+import brewtrace
 import config
 import brewery
+import eventlog
+import fermentation
+import flows
+import history
+import metrics
+import planner
 import process
 import pushnoti
 import recipes
+import telemetry
+import watchdog
 
 BASE = '/pombru/api/v1'
 
+_HARDWARE_EXECUTOR = None
+def run_on_hardware(func, *args):
+    """Runs func on the hardware executor, so blocking device operations (e.g. valve
+    settling) never occupy the server's request threads for long.
+
+    Waits at most [server] HandlerTimeoutSecs. Returns True if func has completed,
+    False if it is still running in the background."""
+    future = _HARDWARE_EXECUTOR.submit(func, *args)
+    try:
+        future.result(timeout=config.config.server_handler_timeout_secs)
+        return True
+    except concurrent.futures.TimeoutError:
+        logging.warning("Hardware operation %s is still running after the handler timeout", func)
+        return False
+
 class JamMakerApi(Resource):
     "Represents a REST API endpoint for a modified jam maker."
 
     parser = reqparse.RequestParser()
     parser.add_argument('mode')
     parser.add_argument('target', required=False)
+    parser.add_argument('volume', required=False)
 
     def __init__(self, jammaker):
         self.jammaker = jammaker
 
     def get(self):
+        self.jammaker.wake()
+        mode = self.jammaker.get_mode()
         ret = {
-            'mode': self.jammaker.get_mode(),
+            'mode': mode,
             'current': self.jammaker.get_temperature()
         }
-        if self.jammaker.get_mode() == 'controlled':
+        if mode in ('controlled', 'paused'):
             ret['target'] = self.jammaker.get_target_temperature()
+        autotune = self.jammaker.get_autotune_status()
+        if autotune is not None:
+            ret['autotune'] = autotune
+        boil = self.jammaker.get_boil_status()
+        if boil is not None:
+            ret['boil'] = boil
         return ret
 
     def put(self):
@@ -37,14 +74,17 @@ class JamMakerApi(Resource):
         new_mode = args['mode']
         if new_mode == 'controlled':
             new_target = float(args['target'])
-            self.jammaker.set_temperature(new_target)
+            done = run_on_hardware(self.jammaker.set_temperature, new_target)
         elif new_mode == 'on':
-            self.jammaker.on()
+            done = run_on_hardware(self.jammaker.on)
         elif new_mode == 'off':
-            self.jammaker.off()
+            done = run_on_hardware(self.jammaker.off)
+        elif new_mode == 'autotune':
+            volume = float(args['volume']) if args['volume'] is not None else None
+            done = run_on_hardware(self.jammaker.autotune, volume)
         else:
             abort(400)
-        return self.get()
+        return self.get(), 200 if done else 202
 
 class PumpApi(Resource):
     "Represents a REST api for a pump."
@@ -63,9 +103,9 @@ class PumpApi(Resource):
         args = PumpApi.parser.parse_args()
         new_status = args['status']
         if new_status == 'on':
-            self.pump.start()
+            run_on_hardware(self.pump.start)
         elif new_status == 'off':
-            self.pump.stop()
+            run_on_hardware(self.pump.stop)
         else:
             abort(400)
         return self.get(), 202
@@ -81,25 +121,296 @@ class ProcessApi(Resource):
         self.process = process
 
     def get(self):
-        status, stage, stagetime, processtime = self.process.get_status()
-        return {'status': status, 'current_stage': stage['name'], 'stage_remaining': stagetime, 'process_remaining': processtime}
+        snapshot = self.process.get_status_snapshot()
+        return {'status': snapshot.status, 'current_stage': snapshot.stage['name'], 'stage_remaining': snapshot.stage_remaining(),
+                'process_remaining': snapshot.process_remaining(), 'version': snapshot.version}
 
     def put(self):
         args = ProcessApi.parser.parse_args()
         command = args["command"]
+        # Stage changes move valves and switch pumps, so they run on the hardware executor
         if command == "start":
-            self.process.start()
+            done = run_on_hardware(self.process.start)
         elif command == "stop":
-            self.process.stop()
+            done = run_on_hardware(self.process.stop)
         elif command == "pause":
-            self.process.pause()
+            done = run_on_hardware(self.process.pause)
         elif command == "continue":
-            self.process.cont()
+            done = run_on_hardware(self.process.cont)
         elif command == "continue_with":
             target = process.BrewStages.__dict__[args["stage"]]
-            self.process.cont_with(target)
+            done = run_on_hardware(self.process.cont_with, target)
         elif command == "next":
-            self.process.next()
+            done = run_on_hardware(self.process.next)
+        else:
+            abort(400)
+        return self.get(), 200 if done else 202
+
+class StatusApi(Resource):
+    """Aggregate status of the whole rig in one request.
+
+    Temperatures are served from the last samples of the control loops, the sensors
+    are not read. The response has a weak ETag calculated from the state, so a poll
+    with a matching If-None-Match header gets a 304 without a body."""
+
+    def __init__(self, brwry, prcss):
+        self.brewery = brwry
+        self.process = prcss
+
+    def get(self):
+        b = self.brewery
+        snapshot = self.process.get_status_snapshot()
+        for jm in b.jammakers.values():
+            jm.wake()
+        jammakers = [(name, jm, jm.get_mode(), jm.get_last_sample()) for name, jm in sorted(b.jammakers.items())]
+        valves = [(name, valve.get_direction_name()) for name, valve in sorted(b.valves.items())]
+        pumps = [(name, 'on' if pump.is_started() else 'off') for name, pump in sorted(b.pumps.items())]
+        routes = sorted(b.router.active())
+        chiller = (b.chiller.get_target_temperature(), b.chiller.get_flow()) if b.chiller is not None else None
+        energy = b.energy.get_status()
+
+        state = (snapshot.version, snapshot.status,
+                 tuple((name, mode, round(sample[0], 1), jm.get_target_temperature(), jm.get_power(), jm.get_fault())
+                       for name, jm, mode, sample in jammakers),
+                 tuple(valves), tuple(pumps), tuple(routes), chiller,
+                 tuple((name, round(kwh, 2)) for name, kwh in sorted(energy['kwh'].items())))
+        etag = hashlib.md5(repr(state).encode()).hexdigest()
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers={'ETag': 'W/"' + etag + '"'})
+
+        ret = {
+            'process': {'status': snapshot.status, 'current_stage': snapshot.stage['name'], 'stage_remaining': snapshot.stage_remaining(),
+                        'process_remaining': snapshot.process_remaining(), 'version': snapshot.version}
+        }
+        for name, jm, mode, sample in jammakers:
+            ret[name] = {'mode': mode, 'current': sample[0], 'sampled_at': sample[1], 'power': jm.get_power()}
+            if mode in ('controlled', 'paused'):
+                ret[name]['target'] = jm.get_target_temperature()
+            if jm.get_fault() is not None:
+                ret[name]['fault'] = jm.get_fault()
+        for name, target in valves:
+            ret[name] = {'target': target}
+        for name, onoff in pumps:
+            ret[name] = {'status': onoff}
+        ret['routes'] = routes
+        ret['energy'] = energy
+        if b.chiller is not None:
+            ret['chiller'] = {'status': 'on' if b.chiller.is_started() else 'off'}
+            if b.chiller.is_started():
+                ret['chiller'].update({'target': b.chiller.get_target_temperature(), 'flow': b.chiller.get_flow(), 'eta': b.chiller.get_eta()})
+        return ret, 200, {'ETag': 'W/"' + etag + '"'}
+
+class StreamApi(Resource):
+    """Server-Sent Events stream of the telemetry events.
+
+    Every client gets its own bounded queue, the oldest events are dropped if the
+    client is too slow to read them. An open stream holds a request thread, so at
+    most [server] Threads minus StreamReserve streams are served at a time."""
+
+    def get(self):
+        cfg = config.config.current
+        limit = max(0, cfg.server_threads - cfg.server_stream_reserve)
+        sub = telemetry.hub.subscribe(cfg.telemetry_client_queue_size, limit)
+        if sub is None:
+            logging.warning("Event stream refused, %d streams are open already", limit)
+            abort(503)
+        keep_alive = cfg.telemetry_keep_alive_secs
+
+        def stream():
+            try:
+                yield "retry: 5000\n\n"
+                while True:
+                    event = sub.get(keep_alive)
+                    if event is None:
+                        yield ": keep-alive\n\n"
+                        continue
+                    yield "id: %d\nevent: %s\ndata: %s\n\n" % (
+                        event.sequence, event.kind, json.dumps({'timestamp': event.timestamp, 'data': event.data}))
+            finally:
+                telemetry.hub.unsubscribe(sub)
+
+        return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+class MetricsApi(Resource):
+    "Prometheus metrics of the control stack."
+
+    def get(self):
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+class TraceApi(Resource):
+    "Execution trace of the current brew in Chrome trace format."
+
+    def get(self):
+        trace = brewtrace.tracer.export()
+        filename = "pombru-trace-" + str(trace["otherData"]["brew"]) + ".json"
+        return trace, 200, {'Content-Disposition': 'attachment; filename=' + filename}
+
+class HistoryApi(Resource):
+    "List of the recorded brews, newest first."
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('limit', type=int, default=20, location='args')
+
+    def __init__(self, hist):
+        self.history = hist
+
+    def get(self):
+        args = HistoryApi.parser.parse_args()
+        return self.history.brews(args['limit'])
+
+class HistoryBrewApi(Resource):
+    "Complete record of one brew, with the temperature samples if samples=1."
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('samples', type=int, default=0, location='args')
+
+    def __init__(self, hist):
+        self.history = hist
+
+    def get(self, brew_id):
+        args = HistoryBrewApi.parser.parse_args()
+        ret = self.history.brew(brew_id, bool(args['samples']))
+        if ret is None:
+            abort(404)
+        return ret
+
+class HistoryStatsApi(Resource):
+    "Heat-up and duration statistics of a stage over the last brews."
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('stage', required=True, location='args')
+    parser.add_argument('vessel', default='mashtun', location='args')
+    parser.add_argument('liters', type=float, required=False, location='args')
+    parser.add_argument('last', type=int, default=20, location='args')
+
+    def __init__(self, hist):
+        self.history = hist
+
+    def get(self):
+        args = HistoryStatsApi.parser.parse_args()
+        try:
+            return self.history.stage_stats(args['stage'], args['vessel'], args['liters'], args['last'])
+        except ValueError:
+            abort(400)
+
+class HistoryReportApi(Resource):
+    "Analytics report of one brew as JSON, or as HTML with format=html."
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('format', default='json', location='args')
+
+    def __init__(self, hist):
+        self.history = hist
+
+    def get(self, brew_id):
+        try:
+            import analytics
+        except ImportError as e:
+            logging.error("Analytics is not available: %s", e)
+            abort(501)
+        args = HistoryReportApi.parser.parse_args()
+        report = analytics.analyze(self.history, [brew_id])
+        if not report:
+            abort(404)
+        if args['format'] == 'html':
+            return Response(analytics.render_html(report), mimetype='text/html')
+        return report[0]
+
+class RecipesApi(Resource):
+    """Recipe library: GET lists the recipes, POST imports a BeerXML or JSON document
+    (the format is guessed if not given)."""
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('format', required=False, location='args')
+
+    def __init__(self, library):
+        self.library = library
+
+    def get(self):
+        return self.library.list()
+
+    def post(self):
+        args = RecipesApi.parser.parse_args()
+        try:
+            ids = self.library.import_text(request.get_data(as_text=True), args['format'])
+        except ValueError as e:
+            return {'message': str(e)}, 400
+        return {'imported': ids}, 201
+
+class RecipeApi(Resource):
+    "One recipe of the library with its plan."
+
+    def __init__(self, library, prcss):
+        self.library = library
+        self.process = prcss
+
+    def get(self, recipe_id):
+        recipe = self.library.get(recipe_id)
+        if recipe is None:
+            abort(404)
+        plan = process.compile_plan(recipe, config.config.current)
+        return {'id': recipe_id, 'recipe': recipe.to_dict(), 'plan': plan.to_list(), 'total_seconds': plan.total_seconds}
+
+    def delete(self, recipe_id):
+        if not self.library.delete(recipe_id):
+            abort(404)
+        return '', 204
+
+class RecipeSelectionApi(Resource):
+    "The recipe of the process. PUT selects a recipe of the library, only while the process is stopped."
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('id', required=True)
+
+    def __init__(self, library, prcss):
+        self.library = library
+        self.process = prcss
+
+    def get(self):
+        plan = self.process.get_plan()
+        return {'id': self.library.selected()[0], 'recipe': self.process.recipe.to_dict(),
+                'plan': plan.to_list(), 'total_seconds': plan.total_seconds}
+
+    def put(self):
+        args = RecipeSelectionApi.parser.parse_args()
+        recipe = self.library.get(args['id'])
+        if recipe is None:
+            abort(404)
+        if self.process.get_status_snapshot().status != 'stopped':
+            return {'message': "The recipe cannot be changed while brewing"}, 409
+        try:
+            self.process.set_recipe(recipe)
+        except ValueError as e:
+            return {'message': str(e)}, 409
+        self.library.select(args['id'])
+        return self.get()
+
+class PlanApi(Resource):
+    """What-if planning. POST a JSON object with the recipe ('recipe': a recipe object
+    or 'recipe_id' of the library; the current recipe if neither) and configuration
+    overrides ('config': {section: {key: value}}), get the simulated timeline."""
+
+    def __init__(self, planner, library, prcss):
+        self.planner = planner
+        self.library = library
+        self.process = prcss
+
+    def post(self):
+        body = request.get_json(force=True, silent=True) or {}
+        try:
+            if 'recipe' in body:
+                recipe = recipes.from_dict(body['recipe'])
+            elif 'recipe_id' in body:
+                recipe = self.library.get(body['recipe_id']) if self.library is not None else None
+                if recipe is None:
+                    abort(404)
+            else:
+                recipe = self.process.recipe
+            return self.planner.plan(recipe, body.get('config'))
+        except ValueError as e:
+            return {'message': str(e)}, 400
+        except concurrent.futures.TimeoutError:
+            return {'message': "The simulation is still running, try again later"}, 504
 
 class TWValveApi(Resource):
     "REST api for two-way valves."
@@ -116,29 +427,121 @@ class TWValveApi(Resource):
     def put(self):
         args = TWValveApi.parser.parse_args()
         new_target = args["target"]
-        self.twvalve.set_direction_name(new_target)
+        try:
+            done = run_on_hardware(self.twvalve.set_direction_name, new_target)
+        except ValueError:
+            abort(400)
+        return self.get(), 200 if done else 202
 
-class ConfigApi(Resource):
-    "REST api for configuration."
+class TopologyApi(Resource):
+    """REST api of the rig's topology. GET returns the graph, the valve positions and the
+    running routes. With routes=<source>-><target>,... it returns the paths and the valve
+    moves the routes would take instead of the running ones, nothing is moved."""
 
-    def __init__(self, brwry, prcss):
-        self.brewery = brwry
-        self.process = prcss
+    def __init__(self, brwry):
+        self._brewery = brwry
 
     def get(self):
-        ret = {}
-        for sec in config.config.cp.sections():
-            secdata = {}
-            ret[sec] = secdata
-            for k, v in config.config.cp.items(sec):
-                secdata[k] = v
-
+        router = self._brewery.router
+        specs = [s for s in request.args.get('routes', '').split(",") if s]
+        if specs:
+            try:
+                paths = router.plan(specs)
+            except ValueError as e:
+                return {"message": str(e)}, 400
+            positions = router.valve_positions()
+            moves = set(m for p in paths for m in p.moves(positions))
+            return {'paths': [p.to_dict() for p in paths], 'valve_moves': len(moves),
+                    'settle_secs': len(moves) * config.config.current.valve_settle_time_secs}
+        ret = router.topology.to_dict()
+        ret['valve_positions'] = router.valve_positions()
+        ret['routes'] = [p.to_dict() for _, p in sorted(router.active().items())]
         return ret
 
+class FlowsApi(Resource):
+    "The brewing flows a recipe can select by its flow field, see flows.py."
+
+    def get(self):
+        try:
+            return [flow.to_dict() for _, flow in sorted(flows.get_all().items())]
+        except ValueError as e:
+            return {"message": str(e)}, 400
+
+class WatchdogApi(Resource):
+    """REST api of the safety watchdog. GET returns the active and the recent faults,
+    PUT with command=clear clears the faults, so the heaters and pumps can be used again."""
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('command')
+
+    def __init__(self, wdog):
+        self._watchdog = wdog
+
+    def get(self):
+        return self._watchdog.get_status()
+
     def put(self):
-        config.config.reload()
-        self.brewery.reload_config()
-        self.process.reload_config()
+        args = WatchdogApi.parser.parse_args()
+        if args['command'] != 'clear':
+            return {"message": "Invalid watchdog command: " + str(args['command'])}, 400
+        self._watchdog.clear()
+        return self.get()
+
+class FermentationApi(Resource):
+    """REST api of the fermentation monitoring. PUT with command=start (optionally with
+    a target), command=target or command=stop; without a target the temperature is
+    only recorded."""
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('command')
+    parser.add_argument('target', type=float, required=False)
+
+    def __init__(self, fermenter):
+        self._fermenter = fermenter
+
+    def get(self):
+        return self._fermenter.get_status()
+
+    def put(self):
+        args = FermentationApi.parser.parse_args()
+        command = args['command']
+        if command == 'start':
+            done = run_on_hardware(self._fermenter.start, args['target'])
+        elif command == 'target':
+            done = run_on_hardware(self._fermenter.set_target, args['target'])
+        elif command == 'stop':
+            done = run_on_hardware(self._fermenter.stop)
+        else:
+            return {"message": "Invalid fermentation command: " + str(command)}, 400
+        return self.get(), 200 if done else 202
+
+class FermentationSamplesApi(Resource):
+    """Recorded temperature of the fermenter between since and until (seconds), of the
+    finest tier which keeps them."""
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('since', type=float, required=False, location='args')
+    parser.add_argument('until', type=float, required=False, location='args')
+
+    def __init__(self, fermenter):
+        self._fermenter = fermenter
+
+    def get(self):
+        args = FermentationSamplesApi.parser.parse_args()
+        return {'samples': self._fermenter.samples(args['since'], args['until'])}
+
+class ConfigApi(Resource):
+    """REST api for configuration. PUT reloads the configuration file; the subscribers
+    of the configuration apply the changes."""
+
+    def get(self):
+        return config.config.as_dict()
+
+    def put(self):
+        try:
+            config.config.reload()
+        except ValueError as e:
+            return {"message": str(e)}, 400
 
 _NOTIFY_TIMER = None
 class NotifyApi(Resource):
@@ -157,7 +560,7 @@ class NotifyApi(Resource):
 
     def put(self):
         args = NotifyApi.parser.parse_args()
-        logging.debug("NotifyApi args: " + str(args))
+        logging.debug("NotifyApi args: %s", args)
         cmd = args['command']
         if cmd == 'start':
             self._stop()
@@ -190,42 +593,129 @@ class NotifyApi(Resource):
 
 class PombruRestApi(object):
     """Representation of Pombru REST API.
-    Following devices should be passed:
-    - mashtun
-    - boiler
-    - mashvalve
-    - boilervalve
-    - mashpump
-    - temppump
-    - boilerpump
-    """
-
-    def __init__(self, brwry, prcss):
+    The jam makers, pumps and valves of the brewery get an endpoint of their own,
+    named as in the topology."""
+
+    def __init__(self, brwry, prcss, hist=None, library=None, wdog=None, fermenter=None):
+        global _HARDWARE_EXECUTOR
+        brewtrace.tracer.resize(config.config.trace_buffer_events)
+        if _HARDWARE_EXECUTOR is None:
+            _HARDWARE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=config.config.server_hardware_workers)
         self._app = Flask("pombru")
         self._api = Api(self._app)
         self._brewery = brwry
-        self._api.add_resource(JamMakerApi, BASE + '/mashtun', endpoint='mashtun', resource_class_kwargs={'jammaker': brwry.mashtun})
-        self._api.add_resource(JamMakerApi, BASE + '/boiler', endpoint='boiler', resource_class_kwargs={'jammaker': brwry.boiler})
-        self._api.add_resource(PumpApi, BASE + '/mashtunpump', endpoint='mashtunpump', resource_class_kwargs={'pump': brwry.mashtunpump})
-        self._api.add_resource(PumpApi, BASE + '/temppump', endpoint='temppump', resource_class_kwargs={'pump': brwry.temppump})
-        self._api.add_resource(PumpApi, BASE + '/boilerpump', endpoint='boilerpump', resource_class_kwargs={'pump': brwry.boilerpump})
+        # The devices of the topology, e.g. /mashtun, /mashtunpump, /mashtunvalve
+        for name, jm in brwry.jammakers.items():
+            self._api.add_resource(JamMakerApi, BASE + '/' + name, endpoint=name, resource_class_kwargs={'jammaker': jm})
+        for name, pump in brwry.pumps.items():
+            self._api.add_resource(PumpApi, BASE + '/' + name, endpoint=name, resource_class_kwargs={'pump': pump})
+        for name, valve in brwry.valves.items():
+            self._api.add_resource(TWValveApi, BASE + '/' + name, endpoint=name, resource_class_kwargs={'twvalve': valve})
+        self._api.add_resource(TopologyApi, BASE + '/topology', endpoint="topology", resource_class_kwargs={'brwry': brwry})
+        self._api.add_resource(FlowsApi, BASE + '/flows', endpoint="flows")
         self._api.add_resource(ProcessApi, BASE + '/process', resource_class_kwargs={'process': prcss})
-        self._api.add_resource(TWValveApi, BASE + '/mashtunvalve', endpoint="mashtunvalve", resource_class_kwargs={'twvalve': brwry.mashtunvalve})
-        self._api.add_resource(TWValveApi, BASE + '/boilervalve', endpoint="boilervalve", resource_class_kwargs={'twvalve': brwry.boilervalve})
-        self._api.add_resource(ConfigApi, BASE + '/config', endpoint="config", resource_class_kwargs={'brwry': brwry, 'prcss': prcss})
+        self._api.add_resource(StatusApi, BASE + '/status', endpoint="status", resource_class_kwargs={'brwry': brwry, 'prcss': prcss})
+        self._api.add_resource(StreamApi, BASE + '/stream', endpoint="stream")
+        self._api.add_resource(MetricsApi, BASE + '/metrics', endpoint="metrics")
+        self._api.add_resource(TraceApi, BASE + '/trace', endpoint="trace")
+        if hist is not None:
+            self._api.add_resource(HistoryApi, BASE + '/history', endpoint="history", resource_class_kwargs={'hist': hist})
+            self._api.add_resource(HistoryStatsApi, BASE + '/history/stats', endpoint="historystats", resource_class_kwargs={'hist': hist})
+            self._api.add_resource(HistoryBrewApi, BASE + '/history/<int:brew_id>', endpoint="historybrew", resource_class_kwargs={'hist': hist})
+            self._api.add_resource(HistoryReportApi, BASE + '/history/<int:brew_id>/report', endpoint="historyreport", resource_class_kwargs={'hist': hist})
+        if library is not None:
+            self._api.add_resource(RecipesApi, BASE + '/recipes', endpoint="recipes", resource_class_kwargs={'library': library})
+            self._api.add_resource(RecipeApi, BASE + '/recipes/<string:recipe_id>', endpoint="recipe",
+                    resource_class_kwargs={'library': library, 'prcss': prcss})
+            self._api.add_resource(RecipeSelectionApi, BASE + '/recipe', endpoint="recipeselection",
+                    resource_class_kwargs={'library': library, 'prcss': prcss})
+        self._api.add_resource(PlanApi, BASE + '/plan', endpoint="plan", resource_class_kwargs={
+                'planner': planner.Planner(config.config.planner_cache_size, config.config.planner_timeout_secs),
+                'library': library, 'prcss': prcss})
+        if wdog is not None:
+            self._api.add_resource(WatchdogApi, BASE + '/watchdog', endpoint="watchdog", resource_class_kwargs={'wdog': wdog})
+        if fermenter is not None:
+            self._api.add_resource(FermentationApi, BASE + '/fermentation', endpoint="fermentation",
+                                   resource_class_kwargs={'fermenter': fermenter})
+            self._api.add_resource(FermentationSamplesApi, BASE + '/fermentation/samples', endpoint="fermentationsamples",
+                                   resource_class_kwargs={'fermenter': fermenter})
+        self._api.add_resource(ConfigApi, BASE + '/config', endpoint="config")
         self._api.add_resource(NotifyApi, BASE + '/notify', endpoint="notify",
                 resource_class_kwargs={'prcss': prcss, 'mashtun': brwry.mashtun, 'boiler': brwry.boiler})
 
+        self._temperature_publisher = telemetry.PeriodicPublisher(
+                telemetry.hub, config.config.telemetry_sample_secs, telemetry.EVENT_TEMPERATURE, self._temperature_sample)
+        self._published_samples = None
+
+    def _temperature_sample(self):
+        "The last samples of the vessels, None if none of them changed since the last event."
+        streaming = telemetry.hub.has_subscriptions()
+        ret = {}
+        energy = self._brewery.energy.kwh()
+        for name, jm in self._brewery.jammakers.items():
+            if streaming:
+                jm.wake()
+            temp, sampled_at = jm.get_last_sample()
+            ret[name] = {'current': temp, 'sampled_at': sampled_at, 'target': jm.get_target_temperature(), 'power': jm.get_power(),
+                         'kwh': energy.get(name)}
+        samples = dict((name, sample['sampled_at']) for name, sample in ret.items())
+        if samples == self._published_samples:
+            return None
+        self._published_samples = samples
+        return ret
+
     def start(self):
-        self._app.run()
+        """Starts serving. The server is selected by [server] Mode:
+        - development: Flask's own threaded server
+        - waitress: the waitress production server with a bounded thread pool"""
+        self._temperature_publisher.start()
+        host = config.config.server_host
+        port = config.config.server_port
+        if config.config.server_mode == 'waitress':
+            try:
+                from waitress import serve
+            except ImportError:
+                logging.error("waitress is not installed, falling back to the development server")
+            else:
+                serve(self._app, host=host, port=port, threads=config.config.server_threads,
+                      connection_limit=config.config.server_connection_limit, channel_timeout=config.config.server_channel_timeout_secs)
+                return
+        self._app.run(host=host, port=port, threaded=True)
 
 if __name__ == "__main__":
-    logging.basicConfig(filename='pombru.log', level=logging.DEBUG, format='%(asctime)s %(message)s')
+    handler = logging.handlers.RotatingFileHandler(config.config.logging_file, maxBytes=config.config.logging_max_bytes,
+                                                   backupCount=config.config.logging_backup_count)
+    logging.basicConfig(handlers=[handler], level=getattr(logging, config.config.logging_level), format='%(asctime)s %(message)s')
+    if config.config.eventlog_enabled:
+        evlog = eventlog.EventLog(config.config.eventlog_directory, config.config.eventlog_max_segment_bytes,
+                                  config.config.eventlog_max_segment_secs, config.config.eventlog_max_segments,
+                                  config.config.eventlog_queue_size)
+        evlog.start()
+        telemetry.hub.add_listener(evlog.listener)
+    hist = None
+    if config.config.history_enabled:
+        hist = history.BrewHistory(config.config.history_database, config.config.history_batch_secs,
+                                   config.config.history_sample_secs, config.config.history_queue_size)
+        hist.start()
+        telemetry.hub.add_listener(hist.listener)
     pushnoti.pushnoti_init()
-    r = recipes.from_config()
+    library = recipes.RecipeLibrary(config.config.recipes_directory)
+    _, r = library.selected()
+    if r is None:
+        r = recipes.from_config()
     logging.info("Recipe: " + str(r))
     p = process.BrewProcess(r)
     b = brewery.Brewery()
+    telemetry.hub.add_listener(b.energy.listener)
+    b.energy.register_metrics()
     p.actor = b
     b.process = p
-    PombruRestApi(b, p).start()
+    config.config.subscribe(b.config_changed)
+    config.config.subscribe(p.config_changed)
+    if config.config.config_watch_secs > 0:
+        config.ConfigWatcher(config.config, config.config.config_watch_secs).start()
+    wdog = None
+    if config.config.watchdog_enabled:
+        wdog = watchdog.Watchdog(b)
+        wdog.start()
+    PombruRestApi(b, p, hist, library, wdog, fermentation.Fermenter()).start()
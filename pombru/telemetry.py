@@ -0,0 +1,149 @@
+"""Telemetry events of the brewery: temperature samples, stage transitions,
+task dispatches and notifications. Events are pushed into bounded per-client
+queues, so a slow client never blocks the publisher."""
+import collections
+import logging
+import threading
+import time
+
+EVENT_TEMPERATURE = "temperature"
+EVENT_STATUS = "status"
+EVENT_TASK = "task"
+EVENT_NOTIFICATION = "notification"
+EVENT_BREW = "brew"
+EVENT_STAGE = "stage"
+EVENT_TARGET_REACHED = "target_reached"
+
+class Event(object):
+    "An immutable telemetry event."
+
+    __slots__ = ('sequence', 'kind', 'timestamp', 'data')
+
+    def __init__(self, sequence, kind, timestamp, data):
+        object.__setattr__(self, 'sequence', sequence)
+        object.__setattr__(self, 'kind', kind)
+        object.__setattr__(self, 'timestamp', timestamp)
+        object.__setattr__(self, 'data', data)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Event is immutable")
+
+class Subscription(object):
+    """Bounded event queue of one client. When the queue is full, the oldest
+    event is dropped."""
+
+    def __init__(self, size):
+        self._events = collections.deque(maxlen=size)
+        self._cond = threading.Condition()
+        self.dropped = 0
+
+    def put(self, event):
+        with self._cond:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+            self._events.append(event)
+            self._cond.notify()
+
+    def get(self, timeout):
+        "Returns the next event, or None if there was no event within timeout seconds."
+        with self._cond:
+            if not self._events:
+                self._cond.wait(timeout)
+            if self._events:
+                return self._events.popleft()
+            return None
+
+class TelemetryHub(object):
+    """Distributes the published events to the subscriptions and listeners.
+
+    Listeners are called synchronously on the publishing thread, so they must
+    not block (e.g. only put the event into their own queue)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = ()
+        self._listeners = ()
+        self._sequence = 0
+
+    def subscribe(self, size, limit=None):
+        "Returns a new subscription, None if there are limit subscriptions already."
+        sub = Subscription(size)
+        with self._lock:
+            if limit is not None and len(self._subscriptions) >= limit:
+                return None
+            self._subscriptions = self._subscriptions + (sub,)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscriptions = tuple(s for s in self._subscriptions if s is not sub)
+        if sub.dropped:
+            logging.info("Telemetry subscription closed, %d events were dropped", sub.dropped)
+
+    def add_listener(self, listener):
+        "Adds a function which is called with every published Event."
+        with self._lock:
+            self._listeners = self._listeners + (listener,)
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self._listeners = tuple(l for l in self._listeners if l is not listener)
+
+    def has_subscribers(self):
+        return len(self._subscriptions) > 0 or len(self._listeners) > 0
+
+    def has_subscriptions(self):
+        "True while event stream clients are subscribed, the listeners are not counted."
+        return len(self._subscriptions) > 0
+
+    def publish(self, kind, data):
+        "Publishes an event. Never blocks on the clients."
+        subscriptions = self._subscriptions
+        listeners = self._listeners
+        if not subscriptions and not listeners:
+            return
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+        event = Event(sequence, kind, time.time(), data)
+        for sub in subscriptions:
+            sub.put(event)
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception:
+                logging.exception("Telemetry listener failed")
+
+class PeriodicPublisher(object):
+    """Publishes the result of source() every interval seconds, while there
+    are subscribers. Nothing is published when source() returns None."""
+
+    def __init__(self, hub, interval, kind, source):
+        self._hub = hub
+        self._interval = interval
+        self._kind = kind
+        self._source = source
+        self._timer = None
+
+    def start(self):
+        self._timer = threading.Timer(self._interval, self._timeout)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _timeout(self):
+        try:
+            if self._hub.has_subscribers():
+                data = self._source()
+                if data is not None:
+                    self._hub.publish(self._kind, data)
+        except Exception:
+            logging.exception("Error while publishing periodic telemetry")
+        if self._timer is not None:
+            self.start()
+
+hub = TelemetryHub()
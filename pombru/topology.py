@@ -0,0 +1,350 @@
+"""The rig as a graph of vessels, pumps and valves, and the planner of the transfer paths.
+
+[topology] lists the names of the Vessels, Pumps and Valves, each has a section of its own:
+- [vessel:<name>]: SensorChannel and HeaterPin of a heated vessel, optional PowerCap
+  (percent), ChillerPin and HopArmPins (the relays of the hop arms 1, 2, ...),
+- [pump:<name>]: Pin, From: the vessel the pump draws from, To: the vessel or the valve
+  it pushes into,
+- [valve:<name>]: Pins of the relays of the two directions, Outlets: the vessel or the
+  valve each direction leads to.
+
+A route moves liquid from a vessel to a vessel (to the same one when recirculating)
+through one pump and the valves after it. The planner chooses the paths of the routes
+with the fewest valve moves, each of them costs [valves] SettleTimeSecs. Routes whose
+paths do not share a pump and need no valve in different positions run at the same time.
+The topology is read at startup. Without a [topology] section the rig of mashtun,
+temporary and boiler with three pumps and two valves is used."""
+import configparser
+import itertools
+import logging
+import threading
+
+import config
+
+SECTION_TOPOLOGY = "topology"
+PROPERTY_VESSELS = "Vessels"
+PROPERTY_PUMPS = "Pumps"
+PROPERTY_VALVES = "Valves"
+PROPERTY_SENSOR_CHANNEL = "SensorChannel"
+PROPERTY_HEATER_PIN = "HeaterPin"
+PROPERTY_POWER_CAP = "PowerCap"
+PROPERTY_CHILLER_PIN = "ChillerPin"
+PROPERTY_HOP_ARM_PINS = "HopArmPins"
+PROPERTY_PIN = "Pin"
+PROPERTY_PINS = "Pins"
+PROPERTY_FROM = "From"
+PROPERTY_TO = "To"
+PROPERTY_OUTLETS = "Outlets"
+
+# Device commands of the Router, the brewery publishes them as brew tasks
+EVENT_SET_VALVE = "SET_VALVE"
+EVENT_START_PUMP = "START_PUMP"
+EVENT_STOP_PUMP = "STOP_PUMP"
+
+# The rig Pombru was built for
+DEFAULT = {
+    SECTION_TOPOLOGY: {PROPERTY_VESSELS: "mashtun, temporary, boiler",
+                       PROPERTY_PUMPS: "mashtunpump, temppump, boilerpump",
+                       PROPERTY_VALVES: "mashtunvalve, boilervalve"},
+    "vessel:mashtun": {PROPERTY_SENSOR_CHANNEL: "6", PROPERTY_HEATER_PIN: "27"},
+    "vessel:boiler": {PROPERTY_SENSOR_CHANNEL: "7", PROPERTY_HEATER_PIN: "22", PROPERTY_POWER_CAP: "70", PROPERTY_CHILLER_PIN: "23"},
+    "pump:mashtunpump": {PROPERTY_PIN: "2", PROPERTY_FROM: "mashtun", PROPERTY_TO: "mashtunvalve"},
+    "pump:temppump": {PROPERTY_PIN: "4", PROPERTY_FROM: "temporary", PROPERTY_TO: "boiler"},
+    "pump:boilerpump": {PROPERTY_PIN: "3", PROPERTY_FROM: "boiler", PROPERTY_TO: "boilervalve"},
+    "valve:mashtunvalve": {PROPERTY_PINS: "17, 18", PROPERTY_OUTLETS: "mashtun, temporary"},
+    "valve:boilervalve": {PROPERTY_PINS: "14, 15", PROPERTY_OUTLETS: "mashtun, temporary"},
+}
+
+def route_name(source, target):
+    return source + "->" + target
+
+def parse_route(spec):
+    """Parses a route specification "source->target", optionally followed by ":" and the
+    work-idle distribution of the pump (e.g. "mashtun->mashtun:MASH_DISTRIBUTION").
+    Returns (source, target, distribution)."""
+    route, _, distribution = spec.partition(":")
+    source, arrow, target = route.partition("->")
+    if not arrow or not source.strip() or not target.strip():
+        raise ValueError("Invalid route: " + spec)
+    return source.strip(), target.strip(), distribution.strip() or None
+
+def _names(value):
+    return [n.strip() for n in value.split(",") if n.strip()]
+
+class Vessel(object):
+    def __init__(self, name, sensor_channel=None, heater_pin=None, power_cap=None, chiller_pin=None, hop_arm_pins=None):
+        self.name = name
+        self.sensor_channel = sensor_channel
+        self.heater_pin = heater_pin
+        self.power_cap = power_cap
+        self.chiller_pin = chiller_pin
+        self.hop_arm_pins = hop_arm_pins if hop_arm_pins is not None else []
+
+class PumpNode(object):
+    def __init__(self, name, pin, source, outlet):
+        self.name = name
+        self.pin = pin
+        self.source = source
+        self.outlet = outlet
+
+class ValveNode(object):
+    def __init__(self, name, pins, outlets):
+        self.name = name
+        self.pins = pins
+        self.outlets = outlets
+
+class Path(object):
+    """The way of a route: the pump and the (valve, outlet) positions after it."""
+
+    def __init__(self, source, target, pump, positions):
+        self.source = source
+        self.target = target
+        self.pump = pump
+        self.positions = tuple(positions)
+
+    def moves(self, valve_positions):
+        "Returns the (valve, outlet) positions which differ from the current valve_positions."
+        return [(v, o) for v, o in self.positions if valve_positions.get(v) != o]
+
+    def conflicts(self, other):
+        "True if the paths cannot be used at the same time: same pump, or a valve in different positions."
+        if self.pump == other.pump:
+            return True
+        mine = dict(self.positions)
+        return any(v in mine and mine[v] != o for v, o in other.positions)
+
+    def to_dict(self):
+        return {'route': route_name(self.source, self.target), 'pump': self.pump,
+                'valves': dict(self.positions)}
+
+    def __repr__(self):
+        return "Path(" + route_name(self.source, self.target) + " via " + self.pump + \
+            "".join(", " + v + "=" + o for v, o in self.positions) + ")"
+
+class Topology(object):
+    "The graph of the rig, see the module documentation."
+
+    def __init__(self, vessels, pumps, valves):
+        self.vessels = vessels
+        self.pumps = pumps
+        self.valves = valves
+        self._paths = {}
+        self._validate()
+
+    def _validate(self):
+        names = list(self.vessels) + list(self.pumps) + list(self.valves)
+        if len(set(names)) != len(names):
+            raise ValueError("Topology names must be unique: " + ", ".join(names))
+        for pump in self.pumps.values():
+            if pump.source not in self.vessels:
+                raise ValueError("Pump " + pump.name + " draws from unknown vessel " + pump.source)
+            if pump.outlet not in self.vessels and pump.outlet not in self.valves:
+                raise ValueError("Pump " + pump.name + " pushes into unknown " + pump.outlet)
+        for valve in self.valves.values():
+            if len(valve.pins) != 2 or len(valve.outlets) != 2:
+                raise ValueError("Valve " + valve.name + " must have two pins and two outlets")
+            for outlet in valve.outlets:
+                if outlet not in self.vessels and outlet not in self.valves:
+                    raise ValueError("Valve " + valve.name + " leads to unknown " + outlet)
+        # Every valve is fed by a pump or a valve, and valves do not form a loop
+        fed = set(p.outlet for p in self.pumps.values())
+        fed.update(o for v in self.valves.values() for o in v.outlets)
+        for valve in self.valves.values():
+            if valve.name not in fed:
+                raise ValueError("Valve " + valve.name + " is not connected to a pump")
+            self._valve_paths(valve.name, ())
+
+    def heated(self):
+        "Returns the vessels with a heater."
+        return [v for v in self.vessels.values() if v.heater_pin is not None]
+
+    def pumps_from(self, vessel):
+        return [p.name for p in self.pumps.values() if p.source == vessel]
+
+    def _valve_paths(self, node, seen):
+        "Returns the (target vessel, positions) reachable from a node."
+        if node in self.vessels:
+            return [(node, ())]
+        if node in seen:
+            raise ValueError("Valves form a loop: " + " -> ".join(seen + (node,)))
+        ret = []
+        for outlet in self.valves[node].outlets:
+            for target, positions in self._valve_paths(outlet, seen + (node,)):
+                ret.append((target, ((node, outlet),) + positions))
+        return ret
+
+    def paths(self, source, target):
+        "Returns all paths of the route. Raises ValueError if there is none."
+        key = (source, target)
+        if key not in self._paths:
+            if source not in self.vessels or target not in self.vessels:
+                raise ValueError("Unknown vessel in route " + route_name(source, target))
+            ret = []
+            for name in self.pumps_from(source):
+                for reached, positions in self._valve_paths(self.pumps[name].outlet, ()):
+                    if reached == target:
+                        ret.append(Path(source, target, name, positions))
+            self._paths[key] = ret
+        if not self._paths[key]:
+            raise ValueError("No path for route " + route_name(source, target))
+        return self._paths[key]
+
+    def plan(self, routes, valve_positions, fixed=()):
+        """Chooses a path for every (source, target) of routes which conflicts neither with
+        another one nor with the fixed paths, with the fewest valve moves from valve_positions.
+        Returns the paths in the order of routes. Raises ValueError if there is no such choice."""
+        options = [self.paths(source, target) for source, target in routes]
+        best = None
+        for choice in itertools.product(*options):
+            if any(a.conflicts(b) for a, b in itertools.combinations(list(choice) + list(fixed), 2)):
+                continue
+            moves = set()
+            for path in choice:
+                moves.update(path.moves(valve_positions))
+            # Fewer moves first, then shorter paths
+            cost = (len(moves), sum(len(p.positions) for p in choice))
+            if best is None or cost < best[0]:
+                best = (cost, choice)
+        if best is None:
+            raise ValueError("Conflicting routes: " + ", ".join(route_name(s, t) for s, t in routes) +
+                             (" (running: " + ", ".join(route_name(p.source, p.target) for p in fixed) + ")" if fixed else ""))
+        return list(best[1])
+
+    def to_dict(self):
+        return {'vessels': dict((v.name, {'heated': v.heater_pin is not None, 'chiller': v.chiller_pin is not None,
+                                          'hop_arms': len(v.hop_arm_pins)})
+                                for v in self.vessels.values()),
+                'pumps': dict((p.name, {'from': p.source, 'to': p.outlet}) for p in self.pumps.values()),
+                'valves': dict((v.name, {'outlets': list(v.outlets)}) for v in self.valves.values())}
+
+def _optional_int(section, prop):
+    return int(section[prop]) if prop in section else None
+
+def parse(cp):
+    """Returns the Topology of a configuration parser, the default one if it has no
+    [topology] section. Raises ValueError for missing or invalid values."""
+    if not cp.has_section(SECTION_TOPOLOGY):
+        cp = _default_parser()
+    try:
+        top = cp[SECTION_TOPOLOGY]
+        vessels, pumps, valves = {}, {}, {}
+        for name in _names(top[PROPERTY_VESSELS]):
+            section = cp["vessel:" + name] if cp.has_section("vessel:" + name) else {}
+            vessels[name] = Vessel(name, _optional_int(section, PROPERTY_SENSOR_CHANNEL), _optional_int(section, PROPERTY_HEATER_PIN),
+                                   _optional_int(section, PROPERTY_POWER_CAP), _optional_int(section, PROPERTY_CHILLER_PIN),
+                                   [int(p) for p in _names(section.get(PROPERTY_HOP_ARM_PINS, ""))])
+            if (vessels[name].sensor_channel is None) != (vessels[name].heater_pin is None):
+                raise ValueError("Vessel " + name + " needs both " + PROPERTY_SENSOR_CHANNEL + " and " + PROPERTY_HEATER_PIN)
+        for name in _names(top[PROPERTY_PUMPS]):
+            section = cp["pump:" + name]
+            pumps[name] = PumpNode(name, int(section[PROPERTY_PIN]), section[PROPERTY_FROM].strip(), section[PROPERTY_TO].strip())
+        for name in _names(top.get(PROPERTY_VALVES, "")):
+            section = cp["valve:" + name]
+            valves[name] = ValveNode(name, [int(p) for p in _names(section[PROPERTY_PINS])], _names(section[PROPERTY_OUTLETS]))
+    except KeyError as e:
+        raise ValueError("Missing topology value: " + str(e))
+    return Topology(vessels, pumps, valves)
+
+def _default_parser():
+    cp = configparser.ConfigParser()
+    cp.read_dict(DEFAULT)
+    return cp
+
+def from_config():
+    "Returns the Topology of the current configuration."
+    return parse(config.config.current.cp)
+
+class Router(object):
+    """Sets the valves and pumps of a brewery for the routes, see the module documentation.
+    * topology: the Topology
+    * pumps, valves: devices.Pump and devices.TwoWayValve by name
+    * execute: called with (event, param) for every device command, see Brewery.task()
+    The current valve positions are read from the valves, so manual moves are taken into account."""
+
+    def __init__(self, topology, pumps, valves, execute):
+        self.topology = topology
+        self._pumps = pumps
+        self._valves = valves
+        self._execute = execute
+        self._lock = threading.RLock()
+        self._active = {}
+        self._paused = []
+
+    def valve_positions(self):
+        return dict((name, valve.get_direction_name()) for name, valve in self._valves.items())
+
+    def active(self):
+        "Returns the paths of the running routes by route name."
+        with self._lock:
+            return dict((name, path) for name, (path, _) in self._active.items())
+
+    def plan(self, specs):
+        "Returns the paths the specs would run on if they replaced the running routes."
+        return self.topology.plan([parse_route(s)[:2] for s in specs], self.valve_positions())
+
+    def set_routes(self, specs):
+        """Runs exactly the routes of specs (see parse_route()). The running routes which
+        are kept are not interrupted, the others are stopped before any valve moves."""
+        with self._lock:
+            self._paused = []
+            wanted = dict((route_name(source, target), (source, target, distribution))
+                          for source, target, distribution in (parse_route(s) for s in specs))
+            for name, (_, distribution) in list(self._active.items()):
+                if name not in wanted or wanted[name][2] != distribution:
+                    self._stop(name)
+            new = [spec for name, spec in wanted.items() if name not in self._active]
+            self._run(new, self.topology.plan([spec[:2] for spec in new], self.valve_positions(), self.active().values()))
+
+    def start(self, spec):
+        "Runs one more route beside the running ones. Raises ValueError if its path conflicts with them."
+        with self._lock:
+            source, target, distribution = parse_route(spec)
+            if route_name(source, target) in self._active:
+                return
+            self._run([(source, target, distribution)],
+                      self.topology.plan([(source, target)], self.valve_positions(), self.active().values()))
+
+    def stop(self, spec):
+        with self._lock:
+            name = route_name(*parse_route(spec)[:2])
+            if name in self._active:
+                self._stop(name)
+
+    def halt(self):
+        "Stops all pumps at once, without waiting for a route being set. Used in safe state."
+        for pump in self._pumps.values():
+            pump.stop()
+        self._active = {}
+        self._paused = []
+
+    def pause(self):
+        """Stops the pumps of the running routes until resume(), the valves stay where they are.
+        Setting the routes or halt() forgets the paused ones."""
+        with self._lock:
+            for name, (path, distribution) in list(self._active.items()):
+                self._stop(name)
+                self._paused.append((path.source, path.target, distribution))
+
+    def resume(self):
+        "Runs the routes stopped by pause() again, the valves are set if they were moved meanwhile."
+        with self._lock:
+            paused, self._paused = self._paused, []
+            if paused:
+                self._run(paused, self.topology.plan([spec[:2] for spec in paused], self.valve_positions(), self.active().values()))
+
+    def _stop(self, name):
+        path, _ = self._active.pop(name)
+        self._execute(EVENT_STOP_PUMP, path.pump)
+
+    def _run(self, specs, paths):
+        positions = self.valve_positions()
+        moves = []
+        for path in paths:
+            moves.extend(m for m in path.moves(positions) if m not in moves)
+        logging.debug("Routes %s: %d valve moves", paths, len(moves))
+        # The plan keeps the valves of the running routes in their positions
+        for valve, outlet in moves:
+            self._execute(EVENT_SET_VALVE, valve + ":" + outlet)
+        for (source, target, distribution), path in zip(specs, paths):
+            self._execute(EVENT_START_PUMP, path.pump if distribution is None else path.pump + ":" + distribution)
+            self._active[route_name(source, target)] = (path, distribution)
@@ -0,0 +1,277 @@
+"""Closed-loop completion of the liquid transfers.
+
+A Transfer watches a pump moving liquid from a source to a target vessel and calls
+back when the move is complete, instead of waiting for the fixed pump time:
+- flow meter ([transfers] FlowMeterPin): a partial transfer is complete when the
+  liters are counted, emptying a vessel when the flow stops for FlowStopSecs,
+- source vessel: when it is empty, its thermistor is uncovered and reads the air or
+  the heater plate: the reading changes by UncoveredCelsius within UncoveredSecs, far
+  faster than the liquid does,
+- target vessel: the inflow moves its temperature (directly, or by the response of
+  its controlled heater) by ReceiveCelsius in StableSecs, then it stays within
+  StableCelsius for StableSecs when the inflow has stopped. Liquid of the same
+  temperature does not move it, such transfers are not detected by the target,
+- flow model: seconds per liter of the route learned from the earlier transfers which
+  were detected complete by a sensor. Used once the route has been learned.
+Sensors are only believed after MinFraction of the expected time, so a splash or a
+slow start does not end a transfer. The fixed pump time remains as a ceiling."""
+import collections
+import configparser
+import logging
+import threading
+
+import config
+import metrics
+import topology
+import utils
+
+COMPLETION_FLOW_METER = "flow_meter"
+COMPLETION_SOURCE = "source_uncovered"
+COMPLETION_TARGET = "target_stable"
+COMPLETION_MODEL = "flow_model"
+COMPLETION_CEILING = "ceiling"
+
+# The completions which measured the transfer, the flow model learns from them
+_MEASURED = frozenset([COMPLETION_FLOW_METER, COMPLETION_SOURCE, COMPLETION_TARGET])
+
+route_name = topology.route_name
+
+# Configured seconds per liter of the routes, for the expected time of a transfer
+SECONDS_PER_LITER_CONFIG = {
+    route_name('mashtun', 'temporary'): 'pump_seconds_per_liter_mash_to_temp',
+    route_name('temporary', 'boiler'): 'pump_seconds_per_liter_temp_to_boil',
+    route_name('boiler', 'temporary'): 'pump_seconds_per_liter_boil_to_temp',
+    route_name('boiler', 'mashtun'): 'pump_seconds_per_liter_boil_to_mash',
+}
+
+class FlowModelStore(object):
+    """Stores the learned seconds per liter of the routes in an ini file.
+
+    Sections are named by the route, e.g. "mashtun->temporary"."""
+
+    PROPERTY_SECONDS_PER_LITER = "SecondsPerLiter"
+    PROPERTY_TRANSFERS = "Transfers"
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.RLock()
+        self._cp = configparser.ConfigParser()
+        self._cp.optionxform = str
+        self._cp.read(filename)
+
+    def get(self, route):
+        "Returns the learned seconds per liter of the route, or None."
+        with self._lock:
+            if not self._cp.has_section(route):
+                return None
+            return float(self._cp[route][FlowModelStore.PROPERTY_SECONDS_PER_LITER])
+
+    def learn(self, route, seconds_per_liter, weight):
+        "Moves the value of the route toward the observed one by weight (0..1), and writes the file."
+        with self._lock:
+            old = self.get(route)
+            count = int(self._cp[route][FlowModelStore.PROPERTY_TRANSFERS]) if old is not None else 0
+            new = seconds_per_liter if old is None else old + weight * (seconds_per_liter - old)
+            self._cp[route] = {
+                FlowModelStore.PROPERTY_SECONDS_PER_LITER: "%.3f" % new,
+                FlowModelStore.PROPERTY_TRANSFERS: str(count + 1)}
+            with open(self._filename, "w") as f:
+                self._cp.write(f)
+            return new
+
+class TransferMonitor(object):
+    """Creates the Transfers of a brewery.
+    * sensors: jam makers by vessel name, their last samples are read
+    * flow_meter: optional lowlevel.FlowMeter
+    The flow model is not updated if learn is False (simulations)."""
+
+    def __init__(self, sensors, flow_meter=None):
+        self.sensors = sensors
+        self.flow_meter = flow_meter
+        self.learn = True
+        self._store = None
+        self._store_file = None
+
+    def store(self):
+        filename = config.config.current.transfers_model_file
+        if filename != self._store_file:
+            self._store = FlowModelStore(filename)
+            self._store_file = filename
+        return self._store
+
+    def configured_seconds_per_liter(self, route):
+        "Returns the seconds per liter of the route in [pumps], None if it is not configured."
+        name = SECONDS_PER_LITER_CONFIG.get(route)
+        return getattr(config.config.current, name) if name is not None else None
+
+    def watch(self, source, target, liters, to_empty, ceiling, callback, name=None, *args):
+        """Returns a Transfer. When started, callback(transfer, *args) is called once,
+        when the transfer is complete or ceiling seconds passed."""
+        return Transfer(self, source, target, liters, to_empty, ceiling, callback, name, *args)
+
+class Transfer(object):
+    """A transfer being watched, see the module documentation. It can be used in place of
+    a utils.PausableTimer: start(), cancel(), pause() and resume()."""
+
+    def __init__(self, monitor, source, target, liters, to_empty, ceiling, callback, name=None, *args):
+        self._monitor = monitor
+        self._source = source
+        self._target = target
+        self.route = route_name(source, target)
+        self._liters = liters
+        self._to_empty = to_empty
+        self._callback = callback
+        self._args = args
+        self.name = name
+        self._lock = threading.RLock()
+        self._ceiling_secs = ceiling
+        self._ceiling = utils.PausableTimer(ceiling, self._ceiling_reached, str(name) + " (ceiling)")
+        self._tick_timer = None
+        self._done = False
+        self._active_secs = 0.0
+        self._resumed_at = None
+        self._meter_start = 0.0
+        self._source_samples = collections.deque()
+        self._target_samples = collections.deque()
+
+    def _temperature(self, vessel):
+        jm = self._monitor.sensors.get(vessel)
+        if jm is None:
+            return None
+        jm.wake()
+        sample = jm.get_last_sample(read=False)
+        if sample is None or sample[0] != sample[0]:
+            return None
+        return sample
+
+    def start(self):
+        with self._lock:
+            self._resumed_at = utils.clock.time()
+            if self._monitor.flow_meter is not None:
+                self._meter_start = self._monitor.flow_meter.read()[0]
+            self._ceiling.start()
+            self._schedule()
+
+    def cancel(self):
+        with self._lock:
+            self._done = True
+            self._stop_ticks()
+            self._ceiling.cancel()
+
+    def pause(self):
+        with self._lock:
+            if self._done or self._resumed_at is None:
+                return
+            self._active_secs += utils.clock.time() - self._resumed_at
+            self._resumed_at = None
+            self._stop_ticks()
+            self._ceiling.pause()
+
+    def resume(self):
+        with self._lock:
+            if self._done or self._resumed_at is not None:
+                return
+            self._resumed_at = utils.clock.time()
+            # The liquid may have settled meanwhile
+            self._source_samples.clear()
+            self._target_samples.clear()
+            self._ceiling.resume()
+            self._schedule()
+
+    def elapsed(self):
+        "Seconds spent transferring, without the paused time."
+        with self._lock:
+            if self._resumed_at is None:
+                return self._active_secs
+            return self._active_secs + utils.clock.time() - self._resumed_at
+
+    def _schedule(self):
+        self._tick_timer = utils.clock.timer(1, self._tick)
+        self._tick_timer.start()
+
+    def _stop_ticks(self):
+        if self._tick_timer is not None:
+            self._tick_timer.cancel()
+            self._tick_timer = None
+
+    def _tick(self):
+        with self._lock:
+            if self._done or self._tick_timer is None:
+                return
+            self._schedule()
+            try:
+                completion = self._check(config.config.current, self.elapsed())
+            except Exception:
+                logging.exception("Checking transfer '%s' failed", self.name)
+                return
+        if completion is not None:
+            self._complete(*completion)
+
+    def _check(self, cfg, elapsed):
+        """Returns how the transfer is complete and how many seconds ago the liquid stopped
+        flowing, None while it is not complete."""
+        learned = self._monitor.store().get(self.route)
+        seconds_per_liter = learned if learned is not None else self._monitor.configured_seconds_per_liter(self.route)
+        expected = self._liters * seconds_per_liter if seconds_per_liter is not None else self._ceiling_secs
+        believable = elapsed >= cfg.transfers_min_fraction * expected
+
+        meter = self._monitor.flow_meter
+        if meter is not None:
+            liters, last_pulse_at = meter.read()
+            moved = liters - self._meter_start
+            if not self._to_empty and moved >= self._liters:
+                return COMPLETION_FLOW_METER, 0
+            if self._to_empty and moved > 0 and believable and utils.clock.time() - last_pulse_at >= cfg.transfers_flow_stop_secs:
+                return COMPLETION_FLOW_METER, utils.clock.time() - last_pulse_at
+
+        if self._to_empty:
+            sample = self._temperature(self._source)
+            if sample is not None and Transfer._window(self._source_samples, sample, cfg.transfers_uncovered_secs) >= \
+                    cfg.transfers_uncovered_celsius and believable:
+                return COMPLETION_SOURCE, 0
+            sample = self._temperature(self._target)
+            stable = cfg.transfers_stable_secs
+            if sample is not None:
+                samples = self._target_samples
+                Transfer._window(samples, sample, 2 * stable)
+                # Moving in the first half of the window, after the sensors are believed, still in the second
+                half = sample[1] - stable
+                moving = [t for at, t in samples if at < half]
+                still = [t for at, t in samples if at >= half]
+                if moving and sample[1] - samples[0][0] >= 1.8 * stable and elapsed - 2 * stable >= cfg.transfers_min_fraction * expected and \
+                        max(moving) - min(moving) >= cfg.transfers_receive_celsius and max(still) - min(still) <= cfg.transfers_stable_celsius:
+                    return COMPLETION_TARGET, stable
+
+        if learned is not None and elapsed >= expected + (cfg.transfers_tail_secs if self._to_empty else 0):
+            return COMPLETION_MODEL, 0
+        return None
+
+    @staticmethod
+    def _window(samples, sample, secs):
+        "Adds a (temperature, timestamp) sample to the window of secs seconds, returns the spread of the window."
+        temp, at = sample
+        if not samples or at > samples[-1][0]:
+            samples.append((at, temp))
+            while at - samples[0][0] > secs:
+                samples.popleft()
+        temps = [t for _, t in samples]
+        return max(temps) - min(temps)
+
+    def _ceiling_reached(self, timer, *_, **__):
+        self._complete(COMPLETION_CEILING, 0)
+
+    def _complete(self, completion, lag):
+        with self._lock:
+            if self._done:
+                return
+            self._done = True
+            self._stop_ticks()
+            self._ceiling.cancel()
+            elapsed = self.elapsed()
+        metrics.TRANSFER_SECONDS.labels(route=self.route, completion=completion).observe(elapsed)
+        logging.info("Transfer '%s' of %.1f L %s complete after %.0f s: %s", self.name, self._liters, self.route, elapsed, completion)
+        if completion in _MEASURED and self._monitor.learn and self._liters > 0:
+            cfg = config.config.current
+            spl = self._monitor.store().learn(self.route, max(elapsed - lag, 1) / self._liters, cfg.transfers_model_weight)
+            logging.info("Flow model of %s: %.2f seconds per liter", self.route, spl)
+        self._callback(self, *self._args)
@@ -1,8 +1,14 @@
 "Various general purpose utilities."
+import datetime
+import heapq
+import itertools
 import logging
 import time
 import threading
 
+import brewtrace
+import metrics
+
 def enum(*args):
     """Creates an enumeration from the parameter values.
     All parameters must be strings which are valid python identifiers
@@ -10,6 +16,85 @@ def enum(*args):
     values = {x: i for i, x in enumerate(args)}
     return type("Enum", (), values)
 
+class Clock(object):
+    """The time source of the control stack: device loops and process timers are
+    created by timer() and read the time by time(). Replaced by a VirtualClock
+    when replaying or simulating a brew."""
+
+    def time(self):
+        return time.time()
+
+    def timer(self, interval, function, args=None, kwargs=None):
+        "Returns a new, not yet started timer with the interface of threading.Timer."
+        return threading.Timer(interval, function, args, kwargs)
+
+    def sleep(self, secs):
+        time.sleep(secs)
+
+class VirtualTimer(object):
+    "Timer of the VirtualClock with the interface of threading.Timer."
+
+    def __init__(self, clock, interval, function, args=None, kwargs=None):
+        self._clock = clock
+        self.interval = interval
+        self.function = function
+        self.args = args if args is not None else []
+        self.kwargs = kwargs if kwargs is not None else {}
+        self.cancelled = False
+        self.daemon = True
+
+    def start(self):
+        self._clock.schedule(self)
+
+    def cancel(self):
+        self.cancelled = True
+
+class VirtualClock(Clock):
+    """Clock whose time only advances by run_until() and sleep(). The timers fire
+    on the thread calling run_until(), in the order of their due time. Used for
+    replaying and simulating brews."""
+
+    def __init__(self, start):
+        self._now = start
+        self._queue = []
+        self._sequence = itertools.count()
+
+    def time(self):
+        return self._now
+
+    def timer(self, interval, function, args=None, kwargs=None):
+        return VirtualTimer(self, interval, function, args, kwargs)
+
+    def sleep(self, secs):
+        self._now += secs
+
+    def schedule(self, timer):
+        heapq.heappush(self._queue, (self._now + timer.interval, next(self._sequence), timer))
+
+    def run_until(self, end):
+        "Fires the timers which are due until end, then sets the time to end."
+        while self._queue and self._queue[0][0] <= end:
+            due, _, timer = heapq.heappop(self._queue)
+            if timer.cancelled:
+                continue
+            self._now = max(self._now, due)
+            try:
+                timer.function(*timer.args, **timer.kwargs)
+            except Exception:
+                # Like a failing threading.Timer: only this timer is lost
+                logging.exception("Timer %s failed", timer.function)
+        self._now = max(self._now, end)
+
+clock = Clock()
+
+def now():
+    "Returns the current time of the clock in seconds."
+    return clock.time()
+
+def utcnow():
+    "Returns the current UTC time of the clock as a datetime."
+    return datetime.datetime.utcfromtimestamp(clock.time())
+
 class PausableTimer(object):
     """Timer which can be paused and resumed if not already fired.
     The callback will receive the timer instance before all the other parameters."""
@@ -17,7 +102,7 @@ class PausableTimer(object):
     State = enum('CREATED', 'STARTED', 'PAUSED', 'CANCELLED', 'FINISHED')
 
     def __init__(self, timeout, callback, name=None, *args, **kwargs):
-        self._timer = threading.Timer(timeout, self._callback_wrapper, args, kwargs)
+        self._timer = clock.timer(timeout, self._callback_wrapper, args, kwargs)
         self._orig_timeout = timeout
         self._callback = callback
         self._args = args
@@ -25,6 +110,7 @@ class PausableTimer(object):
         self._state = PausableTimer.State.CREATED
         self._started_at = None
         self._paused_at = None
+        self._due = None
         self._lock = threading.RLock()
         self.name = name
 
@@ -34,6 +120,8 @@ class PausableTimer(object):
             if self._state == PausableTimer.State.STARTED:
                 self._state = PausableTimer.State.FINISHED
                 start = True
+                metrics.TIMER_LATENESS_SECONDS.labels().observe(clock.time() - self._due)
+                brewtrace.tracer.end(str(self.name), brewtrace.CATEGORY_TIMER, id(self))
         if start:
             self._callback(self, *self._args, **self._kwargs)
 
@@ -41,31 +129,44 @@ class PausableTimer(object):
         if self._state != PausableTimer.State.CREATED:
             raise RuntimeError("Timer's state is " + self._state)
         self._state = PausableTimer.State.STARTED
-        self._started_at = time.time()
+        self._started_at = clock.time()
+        self._due = self._started_at + self._orig_timeout
+        brewtrace.tracer.begin(str(self.name), brewtrace.CATEGORY_TIMER, id(self), timeout=self._orig_timeout)
         self._timer.start()
-        logging.debug("Timer " + str(self.name) + " with timeout " + str(self._orig_timeout) + " started.")
+        logging.debug("Timer %s with timeout %s started.", self.name, self._orig_timeout)
 
     def cancel(self):
         with self._lock:
             if self._state != PausableTimer.State.FINISHED and self._state != PausableTimer.State.CANCELLED:
+                if self._state != PausableTimer.State.CREATED:
+                    brewtrace.tracer.end(str(self.name), brewtrace.CATEGORY_TIMER, id(self), cancelled=True)
                 self._state = PausableTimer.State.CANCELLED
-                self._timer.cancel()
+                # A paused timer has no thread timer
+                if self._timer is not None:
+                    self._timer.cancel()
 
     def pause(self):
         with self._lock:
             if (self._state == PausableTimer.State.STARTED):
-                now = time.time()
+                now = clock.time()
                 if now - self._started_at < self._orig_timeout:
                     self._state = PausableTimer.State.PAUSED
                     self._paused_at = now
                     self._timer.cancel()
+                    brewtrace.tracer.instant("paused: " + str(self.name), brewtrace.CATEGORY_TIMER)
                     self._timer = None
 
     def resume(self):
         with self._lock:
             if self._state == PausableTimer.State.PAUSED:
+                now = clock.time()
                 new_timeout = self._orig_timeout - (self._paused_at - self._started_at)
-                self._timer = threading.Timer(new_timeout, self._callback, self._args, self._kwargs)
+                # The paused time does not count, remaining() and a next pause stay right
+                self._started_at += now - self._paused_at
+                self._paused_at = None
+                self._due = now + new_timeout
+                brewtrace.tracer.instant("resumed: " + str(self.name), brewtrace.CATEGORY_TIMER)
+                self._timer = clock.timer(new_timeout, self._callback_wrapper, self._args, self._kwargs)
                 self._state = PausableTimer.State.STARTED
                 self._timer.start()
 
@@ -75,7 +176,7 @@ class PausableTimer(object):
     def remaining(self):
         with self._lock:
             if self._state == PausableTimer.State.STARTED:
-                return self._orig_timeout - (time.time() - self._started_at)
+                return self._orig_timeout - (clock.time() - self._started_at)
             elif self._state == PausableTimer.State.PAUSED:
                 return self._orig_timeout - (self._paused_at - self._started_at)
             else:
@@ -0,0 +1,171 @@
+"""Safety watchdog of the control loops and the temperature probes.
+
+A thread checks every [watchdog] CheckSecs seconds
+- the heartbeats of the loops: the control loop and the heater cycle of both jam
+  makers must tick within LateSecs of their deadline,
+- the last temperature samples: not older than StaleSecs, inside MinTemperature..
+  MaxTemperature (an open or shorted probe reads NaN or an extreme), and not changing
+  faster than MaxRate Celsius per second,
+- the heaters: working at NoRisePower percent or more, the temperature must rise by
+  NoRiseCelsius in NoRiseSecs seconds.
+
+On a fault the brewery is put into safe state for the vessel: the heater is switched
+off at once and the pumps are stopped, until the fault is cleared. A stalled loop is in
+safe state at most LateSecs + CheckSecs after its missed deadline, 0.4 s by default, well
+within the 1 s control period. The checks only read timestamps and the last samples,
+the sensors are not touched.
+
+While all the control loops are idle (see devices.JamMaker) the checks run only every
+[idle] SampleSecs seconds, a loop leaving the idle rate wakes the watchdog at once."""
+import collections
+import logging
+import threading
+
+import config
+import metrics
+import pushnoti
+import utils
+from devices import JamMaker
+
+FAULT_LOOP_STALLED = "loop_stalled"
+FAULT_HEATER_STALLED = "heater_stalled"
+FAULT_STALE_SAMPLE = "stale_sample"
+FAULT_PROBE = "probe_open_or_short"
+FAULT_RATE = "implausible_rate"
+FAULT_NO_RISE = "no_temperature_rise"
+
+class _VesselState(object):
+    "What the checks remember of a vessel."
+
+    def __init__(self):
+        self.sample = None
+        # (timestamp, temperature) when the heater started to work at high power
+        self.rise_start = None
+
+class Watchdog(object):
+    "Supervises the jam makers of a brewery, see the module documentation."
+
+    def __init__(self, brwry, history_size=50):
+        self._brewery = brwry
+        self._vessels = sorted(brwry.jammakers.items())
+        self._states = dict((name, _VesselState()) for name, _ in self._vessels)
+        self._faults = collections.deque(maxlen=history_size)
+        self._checks = 0
+        self._last_check = None
+        self._stopped = threading.Event()
+        self._woken = threading.Event()
+        for _, jm in self._vessels:
+            jm.add_wake_listener(self._woken.set)
+        self._lateness = metrics.TICK_LATENESS_SECONDS.labels(loop="watchdog")
+        self._check_seconds = metrics.WATCHDOG_CHECK_SECONDS.labels()
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="watchdog")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._woken.set()
+
+    def _run(self):
+        due = utils.clock.time()
+        while True:
+            cfg = config.config.current
+            idle = all(jm.is_idle() for _, jm in self._vessels)
+            interval = cfg.idle_sample_secs if idle else cfg.watchdog_check_secs
+            due += interval
+            if self._woken.wait(max(0, due - utils.clock.time())):
+                self._woken.clear()
+                if self._stopped.is_set():
+                    return
+            now = utils.clock.time()
+            if now < due:
+                # Woken by a loop leaving the idle rate
+                due = now
+            self._lateness.observe(now - due)
+            if now - due > interval:
+                # No catching up after the thread was starved
+                due = now
+            try:
+                with self._check_seconds.time():
+                    self.check(now)
+            except Exception:
+                logging.exception("Watchdog check failed")
+
+    def check(self, now=None):
+        "Checks all loops and samples once. Returns the faults found."
+        cfg = config.config.current
+        if now is None:
+            now = utils.clock.time()
+        found = []
+        for name, jm in self._vessels:
+            if jm.get_fault() is not None:
+                # Already in safe state
+                continue
+            fault = self._check_vessel(cfg, now, jm, self._states[name])
+            if fault is not None:
+                found.append(self._trip(name, *fault))
+        self._checks += 1
+        self._last_check = now
+        return found
+
+    def _check_vessel(self, cfg, now, jm, state):
+        "Returns a (kind, onset, message) tuple for a fault, None if everything is fine."
+        control_due, heater_due = jm.get_deadlines()
+        if control_due is not None and now - control_due > cfg.watchdog_late_secs:
+            return FAULT_LOOP_STALLED, control_due, "control loop is %.1f s late" % (now - control_due)
+        if heater_due is not None and now - heater_due > cfg.watchdog_late_secs:
+            return FAULT_HEATER_STALLED, heater_due, "heater cycle is %.1f s late" % (now - heater_due)
+
+        sample = jm.get_last_sample(read=False)
+        if sample is None:
+            return None
+        temp, at = sample
+        # StaleSecs is for samples every second, an idle loop samples less often
+        stale_secs = cfg.watchdog_stale_secs + jm.get_sample_secs() - JamMaker.TICK_SECS
+        if now - at > stale_secs:
+            return FAULT_STALE_SAMPLE, at + stale_secs, "last temperature sample is %.1f s old" % (now - at)
+        if not cfg.watchdog_min_temperature <= temp <= cfg.watchdog_max_temperature:
+            return FAULT_PROBE, at, "temperature probe reads %s, open or shorted probe" % (temp,)
+        prev = state.sample
+        if prev is not None and at > prev[1]:
+            rate = abs(temp - prev[0]) / (at - prev[1])
+            if rate > cfg.watchdog_max_rate:
+                return FAULT_RATE, at, "temperature changed %.1f -> %.1f at %.1f C/s" % (prev[0], temp, rate)
+        state.sample = sample
+
+        mode = jm.get_mode()
+        heating = mode in (JamMaker.MODE_MANUAL_ON, JamMaker.MODE_AUTOTUNE) or \
+            (mode == JamMaker.MODE_CONTROLLED and temp < jm.get_target_temperature() - cfg.watchdog_no_rise_celsius)
+        if not heating or jm.get_power() < cfg.watchdog_no_rise_power or temp >= cfg.watchdog_no_rise_below:
+            state.rise_start = None
+        elif state.rise_start is None:
+            state.rise_start = (at, temp)
+        elif at - state.rise_start[0] >= cfg.watchdog_no_rise_secs:
+            rise = temp - state.rise_start[1]
+            if rise < cfg.watchdog_no_rise_celsius:
+                return FAULT_NO_RISE, at, "temperature rose %.1f C in %.0f s while heating" % (rise, at - state.rise_start[0])
+            state.rise_start = (at, temp)
+        return None
+
+    def _trip(self, vessel, kind, onset, message):
+        self._brewery.enter_safe_state(vessel, kind)
+        at = utils.clock.time()
+        latency = max(0.0, at - onset)
+        metrics.WATCHDOG_DETECTION_SECONDS.labels(fault=kind).observe(latency)
+        fault = {'vessel': vessel, 'fault': kind, 'message': message, 'at': at, 'latency': latency}
+        self._faults.append(fault)
+        logging.error("Watchdog: %s %s, safe state entered %.3f s after the onset", vessel, message, latency)
+        pushnoti.notify_async("SAFETY: %s %s. Heater is off, pumps are stopped." % (vessel, message))
+        return fault
+
+    def clear(self):
+        "Clears the latched faults. The checks start over."
+        self._brewery.clear_faults()
+        for name, _ in self._vessels:
+            self._states[name] = _VesselState()
+
+    def get_status(self):
+        return {'checks': self._checks, 'last_check': self._last_check,
+                'active': self._brewery.get_faults(), 'faults': list(self._faults)}
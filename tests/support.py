@@ -0,0 +1,26 @@
+"""Common set-up of the tests: mocked GPIO, the modules of pombru on the path and
+the test configuration (pombru.ini.test) in a scratch working directory, so the
+files the services write stay out of the tree. Import it before any pombru module."""
+import os
+import shutil
+import sys
+import tempfile
+
+POMBRU_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pombru")
+
+os.environ['GPIOZERO_PIN_FACTORY'] = 'mock'
+if POMBRU_DIR not in sys.path:
+    sys.path.insert(0, POMBRU_DIR)
+
+WORK_DIR = tempfile.mkdtemp(prefix="pombru-tests-")
+shutil.copy(os.path.join(POMBRU_DIR, "pombru.ini.test"), os.path.join(WORK_DIR, "pombru.ini"))
+os.chdir(WORK_DIR)
+
+class TaskRecorder(object):
+    "Actor of the process which only records the tasks."
+
+    def __init__(self):
+        self.tasks = []
+
+    def task(self, task):
+        self.tasks.append(task)
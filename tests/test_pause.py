@@ -0,0 +1,88 @@
+"Pausing a brew: frozen timers, and leaving a paused stage by next() or cont_with()."
+import unittest
+
+import support
+
+import process
+import recipes
+import utils
+
+class PausableTimerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_clock, utils.clock = utils.clock, utils.VirtualClock(0.0)
+        self.fired = []
+        self.timer = utils.PausableTimer(60, self.fired.append, "test timer")
+
+    def tearDown(self):
+        utils.clock = self.saved_clock
+
+    def test_paused_time_does_not_count(self):
+        self.timer.start()
+        utils.clock.run_until(20)
+        self.timer.pause()
+        utils.clock.run_until(1000)
+        self.assertEqual(self.timer.remaining(), 40)
+        self.timer.resume()
+        utils.clock.run_until(1039)
+        self.assertEqual(self.fired, [])
+        utils.clock.run_until(1041)
+        self.assertEqual(self.fired, [self.timer])
+
+    def test_cancel_paused_timer(self):
+        self.timer.start()
+        self.timer.pause()
+        self.timer.cancel()
+        self.timer.resume()
+        utils.clock.run_until(3600)
+        self.assertEqual(self.timer.get_state(), utils.PausableTimer.State.CANCELLED)
+        self.assertEqual(self.fired, [])
+
+class BrewPauseTest(unittest.TestCase):
+    "The sparge circulation is left by its timer after [process] SpargingCirculateSecs."
+
+    def setUp(self):
+        self.saved_clock, utils.clock = utils.clock, utils.VirtualClock(0.0)
+        self.process = process.BrewProcess(recipes.from_config())
+        self.process.actor = support.TaskRecorder()
+        self.circulation = process.BrewStages.SPARGE_CIRCULATE_IN_MASH_1
+        self.process.cont_with(self.circulation)
+
+    def tearDown(self):
+        self.process.stop()
+        utils.clock = self.saved_clock
+
+    def status(self):
+        return self.process.get_status_snapshot()
+
+    def test_pause_freezes_the_stage(self):
+        self.process.pause()
+        self.assertEqual(self.status().status, 'paused')
+        utils.clock.run_until(3600)
+        self.assertIs(self.status().stage, self.circulation)
+        self.process.cont()
+        self.assertEqual(self.status().status, 'running')
+        utils.clock.run_until(7200)
+        self.assertIsNot(self.status().stage, self.circulation)
+
+    def test_next_leaves_paused_stage(self):
+        self.process.pause()
+        self.process.next()
+        self.assertEqual(self.status().status, 'running')
+        following = self.status().stage
+        self.assertIsNot(following, self.circulation)
+        # In manual transfer mode the brewer leaves the transfer, the timer of the
+        # circulation must not
+        utils.clock.run_until(7200)
+        self.assertIs(self.status().stage, following)
+
+    def test_cont_with_leaves_paused_stage(self):
+        self.process.pause()
+        self.process.cont_with(process.BrewStages.BOIL)
+        self.assertEqual(self.status().status, 'running')
+        # Nothing heats the boiler, only the timer of the circulation could leave the boil
+        utils.clock.run_until(7200)
+        self.assertIs(self.status().stage, process.BrewStages.BOIL)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+"Pausing and cancelling a watched transfer."
+import unittest
+
+import support
+
+import transfers
+import utils
+
+class TransferPauseTest(unittest.TestCase):
+    "Without sensors and flow meter the transfer is complete after its ceiling of 600 seconds."
+
+    def setUp(self):
+        self.saved_clock, utils.clock = utils.clock, utils.VirtualClock(0.0)
+        self.monitor = transfers.TransferMonitor({})
+        self.monitor.learn = False
+        self.completed = []
+        self.transfer = self.monitor.watch('mashtun', 'temporary', 10, True, 600, self.completed.append, "test transfer")
+
+    def tearDown(self):
+        self.transfer.cancel()
+        utils.clock = self.saved_clock
+
+    def test_paused_time_does_not_count(self):
+        self.transfer.start()
+        utils.clock.run_until(100)
+        self.transfer.pause()
+        utils.clock.run_until(1000)
+        self.assertEqual(self.transfer.elapsed(), 100)
+        self.assertEqual(self.completed, [])
+        self.transfer.resume()
+        utils.clock.run_until(1499)
+        self.assertEqual(self.completed, [])
+        utils.clock.run_until(1501)
+        self.assertEqual(self.completed, [self.transfer])
+
+    def test_cancel_paused_transfer(self):
+        self.transfer.start()
+        utils.clock.run_until(100)
+        self.transfer.pause()
+        self.transfer.cancel()
+        self.transfer.resume()
+        utils.clock.run_until(3600)
+        self.assertEqual(self.completed, [])
+        self.assertEqual(self.transfer.elapsed(), 100)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+"The watchdog and slow target temperature listeners: the control loop is not stalled by them."
+import threading
+import time
+import unittest
+
+import support
+
+import config
+import lowlevel
+import utils
+import watchdog
+from devices import JamMaker, TwoWayValve
+
+class DaemonClock(utils.Clock):
+    "Wall clock whose timers do not keep the test process alive."
+
+    def timer(self, interval, function, args=None, kwargs=None):
+        timer = threading.Timer(interval, function, args, kwargs)
+        timer.daemon = True
+        return timer
+
+class FixedAdc(object):
+    "Replaces an MCP3208 channel which reads a constant temperature."
+
+    def __init__(self, temp):
+        self.value = lowlevel.celsius_to_adc(temp)
+
+class SafeStateRecorder(object):
+    "Stands in for the brewery of the watchdog, records the vessels put into safe state."
+
+    def __init__(self, jammakers):
+        self.jammakers = jammakers
+        self.safe_states = []
+
+    def enter_safe_state(self, vessel, kind):
+        self.safe_states.append((vessel, kind))
+
+class TargetListenerTest(unittest.TestCase):
+    "The listener moves a valve like Brewery.mash_temp_reached() does when a stage ends."
+
+    def setUp(self):
+        self.saved_clock, utils.clock = utils.clock, DaemonClock()
+        self.saved_config = config.config.current
+        # Well above LateSecs
+        config.config.override(valve_settle_time_secs=1)
+        self.valve = TwoWayValve(12, 13, "mashtun", "boiler", name="test valve")
+        self.jammaker = JamMaker(0, 20, listener=self.target_reached, name="test", adc=FixedAdc(70))
+        self.brewery = SafeStateRecorder({'test': self.jammaker})
+        self.watchdog = watchdog.Watchdog(self.brewery)
+        self.moving = threading.Event()
+        self.moved = threading.Event()
+
+    def tearDown(self):
+        self.jammaker.off()
+        config.config.restore(self.saved_config)
+        utils.clock = self.saved_clock
+
+    def target_reached(self, target):
+        self.moving.set()
+        self.valve.direction_2()
+        self.moved.set()
+
+    def test_slow_listener_does_not_stall_the_loop(self):
+        self.jammaker.set_temperature(65)
+        self.assertTrue(self.moving.wait(10))
+        # The listener is busy for longer than LateSecs, the next tick is not due yet
+        time.sleep(0.5)
+        self.assertEqual(self.watchdog.check(), [])
+        self.assertTrue(self.moved.wait(10))
+        self.assertEqual(self.valve.get_direction_name(), "boiler")
+        self.assertEqual(self.watchdog.check(), [])
+        self.assertEqual(self.brewery.safe_states, [])
+        self.assertIsNone(self.jammaker.get_fault())
+
+if __name__ == '__main__':
+    unittest.main()